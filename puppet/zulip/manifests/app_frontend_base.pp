@@ -23,12 +23,15 @@ class zulip::app_frontend_base {
     source => "puppet:///modules/zulip/nginx/zulip-include-frontend/app",
     notify => Service["nginx"],
   }
+  # The number of Tornado processes to shard the event queue system
+  # across; must match TORNADO_PROCESSES in /etc/zulip/settings.py.
+  $tornado_processes = zulipconf("application_server", "tornado_processes", "1")
   file { "/etc/nginx/zulip-include/upstreams":
     require => Package["nginx-full"],
     owner  => "root",
     group  => "root",
     mode => 644,
-    source => "puppet:///modules/zulip/nginx/zulip-include-frontend/upstreams",
+    content => template("zulip/nginx/upstreams.template.erb"),
     notify => Service["nginx"],
   }
   file { "/etc/nginx/zulip-include/uploads.types":
@@ -278,9 +278,11 @@ exports.cleanup_event_queue = function cleanup_event_queue() {
     }
     // Set expired because in a reload we may be called twice.
     page_params.event_queue_expired = true;
+    // queue_id goes in the query string, since that's what the
+    // proxy uses to route requests on servers with several Tornado
+    // processes.
     channel.del({
-        url:      '/json/events',
-        data:     {queue_id: page_params.queue_id},
+        url:      '/json/events?queue_id=' + encodeURIComponent(page_params.queue_id),
     });
 };
 
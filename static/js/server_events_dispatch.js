@@ -40,6 +40,15 @@ exports.dispatch_normal_event = function dispatch_normal_event(event) {
         reload.initiate(reload_options);
         break;
 
+    case 'resync_required':
+        // Our event queue overflowed, so we've missed events.
+        page_params.event_queue_expired = true;
+        reload.initiate({immediate: true,
+                         save_pointer: false,
+                         save_narrow: true,
+                         save_compose: true});
+        break;
+
     case 'reaction':
         if (event.op === 'add') {
             reactions.add_reaction(event);
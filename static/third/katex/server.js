@@ -0,0 +1,42 @@
+#!/usr/bin/env node
+
+// Long-running KaTeX render server, used by zerver/lib/tex.py so that
+// rendering a formula doesn't pay for starting a new node process
+// (which is what cli.js does).
+//
+// Reads batches of formulas from stdin, one JSON array per line, each
+// formula being an object {"tex": ..., "display_mode": true/false}.
+// For each batch, writes a line to stdout with a JSON array of the
+// rendered HTML, with null for formulas KaTeX couldn't render.
+
+let katex;
+try {
+    // Attempt to import KaTeX from the production bundle
+    katex = require("/home/zulip/prod-static/min/katex.js");
+} catch (ex) {
+    // Import KaTeX from node_modules (development environment) otherwise
+    katex = require("../../node_modules/katex/katex.js");
+}
+
+const readline = require("readline");
+
+const lines = readline.createInterface({
+    input: process.stdin,
+    terminal: false,
+});
+
+lines.on("line", function (line) {
+    const formulas = JSON.parse(line);
+    const results = formulas.map(function (formula) {
+        try {
+            return katex.renderToString(formula.tex, { displayMode: formula.display_mode });
+        } catch (ex) {
+            return null;
+        }
+    });
+    process.stdout.write(JSON.stringify(results) + "\n");
+});
+
+lines.on("close", function () {
+    process.exit(0);
+});
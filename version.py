@@ -1,2 +1,2 @@
 ZULIP_VERSION = "1.6.0+git"
-PROVISION_VERSION = '6.0'
+PROVISION_VERSION = '6.1'
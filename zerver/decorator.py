@@ -17,8 +17,7 @@ from zerver.lib.timestamp import datetime_to_timestamp, timestamp_to_datetime
 from zerver.lib.utils import statsd, get_subdomain, check_subdomain, \
     is_remote_server
 from zerver.lib.exceptions import RateLimited
-from zerver.lib.rate_limiter import incr_ratelimit, is_ratelimited, \
-    api_calls_left
+from zerver.lib.rate_limiter import check_and_incr_ratelimit
 from zerver.lib.request import REQ, has_request_variables, JsonableError, RequestVariableMissingError
 from django.core.handlers import base
 
@@ -653,7 +652,7 @@ def rate_limit_user(request, user, domain):
     if the user has been rate limited, otherwise returns and modifies request to contain
     the rate limit information"""
 
-    ratelimited, time = is_ratelimited(user, domain)
+    ratelimited, time, calls_remaining = check_and_incr_ratelimit(user, domain)
     request._ratelimit_applied_limits = True
     request._ratelimit_secs_to_freedom = time
     request._ratelimit_over_limit = ratelimited
@@ -662,11 +661,7 @@ def rate_limit_user(request, user, domain):
         statsd.incr("ratelimiter.limited.%s.%s" % (type(user), user.id))
         raise RateLimited()
 
-    incr_ratelimit(user, domain)
-    calls_remaining, time_reset = api_calls_left(user, domain)
-
     request._ratelimit_remaining = calls_remaining
-    request._ratelimit_secs_to_freedom = time_reset
 
 def rate_limit(domain='all'):
     # type: (Text) -> Callable[[Callable[..., HttpResponse]], Callable[..., HttpResponse]]
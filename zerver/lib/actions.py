@@ -2,7 +2,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from typing import (
     AbstractSet, Any, AnyStr, Callable, Dict, Iterable, List, Mapping, MutableMapping,
-    Optional, Sequence, Set, Text, Tuple, TypeVar, Union, cast,
+    Optional, Sequence, Set, Text, Tuple, Type, TypeVar, Union, cast,
 )
 
 from django.utils.html import escape
@@ -16,6 +16,7 @@ from zerver.lib.bugdown import (
     url_embed_preview_enabled_for_realm
 )
 from zerver.lib.cache import (
+    per_request_message_dict_cache,
     to_dict_cache_key,
     to_dict_cache_key_id,
 )
@@ -23,9 +24,12 @@ from zerver.lib.context_managers import lockfile
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.message import (
     access_message,
+    delete_unread_summaries,
     MessageDict,
-    message_to_dict,
+    RealmAlertWords,
+    bulk_render_markdown,
     render_markdown,
+    stringify_message_dict,
 )
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.retention import move_message_to_archive
@@ -53,7 +57,7 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
 from zerver.lib.alert_words import alert_words_in_realm
 from zerver.lib.avatar import avatar_url
 
-from django.db import transaction, IntegrityError, connection
+from django.db import models, transaction, IntegrityError, connection
 from django.db.models import F, Q, Max
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
@@ -65,16 +69,19 @@ import six
 from six.moves import filter
 from six.moves import map
 from six.moves import range
-from six import unichr
+from six import binary_type, unichr
 
 from zerver.lib.create_user import random_api_key
 from zerver.lib.timestamp import timestamp_to_datetime, datetime_to_timestamp
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.presence import set_last_active_times
 from zerver.lib.create_user import create_user
 from zerver.lib import bugdown
 from zerver.lib.cache import cache_with_key, cache_set, \
     user_profile_by_email_cache_key, user_profile_cache_key, \
-    cache_set_many, cache_delete, cache_delete_many
+    cache_set_many, cache_delete, cache_delete_many, \
+    generic_bulk_cached_fetch, delete_stream_subscriber_caches, \
+    stream_subscriber_dict_fields, stream_subscribers_cache_key
 from zerver.decorator import statsd_increment
 from zerver.lib.utils import log_statsd_event, statsd
 from zerver.lib.html_diff import highlight_html_differences
@@ -87,7 +94,7 @@ from zerver.lib.sessions import delete_user_sessions
 from zerver.lib.upload import attachment_url_re, attachment_url_to_path_id, \
     claim_attachment, delete_message_image
 from zerver.lib.str_utils import NonBinaryStr, force_str
-from zerver.tornado.event_queue import request_event_queue, send_event
+from zerver.tornado.event_queue import request_event_queue, send_event, send_event_batch
 
 import DNS
 import ujson
@@ -575,6 +582,7 @@ def do_deactivate_stream(stream, log=True):
         recipient__type=Recipient.STREAM,
         recipient__type_id=stream.id,
         active=True).update(active=False)
+    delete_stream_subscriber_caches([get_recipient(Recipient.STREAM, stream.id).id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -686,9 +694,10 @@ def create_mirror_user_if_needed(realm, email, email_to_fullname):
         except IntegrityError:
             return get_user(email, realm)
 
-def render_incoming_message(message, content, message_users, realm):
-    # type: (Message, Text, Set[UserProfile], Realm) -> Text
-    realm_alert_words = alert_words_in_realm(realm)
+def render_incoming_message(message, content, message_users, realm, realm_alert_words=None):
+    # type: (Message, Text, Set[UserProfile], Realm, Optional[RealmAlertWords]) -> Text
+    if realm_alert_words is None:
+        realm_alert_words = alert_words_in_realm(realm)
     try:
         rendered_content = render_markdown(
             message=message,
@@ -701,6 +710,52 @@ def render_incoming_message(message, content, message_users, realm):
         raise JsonableError(_('Unable to render message'))
     return rendered_content
 
+def render_incoming_messages(renders):
+    # type: (List[Dict[str, Any]]) -> List[Text]
+    """Batch version of render_incoming_message; see bulk_render_markdown."""
+    for render in renders:
+        if render.get('realm_alert_words') is None:
+            render['realm_alert_words'] = alert_words_in_realm(render['realm'])
+    try:
+        return bulk_render_markdown(renders)
+    except BugdownRenderingException:
+        raise JsonableError(_('Unable to render message'))
+
+def get_stream_subscriber_dicts(recipient_ids):
+    # type: (Iterable[int]) -> Dict[int, List[Dict[str, Any]]]
+    """Fetches the active subscribers of the streams with the given
+    recipient IDs, as dicts of stream_subscriber_dict_fields.  These
+    lists are cached, and deleted by bulk_add_subscriptions,
+    bulk_remove_subscriptions and flush_user_profile when they change,
+    so on a warm cache this doesn't touch the database."""
+    def query_function(recipient_ids):
+        # type: (List[int]) -> List[Tuple[int, List[Dict[str, Any]]]]
+        fields = ['user_profile__' + field for field in stream_subscriber_dict_fields]
+        rows = Subscription.objects.filter(recipient_id__in=recipient_ids, active=True).values(
+            'recipient_id', *fields)
+        subscribers_by_recipient_id = defaultdict(list)  # type: Dict[int, List[Dict[str, Any]]]
+        for row in rows:
+            subscribers_by_recipient_id[row['recipient_id']].append(
+                dict((field, row['user_profile__' + field]) for field in stream_subscriber_dict_fields))
+        return [(recipient_id, subscribers_by_recipient_id[recipient_id])
+                for recipient_id in recipient_ids]
+
+    return generic_bulk_cached_fetch(
+        stream_subscribers_cache_key,
+        query_function,
+        list(recipient_ids),
+        id_fetcher=lambda item: item[0],
+        cache_transformer=lambda item: item[1])
+
+def user_profile_from_stream_subscriber_dict(subscriber):
+    # type: (Dict[str, Any]) -> UserProfile
+    # This builds the same partially loaded object as
+    # UserProfile.objects.only(*stream_subscriber_dict_fields); any
+    # other field is fetched from the database if it is accessed.
+    values = [subscriber[field.attname] for field in UserProfile._meta.concrete_fields
+              if field.attname in subscriber]
+    return UserProfile.from_db('default', stream_subscriber_dict_fields, values)
+
 def get_recipient_user_profiles(recipient, sender_id):
     # type: (Recipient, int) -> List[UserProfile]
     if recipient.type == Recipient.PERSONAL:
@@ -711,20 +766,17 @@ def get_recipient_user_profiles(recipient, sender_id):
         # For personals, you send out either 1 or 2 copies, for
         # personals to yourself or to someone else, respectively.
         assert((len(recipients) == 1) or (len(recipients) == 2))
-    elif (recipient.type == Recipient.STREAM or recipient.type == Recipient.HUDDLE):
+    elif recipient.type == Recipient.STREAM:
+        subscribers = get_stream_subscriber_dicts([recipient.id]).get(recipient.id, [])
+        recipients = [user_profile_from_stream_subscriber_dict(subscriber)
+                      for subscriber in subscribers]
+    elif recipient.type == Recipient.HUDDLE:
         # We use select_related()/only() here, while the PERSONAL case above uses
-        # get_user_profile_by_id() to get UserProfile objects from cache.  Streams will
+        # get_user_profile_by_id() to get UserProfile objects from cache.  Huddles will
         # typically have more recipients than PMs, so get_user_profile_by_id() would be
         # a bit more expensive here, given that we need to hit the DB anyway and only
         # care about the email from the user profile.
-        fields = [
-            'user_profile__id',
-            'user_profile__email',
-            'user_profile__enable_online_push_notifications',
-            'user_profile__is_active',
-            'user_profile__is_bot',
-            'user_profile__bot_type',
-        ]
+        fields = ['user_profile__' + field for field in stream_subscriber_dict_fields]
         query = Subscription.objects.select_related("user_profile").only(*fields).filter(
             recipient=recipient, active=True)
         recipients = [s.user_profile for s in query]
@@ -732,6 +784,44 @@ def get_recipient_user_profiles(recipient, sender_id):
         raise ValueError('Bad recipient type')
     return recipients
 
+def bulk_get_recipient_user_profiles(messages):
+    # type: (Sequence[Message]) -> List[List[UserProfile]]
+    """Batch version of get_recipient_user_profiles, which fetches the
+    subscribers for all the stream messages from the stream subscriber
+    cache at once, and those for all the huddle messages in a single
+    query.  Returns a list of recipients, in the same order as
+    `messages`."""
+    stream_recipient_ids = {
+        message.recipient_id for message in messages
+        if message.recipient.type == Recipient.STREAM}
+    huddle_recipient_ids = {
+        message.recipient_id for message in messages
+        if message.recipient.type == Recipient.HUDDLE}
+
+    users_by_recipient_id = defaultdict(list)  # type: Dict[int, List[UserProfile]]
+    if stream_recipient_ids:
+        subscribers_by_recipient_id = get_stream_subscriber_dicts(stream_recipient_ids)
+        for recipient_id, subscribers in subscribers_by_recipient_id.items():
+            users_by_recipient_id[recipient_id] = [
+                user_profile_from_stream_subscriber_dict(subscriber)
+                for subscriber in subscribers]
+    if huddle_recipient_ids:
+        fields = ['recipient'] + ['user_profile__' + field for field in stream_subscriber_dict_fields]
+        query = Subscription.objects.select_related("user_profile").only(*fields).filter(
+            recipient_id__in=huddle_recipient_ids, active=True)
+        for sub in query:
+            users_by_recipient_id[sub.recipient_id].append(sub.user_profile)
+
+    recipients = []  # type: List[List[UserProfile]]
+    for message in messages:
+        if message.recipient.type == Recipient.PERSONAL:
+            recipients.append(get_recipient_user_profiles(message.recipient, message.sender_id))
+        elif message.recipient.type in (Recipient.STREAM, Recipient.HUDDLE):
+            recipients.append(users_by_recipient_id[message.recipient_id])
+        else:
+            raise ValueError('Bad recipient type')
+    return recipients
+
 def do_send_messages(messages_maybe_none):
     # type: (Sequence[Optional[MutableMapping[str, Any]]]) -> List[int]
     # Filter out messages which didn't pass internal_prep_message properly
@@ -756,22 +846,34 @@ def do_send_messages(messages_maybe_none):
         message['sender_queue_id'] = message.get('sender_queue_id', None)
         message['realm'] = message.get('realm', message['message'].sender.realm)
 
-    for message in messages:
-        message['recipients'] = get_recipient_user_profiles(message['message'].recipient,
-                                                            message['message'].sender_id)
+    # Fetch the recipients for the whole batch at once, rather than
+    # doing a Subscription query per message.
+    all_recipients = bulk_get_recipient_user_profiles([message['message'] for message in messages])
+    for message, recipients in zip(messages, all_recipients):
+        message['recipients'] = recipients
         # Only deliver the message to active user recipients
         message['active_recipients'] = [user_profile for user_profile in message['recipients']
                                         if user_profile.is_active]
 
     links_for_embed = set()  # type: Set[Text]
-    # Render our messages.
+    # Render our messages.  Realm-level data needed for rendering is
+    # fetched once per realm, not once per message.
+    realm_alert_words_by_realm_id = {}  # type: Dict[int, RealmAlertWords]
+    renders = []  # type: List[Dict[str, Any]]
     for message in messages:
         assert message['message'].rendered_content is None
-        rendered_content = render_incoming_message(
-            message['message'],
-            message['message'].content,
-            message['active_recipients'],
-            message['realm'])
+        realm_id = message['realm'].id
+        if realm_id not in realm_alert_words_by_realm_id:
+            realm_alert_words_by_realm_id[realm_id] = alert_words_in_realm(message['realm'])
+        renders.append(dict(message=message['message'],
+                            content=message['message'].content,
+                            message_users=message['active_recipients'],
+                            realm=message['realm'],
+                            realm_alert_words=realm_alert_words_by_realm_id[realm_id]))
+    # The whole batch is rendered at once, so that it can be rendered
+    # in parallel by the bugdown worker pool.
+    all_rendered_content = render_incoming_messages(renders)
+    for message, rendered_content in zip(messages, all_rendered_content):
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = bugdown_version
         links_for_embed |= message['message'].links_for_preview
@@ -785,22 +887,34 @@ def do_send_messages(messages_maybe_none):
         Message.objects.bulk_create([message['message'] for message in messages])
         ums = []  # type: List[UserMessage]
         for message in messages:
+            # These properties on the Message are set via
+            # render_markdown by code in the bugdown inline patterns
+            wildcard = message['message'].mentions_wildcard
+            mentioned_ids = message['message'].mentions_user_ids
+            ids_with_alert_words = message['message'].user_ids_with_alert_words
+            is_me_message = message['message'].is_me_message
+
+            # Soft-deactivated users only get UserMessage rows for
+            # stream messages that mention them or contain their alert
+            # words; the rest are created if they come back.  See
+            # zerver/lib/soft_deactivation.py.
+            message['idle_user_ids'] = set()
+            if message['message'].recipient.type == Recipient.STREAM:
+                message['idle_user_ids'] = {
+                    user_profile.id for user_profile in message['active_recipients']
+                    if user_profile.long_term_idle and
+                    user_profile.id not in mentioned_ids and
+                    user_profile.id not in ids_with_alert_words}
+
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
             # they will be processed later.
             ums_to_create = []
             for user_profile in message['active_recipients']:
                 # is_service_bot is derived from is_bot and bot_type, and both of these fields
                 # should have been pre-fetched.
-                if not user_profile.is_service_bot:
+                if not user_profile.is_service_bot and user_profile.id not in message['idle_user_ids']:
                     ums_to_create.append(UserMessage(user_profile=user_profile, message=message['message']))
 
-            # These properties on the Message are set via
-            # render_markdown by code in the bugdown inline patterns
-            wildcard = message['message'].mentions_wildcard
-            mentioned_ids = message['message'].mentions_user_ids
-            ids_with_alert_words = message['message'].user_ids_with_alert_words
-            is_me_message = message['message'].is_me_message
-
             for um in ums_to_create:
                 if um.user_profile.id == message['message'].sender.id and \
                         message['message'].sent_by_human():
@@ -863,27 +977,44 @@ def do_send_messages(messages_maybe_none):
             if Message.content_has_attachment(message['message'].content):
                 do_claim_attachments(message['message'])
 
+    # Build the message dicts for the whole batch once, and prime the
+    # to_dict cache with them in a single round trip.  Newly sent
+    # messages can't have any reactions yet, so we skip that query.
+    # The events use the dicts we built directly, and we keep them in
+    # the per-request cache too, rather than decoding them again.
+    message_dicts = {}  # type: Dict[Tuple[int, bool], Dict[str, Any]]
+    items_for_remote_cache = {}  # type: Dict[Text, Tuple[binary_type]]
+    for message in messages:
+        for apply_markdown in (True, False):
+            message_dict = MessageDict.to_dict_uncached_helper(message['message'], apply_markdown,
+                                                               reactions=[])
+            key = to_dict_cache_key(message['message'], apply_markdown)
+            items_for_remote_cache[key] = (stringify_message_dict(message_dict),)
+            per_request_message_dict_cache[key] = message_dict
+            message_dicts[(message['message'].id, apply_markdown)] = message_dict
+    cache_set_many(items_for_remote_cache)
+
+    events_and_users = []  # type: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]
+    # Published to the worker queues only once Tornado has the
+    # message events, so that e.g. an embed_links update_message
+    # event can't get there before the message itself.
+    queue_events = []  # type: List[Tuple[str, Dict[str, Any]]]
     for message in messages:
         # Deliver events to the real-time push system, as well as
         # enqueuing any additional processing triggered by the message.
         user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        user_presences = get_status_dict(sender)
-        presences = {}
-        for user_profile in message['active_recipients']:
-            if user_profile.email in user_presences:
-                presences[user_profile.id] = user_presences[user_profile.email]
 
+        message_dict_no_markdown = message_dicts[(message['message'].id, False)]
         event = dict(
             type         = 'message',
             message      = message['message'].id,
-            message_dict_markdown = message_to_dict(message['message'], apply_markdown=True),
-            message_dict_no_markdown = message_to_dict(message['message'], apply_markdown=False),
-            presences    = presences)
+            message_dict_markdown = message_dicts[(message['message'].id, True)],
+            message_dict_no_markdown = message_dict_no_markdown)
         users = [{'id': user.id,
                   'flags': user_flags.get(user.id, []),
                   'always_push_notify': user.enable_online_push_notifications}
-                 for user in message['active_recipients']]
+                 for user in message['active_recipients']
+                 if user.id not in message['idle_user_ids']]
         if message['message'].recipient.type == Recipient.STREAM:
             # Note: This is where authorization for single-stream
             # get_updates happens! We only attach stream data to the
@@ -902,7 +1033,7 @@ def do_send_messages(messages_maybe_none):
             event['local_id'] = message['local_id']
         if message['sender_queue_id'] is not None:
             event['sender_queue_id'] = message['sender_queue_id']
-        send_event(event, users)
+        events_and_users.append((event, users))
 
         if url_embed_preview_enabled_for_realm(message['message']) and links_for_embed:
             event_data = {
@@ -910,29 +1041,27 @@ def do_send_messages(messages_maybe_none):
                 'message_content': message['message'].content,
                 'message_realm_id': message['realm'].id,
                 'urls': links_for_embed}
-            queue_json_publish('embed_links', event_data, lambda x: None)
+            queue_events.append(('embed_links', event_data))
 
         if (settings.ENABLE_FEEDBACK and
             message['message'].recipient.type == Recipient.PERSONAL and
                 settings.FEEDBACK_BOT in [up.email for up in message['recipients']]):
-            queue_json_publish(
-                'feedback_messages',
-                message_to_dict(message['message'], apply_markdown=False),
-                lambda x: None
-            )
+            queue_events.append(('feedback_messages', message_dict_no_markdown))
+
+        for queue_name, service_events in message['message'].service_queue_events.items():
+            for service_event in service_events:
+                queue_events.append((queue_name, {
+                    "message": message_dict_no_markdown,
+                    "trigger": service_event['trigger'],
+                    "user_profile_id": service_event["user_profile"].id,
+                    "failed_tries": 0,
+                }))
 
-        for queue_name, events in message['message'].service_queue_events.items():
-            for event in events:
-                queue_json_publish(
-                    queue_name,
-                    {
-                        "message": message_to_dict(message['message'], apply_markdown=False),
-                        "trigger": event['trigger'],
-                        "user_profile_id": event["user_profile"].id,
-                        "failed_tries": 0,
-                    },
-                    lambda x: None
-                )
+    # Notify Tornado about the whole batch with a single publish.
+    send_event_batch(events_and_users)
+
+    for queue_name, queue_event in queue_events:
+        queue_json_publish(queue_name, queue_event, lambda x: None)
 
     # Note that this does not preserve the order of message ids
     # returned.  In practice, this shouldn't matter, as we only
@@ -1675,6 +1804,7 @@ def bulk_add_subscriptions(streams, users, from_stream_creation=False, acting_us
         Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add])
         Subscription.objects.filter(id__in=[sub.id for (sub, stream) in subs_to_activate]).update(active=True)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
+    delete_stream_subscriber_caches({sub.recipient_id for (sub, stream) in subs_to_add + subs_to_activate})
 
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
@@ -1685,7 +1815,7 @@ def bulk_add_subscriptions(streams, users, from_stream_creation=False, acting_us
                                                    acting_user=acting_user,
                                                    modified_user=sub.user_profile,
                                                    modified_stream=stream,
-                                                   event_last_message_id=0,
+                                                   event_last_message_id=event_last_message_id,
                                                    event_type='subscription_created',
                                                    event_time=event_time))
     for (sub, stream) in subs_to_activate:
@@ -1821,6 +1951,7 @@ def bulk_remove_subscriptions(users, streams, acting_user=None):
         Subscription.objects.filter(id__in=[sub.id for (sub, stream_name) in
                                             subs_to_deactivate]).update(active=False)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
+    delete_stream_subscriber_caches({sub.recipient_id for (sub, stream) in subs_to_deactivate})
 
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
@@ -2450,43 +2581,153 @@ def streams_to_dicts_sorted(streams):
     # type: (List[Stream]) -> List[Dict[str, Any]]
     return sorted([stream.to_dict() for stream in streams], key=lambda elt: elt["name"])
 
+def bulk_update_fields(model, field_names, objs):
+    # type: (Type[models.Model], List[str], Sequence[models.Model]) -> None
+    """Saves the given fields of many existing objects with a single
+    UPDATE query, using a VALUES list (which, unlike INSERT ... ON
+    CONFLICT, works on all the postgres versions we support)."""
+    if len(objs) == 0:
+        return
+    fields = [model._meta.get_field(field_name) for field_name in field_names]
+    row_template = "(%%s, %s)" % (", ".join("%%s::%s" % (field.db_type(connection),)
+                                             for field in fields),)
+    query = """
+        UPDATE %(table)s
+        SET %(assignments)s
+        FROM (VALUES %(rows)s) AS updates(id, %(columns)s)
+        WHERE %(table)s.id = updates.id
+    """ % {'table': model._meta.db_table,
+           'assignments': ", ".join("%s = updates.%s" % (field.column, field.column)
+                                    for field in fields),
+           'rows': ", ".join([row_template] * len(objs)),
+           'columns': ", ".join(field.column for field in fields)}
+    params = []  # type: List[Any]
+    for obj in objs:
+        params.append(obj.id)
+        for field in fields:
+            params.append(field.get_db_prep_value(getattr(obj, field.attname), connection))
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    cursor.close()
+
+# How many times to try a batch of row writes that INSERTs the rows
+# it didn't find, when concurrent INSERTs of the same unique keys
+# make it fail.
+INSERT_CONFLICT_ATTEMPTS = 3
+
+def retry_on_insert_conflict(write):
+    # type: (Callable[[], Any]) -> Any
+    """Runs `write` in a transaction and returns its result.  `write`
+    should SELECT the rows it needs to update and INSERT the others;
+    if another process INSERTs one of those first, the transaction is
+    rolled back and `write` runs again, finding that row this time."""
+    for attempt in range(INSERT_CONFLICT_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return write()
+        except IntegrityError:
+            if attempt == INSERT_CONFLICT_ATTEMPTS - 1:
+                raise
+            statsd.incr('insert_conflict_retries')
+
 def do_update_user_activity_interval(user_profile, log_time):
     # type: (UserProfile, datetime.datetime) -> None
-    effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
-    # This code isn't perfect, because with various races we might end
-    # up creating two overlapping intervals, but that shouldn't happen
-    # often, and can be corrected for in post-processing
-    try:
-        last = UserActivityInterval.objects.filter(user_profile=user_profile).order_by("-end")[0]
-        # There are two ways our intervals could overlap:
-        # (1) The start of the new interval could be inside the old interval
-        # (2) The end of the new interval could be inside the old interval
-        # In either case, we just extend the old interval to include the new interval.
-        if ((log_time <= last.end and log_time >= last.start) or
-                (effective_end <= last.end and effective_end >= last.start)):
-            last.end = max(last.end, effective_end)
-            last.start = min(last.start, log_time)
-            last.save(update_fields=["start", "end"])
-            return
-    except IndexError:
-        pass
+    bulk_update_user_activity_interval([(user_profile, log_time)])
+
+def bulk_update_user_activity_interval(activity_times):
+    # type: (Sequence[Tuple[UserProfile, datetime.datetime]]) -> None
+    """Records that each user was active at the given times, extending
+    their latest UserActivityInterval or creating new ones.  This does
+    the same thing as processing the times in order one at a time, but
+    with a fixed number of queries."""
+    if len(activity_times) == 0:
+        return
+    times_by_user_id = defaultdict(list)  # type: Dict[int, List[datetime.datetime]]
+    for (user_profile, log_time) in activity_times:
+        times_by_user_id[user_profile.id].append(log_time)
+
+    # An interval ending before all the new times can't overlap any of
+    # them, so we only need to look at more recent ones.
+    earliest_time = min(log_time for (user_profile, log_time) in activity_times)
+    last_intervals = {}  # type: Dict[int, UserActivityInterval]
+    for interval in UserActivityInterval.objects.filter(
+            user_profile_id__in=list(times_by_user_id.keys()),
+            end__gte=earliest_time).order_by('user_profile_id', '-end').distinct('user_profile_id'):
+        last_intervals[interval.user_profile_id] = interval
+
+    new_intervals = []  # type: List[UserActivityInterval]
+    updated_intervals = {}  # type: Dict[int, UserActivityInterval]
+    for user_profile_id, log_times in six.iteritems(times_by_user_id):
+        last = last_intervals.get(user_profile_id)
+        for log_time in sorted(log_times):
+            effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
+            # This code isn't perfect, because with various races we might end
+            # up creating two overlapping intervals, but that shouldn't happen
+            # often, and can be corrected for in post-processing
+            #
+            # There are two ways our intervals could overlap:
+            # (1) The start of the new interval could be inside the old interval
+            # (2) The end of the new interval could be inside the old interval
+            # In either case, we just extend the old interval to include the new interval.
+            if last is not None and (
+                    (log_time <= last.end and log_time >= last.start) or
+                    (effective_end <= last.end and effective_end >= last.start)):
+                last.end = max(last.end, effective_end)
+                last.start = min(last.start, log_time)
+                if last.id is not None:
+                    updated_intervals[last.id] = last
+                continue
 
-    # Otherwise, the intervals don't overlap, so we should make a new one
-    UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
+            # Otherwise, the intervals don't overlap, so we should make a new one
+            last = UserActivityInterval(user_profile_id=user_profile_id, start=log_time,
                                         end=effective_end)
+            new_intervals.append(last)
+
+    with transaction.atomic():
+        UserActivityInterval.objects.bulk_create(new_intervals)
+        bulk_update_fields(UserActivityInterval, ["start", "end"],
+                           list(updated_intervals.values()))
 
-@statsd_increment('user_activity')
 def do_update_user_activity(user_profile, client, query, log_time):
     # type: (UserProfile, Client, Text, datetime.datetime) -> None
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        query = query,
-        defaults={'last_visit': log_time, 'count': 0})
+    bulk_update_user_activity([(user_profile, client, query, log_time)])
 
-    activity.count += 1
-    activity.last_visit = log_time
-    activity.save(update_fields=["last_visit", "count"])
+def bulk_update_user_activity(activities):
+    # type: (Sequence[Tuple[UserProfile, Client, Text, datetime.datetime]]) -> None
+    """Records a batch of requests in UserActivity, with one row write
+    per distinct (user, client, query) rather than one per request."""
+    if len(activities) == 0:
+        return
+    counts = defaultdict(int)  # type: Dict[Tuple[int, int, Text], int]
+    last_visits = {}  # type: Dict[Tuple[int, int, Text], datetime.datetime]
+    for (user_profile, client, query, log_time) in activities:
+        key = (user_profile.id, client.id, query)
+        counts[key] += 1
+        last_visits[key] = max(last_visits.get(key, log_time), log_time)
+
+    def write_activities():
+        # type: () -> None
+        new_counts = dict(counts)
+        updated_activities = []  # type: List[UserActivity]
+        for activity in UserActivity.objects.select_for_update().filter(
+                user_profile_id__in=set(key[0] for key in counts),
+                client_id__in=set(key[1] for key in counts),
+                query__in=set(key[2] for key in counts)):
+            key = (activity.user_profile_id, activity.client_id, activity.query)
+            if key not in new_counts:
+                continue
+            activity.count += new_counts.pop(key)
+            activity.last_visit = max(activity.last_visit, last_visits[key])
+            updated_activities.append(activity)
+        bulk_update_fields(UserActivity, ["count", "last_visit"], updated_activities)
+
+        UserActivity.objects.bulk_create([
+            UserActivity(user_profile_id=user_profile_id, client_id=client_id, query=query,
+                         count=count, last_visit=last_visits[(user_profile_id, client_id, query)])
+            for ((user_profile_id, client_id, query), count) in six.iteritems(new_counts)])
+
+    retry_on_insert_conflict(write_activities)
+    statsd.incr('user_activity', len(activities))
 
 def send_presence_changed(user_profile, presence):
     # type: (UserProfile, UserPresence) -> None
@@ -2509,40 +2750,79 @@ def consolidate_client(client):
     else:
         return client
 
-@statsd_increment('user_presence')
 def do_update_user_presence(user_profile, client, log_time, status):
     # type: (UserProfile, Client, datetime.datetime, int) -> None
-    client = consolidate_client(client)
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        defaults = {'timestamp': log_time,
-                    'status': status})
-
-    stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
-    was_idle = presence.status == UserPresence.IDLE
-    became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
-
-    # If an object was created, it has already been saved.
-    #
-    # We suppress changes from ACTIVE to IDLE before stale_status is reached;
-    # this protects us from the user having two clients open: one active, the
-    # other idle. Without this check, we would constantly toggle their status
-    # between the two states.
-    if not created and stale_status or was_idle or status == presence.status:
-        # The following block attempts to only update the "status"
-        # field in the event that it actually changed.  This is
-        # important to avoid flushing the UserPresence cache when the
-        # data it would return to a client hasn't actually changed
-        # (see the UserPresence post_save hook for details).
-        presence.timestamp = log_time
-        update_fields = ["timestamp"]
-        if presence.status != status:
-            presence.status = status
-            update_fields.append("status")
-        presence.save(update_fields=update_fields)
-
-    if not user_profile.realm.is_zephyr_mirror_realm and (created or became_online):
+    bulk_update_user_presence([(user_profile, client, log_time, status)])
+
+def bulk_update_user_presence(presence_updates):
+    # type: (Sequence[Tuple[UserProfile, Client, datetime.datetime, int]]) -> None
+    """Records a batch of presence updates.  Only the newest update for
+    each (user, client) matters, so the others are dropped, and the
+    UserPresence rows are written with one INSERT and one UPDATE."""
+    if len(presence_updates) == 0:
+        return
+    latest_updates = {}  # type: Dict[Tuple[int, int], Tuple[UserProfile, Client, datetime.datetime, int]]
+    for (user_profile, client, log_time, status) in presence_updates:
+        client = consolidate_client(client)
+        key = (user_profile.id, client.id)
+        if key not in latest_updates or log_time >= latest_updates[key][2]:
+            latest_updates[key] = (user_profile, client, log_time, status)
+
+    def write_presences():
+        # type: () -> Tuple[Dict[int, int], List[Tuple[UserProfile, UserPresence]]]
+        existing_presences = {}  # type: Dict[Tuple[int, int], UserPresence]
+        for presence in UserPresence.objects.select_related('client').filter(
+                user_profile_id__in=set(key[0] for key in latest_updates),
+                client_id__in=set(key[1] for key in latest_updates)):
+            existing_presences[(presence.user_profile_id, presence.client_id)] = presence
+
+        new_presences = []  # type: List[UserPresence]
+        updated_presences = []  # type: List[UserPresence]
+        last_active_times = {}  # type: Dict[int, int]
+        changed_presences = []  # type: List[Tuple[UserProfile, UserPresence]]
+        for key, (user_profile, client, log_time, status) in six.iteritems(latest_updates):
+            presence = existing_presences.get(key)
+            created = presence is None
+            if presence is None:
+                presence = UserPresence(user_profile=user_profile, client=client,
+                                        timestamp=log_time, status=status)
+                new_presences.append(presence)
+                became_online = False
+            else:
+                stale_status = ((log_time - presence.timestamp) >
+                                datetime.timedelta(minutes=1, seconds=10))
+                was_idle = presence.status == UserPresence.IDLE
+                became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
+
+                # We suppress changes from ACTIVE to IDLE before stale_status is reached;
+                # this protects us from the user having two clients open: one active, the
+                # other idle. Without this check, we would constantly toggle their status
+                # between the two states.
+                if stale_status or was_idle or status == presence.status:
+                    presence.timestamp = log_time
+                    presence.status = status
+                    updated_presences.append(presence)
+
+            if not user_profile.realm.presence_disabled:
+                # Tornado uses this to decide whether the user is idle;
+                # users who have never been active are.
+                last_active_time = 0
+                if status == UserPresence.ACTIVE:
+                    last_active_time = datetime_to_timestamp(log_time)
+                last_active_times[user_profile.id] = max(last_active_times.get(user_profile.id, 0),
+                                                         last_active_time)
+
+            if not user_profile.realm.is_zephyr_mirror_realm and (created or became_online):
+                changed_presences.append((user_profile, presence))
+
+        UserPresence.objects.bulk_create(new_presences)
+        bulk_update_fields(UserPresence, ["timestamp", "status"], updated_presences)
+        return last_active_times, changed_presences
+
+    last_active_times, changed_presences = retry_on_insert_conflict(write_presences)
+    set_last_active_times(last_active_times)
+
+    for (user_profile, presence) in changed_presences:
         # Push event to all users in the realm so they see the new user
         # appear in the presence list immediately, or the newly online
         # user without delay.  Note that we won't send an update here for a
@@ -2554,6 +2834,7 @@ def do_update_user_presence(user_profile, client, log_time, status):
         # that's not a high priority for now, considering that most of our non-MIT
         # realms are pretty small.
         send_presence_changed(user_profile, presence)
+    statsd.incr('user_presence', len(presence_updates))
 
 def update_user_activity_interval(user_profile, log_time):
     # type: (UserProfile, datetime.datetime) -> None
@@ -2726,10 +3007,12 @@ def update_to_dict_cache(changed_messages):
     message_ids = []
     for changed_message in changed_messages:
         message_ids.append(changed_message.id)
-        items_for_remote_cache[to_dict_cache_key(changed_message, True)] = \
-            (MessageDict.to_dict_uncached(changed_message, apply_markdown=True),)
-        items_for_remote_cache[to_dict_cache_key(changed_message, False)] = \
-            (MessageDict.to_dict_uncached(changed_message, apply_markdown=False),)
+        for apply_markdown in (True, False):
+            key = to_dict_cache_key(changed_message, apply_markdown)
+            # Like flush_message, drop this request's copy as well.
+            per_request_message_dict_cache.pop(key, None)
+            items_for_remote_cache[key] = \
+                (MessageDict.to_dict_uncached(changed_message, apply_markdown=apply_markdown),)
     cache_set_many(items_for_remote_cache)
     return message_ids
 
@@ -2877,6 +3160,9 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
                                 "edit_history"])
 
     event['message_ids'] = update_to_dict_cache(changed_messages)
+    if subject is not None:
+        # The unread summaries group messages by topic.
+        delete_unread_summaries(event['message_ids'])
 
     def user_info(um):
         # type: (UserMessage) -> Dict[str, Any]
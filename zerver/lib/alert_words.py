@@ -7,7 +7,8 @@ import ujson
 import six
 from typing import Dict, Iterable, List, Text
 
-@cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
+@cache_with_key(realm_alert_words_cache_key, timeout=3600*24,
+                lock_timeout=10, stale_timeout=60, early_recompute_beta=1.0)
 def alert_words_in_realm(realm):
     # type: (Realm) -> Dict[int, List[Text]]
     users_query = UserProfile.objects.filter(realm=realm, is_active=True)
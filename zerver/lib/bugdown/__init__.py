@@ -12,6 +12,7 @@ from six.moves import urllib
 import re
 import os.path
 import glob
+import hashlib
 import twitter
 import platform
 import time
@@ -35,13 +36,14 @@ from zerver.lib.bugdown.fenced_code import FENCE_RE
 from zerver.lib.camo import get_camo_url
 from zerver.lib.timeout import timeout, TimeoutExpired
 from zerver.lib.cache import (
-    cache_with_key, cache_get_many, cache_set_many, NotFoundInCache)
+    cache_with_key, cache_get, cache_set, bugdown_render_cache_key, NotFoundInCache)
 from zerver.lib.url_preview import preview as link_preview
 from zerver.models import Message, Realm, UserProfile
 import zerver.lib.alert_words as alert_words
 import zerver.lib.mention as mention
 from zerver.lib.str_utils import force_str, force_text
 from zerver.lib.tex import render_tex
+from zerver.lib.utils import make_safe_digest, statsd
 import six
 from six.moves import range, html_parser
 
@@ -395,6 +397,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                     is_album):
                 return None
 
+            mark_render_uncacheable()
             # Try to retrieve open graph protocol info for a preview
             # This might be redundant right now for shared links for images.
             # However, we might want to make use of title and description
@@ -563,6 +566,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
 
         if tweet_id is None:
             return None
+        mark_render_uncacheable()
 
         try:
             res = fetch_tweet_data(tweet_id)
@@ -689,6 +693,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
 
             if current_message is None or not url_embed_preview_enabled_for_realm(current_message):
                 continue
+            mark_render_uncacheable()
             try:
                 extracted_data = link_preview.link_embed_data_from_cache(url)
             except NotFoundInCache:
@@ -707,6 +712,7 @@ class Avatar(markdown.inlinepatterns.Pattern):
         profile_id = None
 
         if db_data is not None:
+            mark_render_uncacheable()
             user_dict = db_data['by_email'].get(email)
             if user_dict is not None:
                 profile_id = user_dict['id']
@@ -1121,6 +1127,7 @@ class UserMentionPattern(markdown.inlinepatterns.Pattern):
         name = m.group(2) or m.group(3)
 
         if current_message:
+            mark_render_uncacheable()
             wildcard, user = self.find_user_for_mention(name)
 
             if wildcard:
@@ -1157,6 +1164,7 @@ class StreamPattern(VerbosePattern):
         name = m.group('stream_name')
 
         if current_message:
+            mark_render_uncacheable()
             stream = self.find_stream_by_name(name)
             if stream is None:
                 return None
@@ -1173,6 +1181,34 @@ class StreamPattern(VerbosePattern):
             return el
         return None
 
+def find_alert_words(content, possible_words, matcher):
+    # type: (Text, Set[Text], Any) -> Set[Text]
+    """Returns the words in `possible_words` that appear in `content`;
+    `matcher` is the realm's AlertWordMatcher."""
+    if not possible_words:
+        return set()
+
+    content = content.lower()
+
+    # The realm's alert words are found in a single pass; see
+    # AlertWordMatcher in zerver/lib/bugdown/realm_data.py.
+    found = matcher.find(content) & possible_words
+
+    allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+    allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+
+    # Words the caller passed in that the realm's matcher
+    # doesn't know about yet are checked individually.
+    for word in possible_words - matcher.words:
+        escaped = re.escape(word.lower())
+        match_re = re.compile(u'(?:%s)%s(?:%s)' %
+                              (allowed_before_punctuation,
+                               escaped,
+                               allowed_after_punctuation))
+        if re.search(match_re, content):
+            found.add(word)
+    return found
+
 class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
     def run(self, lines):
         # type: (Iterable[Text]) -> Iterable[Text]
@@ -1183,22 +1219,10 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
             # Our caller passes in the list of possible_words.  We
             # don't do any special rendering; we just append the alert words
             # we find to the set current_message.alert_words.
-
-            realm_words = db_data['possible_words']
-
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
-
-            for word in realm_words:
-                escaped = re.escape(word.lower())
-                match_re = re.compile(u'(?:%s)%s(?:%s)' %
-                                      (allowed_before_punctuation,
-                                       escaped,
-                                       allowed_after_punctuation))
-                if re.search(match_re, content):
-                    current_message.alert_words.add(word)
+            content = '\n'.join(lines)
+            current_message.alert_words.update(find_alert_words(content,
+                                                                db_data['possible_words'],
+                                                                db_data['alert_word_matcher']))
 
         return lines
 
@@ -1463,6 +1487,15 @@ current_message = None  # type: Optional[Message]
 # threads themselves, as well.
 db_data = None  # type: Optional[Dict[Text, Any]]
 
+def mark_render_uncacheable():
+    # type: () -> None
+    """Called by the parts of bugdown whose output depends on more than
+    the content and the realm's configuration (users, streams, or
+    remote websites), so that the render isn't stored in the render
+    cache; see get_render_cache_key."""
+    if db_data is not None:
+        db_data['render_cacheable'] = False
+
 def log_bugdown_error(msg):
     # type: (str) -> None
     """We use this unusual logging approach to log the bugdown error, in
@@ -1471,10 +1504,86 @@ def log_bugdown_error(msg):
     could cause an infinite exception loop."""
     logging.getLogger('').error(msg)
 
+def report_bugdown_failure(content, details):
+    # type: (Text, str) -> None
+    from zerver.lib.actions import internal_send_message
+    from zerver.models import get_system_bot
+
+    cleaned = _sanitize_for_log(content)
+
+    # Output error to log as well as sending a zulip and email
+    log_bugdown_error('Exception in Markdown parser: %sInput (sanitized) was: %s'
+                      % (details, cleaned))
+    subject = "Markdown parser failure on %s" % (platform.node(),)
+    if settings.ERROR_BOT is not None:
+        error_bot_realm = get_system_bot(settings.ERROR_BOT).realm
+        internal_send_message(error_bot_realm, settings.ERROR_BOT, "stream",
+                              "errors", subject, "Markdown parser failed, email sent with details.")
+    mail.mail_admins(
+        subject, "Failed message: %s\n\n%s\n\n" % (cleaned, details),
+        fail_silently=False)
+
+# Spend at most this many seconds rendering a message.  Sometimes
+# Python-Markdown is really slow; see https://trac.zulip.net/ticket/345
+BUGDOWN_TIMEOUT = 5
+
+# Set in the worker processes of zerver/lib/bugdown/pool.py, where the
+# timeout is enforced by the parent process killing the worker, and
+# errors are reported by the parent process.
+running_in_bugdown_worker = False
+
+# Rendered messages are cached by a hash of their content plus a
+# fingerprint of everything else that affects how a message renders
+# in a realm: the bugdown version, the realm's filters, emoji and
+# preview settings, and whether the sender is a bot.  Renders that
+# also depend on the realm's users or streams (mentions, stream
+# links, avatars) or on remote websites (tweets and other link
+# previews) call mark_render_uncacheable and aren't cached.  This
+# mostly helps bots and integrations, which send the same content
+# over and over.
+RENDER_CACHE_TIMEOUT = 3600 * 24
+
+def get_render_cache_key(content, realm_filters_key, message_realm, data):
+    # type: (Text, int, Realm, Dict[Text, Any]) -> Text
+    fingerprint = ujson.dumps([version,
+                               realm_filters_key,
+                               realm_filter_data.get(realm_filters_key),
+                               data['emoji'],
+                               data['sent_by_bot'],
+                               message_realm.inline_image_preview,
+                               message_realm.inline_url_embed_preview,
+                               settings.INLINE_IMAGE_PREVIEW,
+                               settings.INLINE_URL_EMBED_PREVIEW,
+                               settings.CAMO_URI,
+                               settings.CAMO_KEY,
+                               settings.ENABLE_FILE_LINKS],
+                              sort_keys=True)
+    return bugdown_render_cache_key(make_safe_digest(content, hashlib.sha1),
+                                    make_safe_digest(fingerprint, hashlib.sha1))
+
+bugdown_render_cache_hits = 0
+bugdown_render_cache_misses = 0
+
+def add_render_cache_stats(hits, misses):
+    # type: (int, int) -> None
+    global bugdown_render_cache_hits
+    global bugdown_render_cache_misses
+    bugdown_render_cache_hits += hits
+    bugdown_render_cache_misses += misses
+
+def record_render_cache_lookup(hit):
+    # type: (bool) -> None
+    if hit:
+        add_render_cache_stats(1, 0)
+        statsd.incr("bugdown.render_cache.hit")
+    else:
+        add_render_cache_stats(0, 1)
+        statsd.incr("bugdown.render_cache.miss")
+
 def do_convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False):
     # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool]) -> Text
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
-    from zerver.models import get_active_user_dicts_in_realm, get_active_streams, UserProfile
+    from zerver.lib.bugdown.realm_data import get_realm_bugdown_data
 
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
@@ -1513,42 +1622,54 @@ def do_convert(content, message=None, message_realm=None, possible_words=None, s
     global db_data
     if message is not None:
         assert message_realm is not None  # ensured above if message is not None
-        realm_users = get_active_user_dicts_in_realm(message_realm)
-        realm_streams = get_active_streams(message_realm).values('id', 'name')
+        realm_data = get_realm_bugdown_data(message_realm)
 
         if possible_words is None:
             possible_words = set()  # Set[Text]
 
         db_data = {'possible_words': possible_words,
-                   'full_names': dict((user['full_name'].lower(), user) for user in realm_users),
-                   'short_names': dict((user['short_name'].lower(), user) for user in realm_users),
-                   'by_email': dict((user['email'].lower(), user) for user in realm_users),
+                   'alert_word_matcher': realm_data.alert_word_matcher,
+                   'full_names': realm_data.full_names,
+                   'by_email': realm_data.by_email,
                    'emoji': message_realm.get_emoji(),
                    'sent_by_bot': sent_by_bot,
-                   'stream_names': dict((stream['name'], stream) for stream in realm_streams)}
+                   'stream_names': realm_data.stream_names,
+                   'render_cacheable': True}
 
     try:
-        # Spend at most 5 seconds rendering.
-        # Sometimes Python-Markdown is really slow; see
-        # https://trac.zulip.net/ticket/345
-        return timeout(5, _md_engine.convert, content)
+        render_cache_key = None  # type: Optional[Text]
+        if message is not None:
+            assert message_realm is not None and db_data is not None
+            render_cache_key = get_render_cache_key(content, realm_filters_key,
+                                                    message_realm, db_data)
+            cached = cache_get(render_cache_key)
+            if cached is not None:
+                rendered_content = cached[0]
+                record_render_cache_lookup(hit=True)
+                # Alert words depend on who can see the message, so
+                # they are found again on every hit.  The only
+                # preprocessors that run before the alert-word pass
+                # normalize whitespace, which doesn't change what
+                # find_alert_words matches, so the raw content works.
+                found_words = find_alert_words(content, possible_words,
+                                               db_data['alert_word_matcher'])
+                if found_words:
+                    message.alert_words.update(found_words)
+                return rendered_content
+            record_render_cache_lookup(hit=False)
+
+        if running_in_bugdown_worker:
+            rendered_content = _md_engine.convert(content)
+        else:
+            rendered_content = timeout(BUGDOWN_TIMEOUT, _md_engine.convert, content)
+
+        if render_cache_key is not None and db_data['render_cacheable']:
+            cache_set(render_cache_key, rendered_content, timeout=RENDER_CACHE_TIMEOUT)
+        return rendered_content
     except Exception:
-        from zerver.lib.actions import internal_send_message
-        from zerver.models import get_system_bot
-
-        cleaned = _sanitize_for_log(content)
-
-        # Output error to log as well as sending a zulip and email
-        log_bugdown_error('Exception in Markdown parser: %sInput (sanitized) was: %s'
-                          % (traceback.format_exc(), cleaned))
-        subject = "Markdown parser failure on %s" % (platform.node(),)
-        if settings.ERROR_BOT is not None:
-            error_bot_realm = get_system_bot(settings.ERROR_BOT).realm
-            internal_send_message(error_bot_realm, settings.ERROR_BOT, "stream",
-                                  "errors", subject, "Markdown parser failed, email sent with details.")
-        mail.mail_admins(
-            subject, "Failed message: %s\n\n%s\n\n" % (cleaned, traceback.format_exc()),
-            fail_silently=False)
+        if running_in_bugdown_worker:
+            raise
+        report_bugdown_failure(content, traceback.format_exc())
         raise BugdownRenderingException()
     finally:
         current_message = None
@@ -1566,22 +1687,43 @@ def get_bugdown_requests():
     # type: () -> int
     return bugdown_total_requests
 
+def get_bugdown_render_cache_hits():
+    # type: () -> int
+    return bugdown_render_cache_hits
+
+def get_bugdown_render_cache_misses():
+    # type: () -> int
+    return bugdown_render_cache_misses
+
 def bugdown_stats_start():
     # type: () -> None
     global bugdown_time_start
     bugdown_time_start = time.time()
 
-def bugdown_stats_finish():
-    # type: () -> None
+def bugdown_stats_finish(num_requests=1):
+    # type: (int) -> None
     global bugdown_total_time
     global bugdown_total_requests
     global bugdown_time_start
-    bugdown_total_requests += 1
+    bugdown_total_requests += num_requests
     bugdown_total_time += (time.time() - bugdown_time_start)
 
 def convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False):
     # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool]) -> Text
+    return convert_many([dict(content=content, message=message, message_realm=message_realm,
+                              possible_words=possible_words, sent_by_bot=sent_by_bot)])[0]
+
+def convert_many(requests):
+    # type: (List[Dict[str, Any]]) -> List[Text]
+    """Renders several messages; each request is a dict of arguments
+    to do_convert.  If settings.BUGDOWN_RENDER_PROCESSES is set, the
+    messages are rendered in parallel by the worker processes of
+    zerver/lib/bugdown/pool.py."""
     bugdown_stats_start()
-    ret = do_convert(content, message, message_realm, possible_words, sent_by_bot)
-    bugdown_stats_finish()
+    if settings.BUGDOWN_RENDER_PROCESSES > 0 and not running_in_bugdown_worker:
+        from zerver.lib.bugdown.pool import render_in_pool
+        ret = render_in_pool(requests)
+    else:
+        ret = [do_convert(**request) for request in requests]
+    bugdown_stats_finish(num_requests=len(requests))
     return ret
@@ -83,7 +83,7 @@ import six
 from django.utils.html import escape
 from markdown.extensions.codehilite import CodeHilite, CodeHiliteExtension
 from zerver.lib.str_utils import force_bytes
-from zerver.lib.tex import render_tex
+from zerver.lib.tex import render_tex_many
 from typing import Any, Dict, Iterable, List, MutableSequence, Optional, Tuple, Union, Text
 
 # Global vars
@@ -333,8 +333,8 @@ class FencedBlockPreprocessor(markdown.preprocessors.Preprocessor):
         # type: (Text) -> Text
         paragraphs = text.split("\n\n")
         tex_paragraphs = []
-        for paragraph in paragraphs:
-            html = render_tex(paragraph, is_inline=False)
+        rendered = render_tex_many([(paragraph, False) for paragraph in paragraphs])
+        for paragraph, html in zip(paragraphs, rendered):
             if html is not None:
                 tex_paragraphs.append(html)
             else:
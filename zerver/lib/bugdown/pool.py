@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+
+# A pool of pre-forked worker processes for rendering markdown.
+#
+# By default, bugdown renders in the calling process, using
+# zerver.lib.timeout to give up on slow messages.  That timeout works
+# by raising an exception asynchronously in the rendering thread,
+# which can't interrupt a single long-running regular expression, and
+# the rendering holds the GIL the whole time.  With
+# settings.BUGDOWN_RENDER_PROCESSES set, each server process instead
+# forks that many bugdown workers (on first use), sends them render
+# requests, and kills any worker that takes longer than
+# BUGDOWN_TIMEOUT seconds.  Batches of messages, such as those sent by
+# do_send_messages, are rendered in parallel across the workers.
+#
+# Workers keep their markdown engines (with realm filters loaded) and
+# the realm data of zerver/lib/bugdown/realm_data.py between requests.
+# They must not use the database or cache connections of the process
+# they were forked from, so they open their own.
+
+from typing import Any, Callable, Dict, List, Optional, Text, Tuple
+
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import time
+import traceback
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from six.moves import range
+
+from zerver.lib import bugdown
+from zerver.models import Message
+
+# Connections inherited from the parent process.  We keep references
+# to them forever: closing them, or letting them be garbage-collected
+# (which closes them), would also close the parent's connections.
+inherited_connections = []  # type: List[Any]
+
+def detach_inherited_connections():
+    # type: () -> None
+    for alias in connections:
+        connection = connections[alias]
+        inherited_connections.append(connection.connection)
+        connection.connection = None
+    inherited_connections.append(getattr(caches._caches, 'caches', None))
+    caches._caches.caches = {}
+
+def render_request(request):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Renders a request made by make_render_request, in a worker."""
+    message = request['message']
+    if message is not None:
+        message.mentions_wildcard = False
+        message.mentions_user_ids = set()
+        message.alert_words = set()
+        message.links_for_preview = set()
+
+    hits = bugdown.get_bugdown_render_cache_hits()
+    misses = bugdown.get_bugdown_render_cache_misses()
+    rendered_content = bugdown.do_convert(request['content'],
+                                          message=message,
+                                          message_realm=request['message_realm'],
+                                          possible_words=request['possible_words'],
+                                          sent_by_bot=request['sent_by_bot'])
+    result = dict(rendered_content=rendered_content,
+                  render_cache_hits=bugdown.get_bugdown_render_cache_hits() - hits,
+                  render_cache_misses=bugdown.get_bugdown_render_cache_misses() - misses)  # type: Dict[str, Any]
+    if message is not None:
+        result.update(mentions_wildcard=message.mentions_wildcard,
+                      mentions_user_ids=message.mentions_user_ids,
+                      alert_words=message.alert_words,
+                      links_for_preview=message.links_for_preview)
+    return result
+
+def worker_loop(conn, render_function, parent_pid):
+    # type: (Any, Callable[[Dict[str, Any]], Dict[str, Any]], int) -> None
+    detach_inherited_connections()
+    bugdown.running_in_bugdown_worker = True
+    while True:
+        try:
+            # Sibling workers hold copies of our pipe, so we won't get
+            # EOF if the parent is killed; check on it periodically.
+            if not conn.poll(1):
+                if os.getppid() != parent_pid:
+                    return
+                continue
+            request = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = render_function(request)
+        except Exception:
+            result = dict(error=traceback.format_exc())
+        conn.send(result)
+
+class BugdownWorker(object):
+    def __init__(self, render_function):
+        # type: (Callable[[Dict[str, Any]], Dict[str, Any]]) -> None
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop,
+                                               args=(child_conn, render_function, os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def fileno(self):
+        # type: () -> int
+        return self.conn.fileno()
+
+    def kill(self):
+        # type: () -> None
+        try:
+            os.kill(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # The worker has already exited.
+            pass
+        self.process.join()
+        self.conn.close()
+
+class BugdownWorkerPool(object):
+    def __init__(self, num_workers, timeout, render_function=render_request):
+        # type: (int, float, Callable[[Dict[str, Any]], Dict[str, Any]]) -> None
+        self.pid = os.getpid()
+        self.timeout = timeout
+        self.render_function = render_function
+        self.workers = [BugdownWorker(render_function) for i in range(num_workers)]
+
+    def replace_worker(self, worker):
+        # type: (BugdownWorker) -> BugdownWorker
+        worker.kill()
+        new_worker = BugdownWorker(self.render_function)
+        self.workers[self.workers.index(worker)] = new_worker
+        return new_worker
+
+    def render(self, requests):
+        # type: (List[Dict[str, Any]]) -> List[Dict[str, Any]]
+        """Renders `requests` in parallel, returning a result for each
+        one.  Failed requests get a result with an `error` key."""
+        results = [None] * len(requests)  # type: List[Optional[Dict[str, Any]]]
+        pending = list(reversed(list(enumerate(requests))))
+        idle = list(self.workers)
+        busy = {}  # type: Dict[BugdownWorker, Tuple[int, float]]
+
+        while pending or busy:
+            while pending and idle:
+                worker = idle.pop()
+                index, request = pending.pop()
+                try:
+                    worker.conn.send(request)
+                except (IOError, OSError):
+                    # The worker died while idle; retry on a fresh one.
+                    idle.append(self.replace_worker(worker))
+                    pending.append((index, request))
+                    continue
+                busy[worker] = (index, time.time() + self.timeout)
+
+            next_deadline = min(deadline for (index, deadline) in busy.values())
+            ready, _, _ = select.select(list(busy.keys()), [], [],
+                                        max(0, next_deadline - time.time()))
+            for worker in ready:
+                index, deadline = busy.pop(worker)
+                try:
+                    results[index] = worker.conn.recv()
+                    idle.append(worker)
+                except (EOFError, IOError, OSError):
+                    results[index] = dict(error="Bugdown worker %d died" % (worker.process.pid,))
+                    idle.append(self.replace_worker(worker))
+
+            now = time.time()
+            for worker, (index, deadline) in list(busy.items()):
+                if deadline <= now:
+                    del busy[worker]
+                    logging.warning("Killing bugdown worker %d after %s seconds"
+                                    % (worker.process.pid, self.timeout))
+                    results[index] = dict(error="Timed out after %s seconds" % (self.timeout,))
+                    idle.append(self.replace_worker(worker))
+
+        return [result for result in results if result is not None]
+
+    def close(self):
+        # type: () -> None
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
+
+bugdown_pool = None  # type: Optional[BugdownWorkerPool]
+
+def get_bugdown_pool():
+    # type: () -> BugdownWorkerPool
+    global bugdown_pool
+    # A pool belongs to the process that forked its workers; after a
+    # fork (e.g. of a uwsgi worker), the new process needs its own.
+    if bugdown_pool is None or bugdown_pool.pid != os.getpid():
+        bugdown_pool = BugdownWorkerPool(settings.BUGDOWN_RENDER_PROCESSES,
+                                         bugdown.BUGDOWN_TIMEOUT)
+    return bugdown_pool
+
+def make_render_request(content, message=None, message_realm=None, possible_words=None,
+                        sent_by_bot=False):
+    # type: (Text, Optional[Message], Optional[Any], Optional[Any], Optional[bool]) -> Dict[str, Any]
+    # Workers get a copy of just the parts of the message that
+    # bugdown uses, rather than the whole object.
+    message_stub = None  # type: Optional[Message]
+    if message is not None:
+        if message_realm is None:
+            message_realm = message.get_realm()
+        message_stub = Message(sender=message.sender,
+                               sending_client=message.sending_client)
+    return dict(content=content,
+                message=message_stub,
+                message_realm=message_realm,
+                possible_words=possible_words,
+                sent_by_bot=sent_by_bot)
+
+def render_in_pool(requests):
+    # type: (List[Dict[str, Any]]) -> List[Text]
+    results = get_bugdown_pool().render([make_render_request(**request) for request in requests])
+
+    rendered = []  # type: List[Text]
+    for request, result in zip(requests, results):
+        if 'error' in result:
+            bugdown.report_bugdown_failure(request['content'], result['error'])
+            raise bugdown.BugdownRenderingException()
+        # Keep this process's render cache statistics (which the
+        # request logging reports) in step with the workers'.
+        bugdown.add_render_cache_stats(result['render_cache_hits'],
+                                       result['render_cache_misses'])
+        message = request.get('message')
+        if message is not None:
+            message.mentions_wildcard = result['mentions_wildcard']
+            message.mentions_user_ids = result['mentions_user_ids']
+            message.alert_words = result['alert_words']
+            message.links_for_preview = result['links_for_preview']
+        rendered.append(result['rendered_content'])
+    return rendered
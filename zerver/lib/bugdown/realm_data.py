@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+
+# Realm-wide lookup structures used by bugdown: the users and streams
+# that can be mentioned, and a trie of every alert word in the realm.
+# Building these from scratch for every rendered message is expensive
+# in large realms, so each process keeps a compiled copy per realm.
+#
+# A copy is valid as long as the realm's "bugdown realm data version"
+# in the remote cache is unchanged; flush_bugdown_realm_data deletes
+# that version whenever a user, stream or alert word in the realm
+# changes, so every process rebuilds on its next render.
+
+from typing import Any, Dict, Iterable, Set, Text
+
+import binascii
+import os
+from six.moves import range
+
+from zerver.lib.alert_words import alert_words_in_realm
+from zerver.lib.cache import bugdown_realm_data_version_cache_key, cache_get, cache_set
+from zerver.models import Realm, get_active_streams, get_active_user_dicts_in_realm
+
+# Alert words must be surrounded by whitespace, the start or end of
+# the content, or one of these punctuation characters.
+ALERT_WORD_ALLOWED_BEFORE = u'(".,\';[*`>'
+ALERT_WORD_ALLOWED_AFTER = u')"?:.,\';]!*`'
+
+class AlertWordMatcher(object):
+    """A trie of alert words, which finds all the words that appear in
+    a message in one pass over its content (rather than one regular
+    expression search per word)."""
+
+    # Key in a trie node marking the end of one or more words; its
+    # value is the set of the words, in their original case.
+    WORDS = u''
+
+    def __init__(self, words):
+        # type: (Iterable[Text]) -> None
+        self.words = set(words)  # type: Set[Text]
+        self.trie = {}  # type: Dict[Text, Any]
+        for word in self.words:
+            if not word:
+                continue
+            node = self.trie
+            for char in word.lower():
+                node = node.setdefault(char, {})
+            node.setdefault(self.WORDS, set()).add(word)
+
+    def find(self, content):
+        # type: (Text) -> Set[Text]
+        found = set()  # type: Set[Text]
+        if not self.trie:
+            return found
+        content = content.lower()
+        length = len(content)
+        for start in range(length):
+            if start > 0:
+                before = content[start - 1]
+                if not (before.isspace() or before in ALERT_WORD_ALLOWED_BEFORE):
+                    continue
+            node = self.trie
+            pos = start
+            while pos < length:
+                node = node.get(content[pos])
+                if node is None:
+                    break
+                pos += 1
+                if self.WORDS in node and self.ends_word(content, pos):
+                    found |= node[self.WORDS]
+        return found
+
+    @staticmethod
+    def ends_word(content, pos):
+        # type: (Text, int) -> bool
+        if pos == len(content) or (pos == len(content) - 1 and content[pos] == u'\n'):
+            return True
+        after = content[pos]
+        return after.isspace() or after in ALERT_WORD_ALLOWED_AFTER
+
+class RealmBugdownData(object):
+    def __init__(self, version, realm):
+        # type: (Text, Realm) -> None
+        self.version = version
+        realm_users = get_active_user_dicts_in_realm(realm)
+        self.full_names = dict((user['full_name'].lower(), user) for user in realm_users)
+        self.by_email = dict((user['email'].lower(), user) for user in realm_users)
+        realm_streams = get_active_streams(realm).values('id', 'name')
+        self.stream_names = dict((stream['name'], stream) for stream in realm_streams)
+        realm_words = set()  # type: Set[Text]
+        for words in alert_words_in_realm(realm).values():
+            realm_words.update(words)
+        self.alert_word_matcher = AlertWordMatcher(realm_words)
+
+realm_bugdown_data = {}  # type: Dict[int, RealmBugdownData]
+
+def get_bugdown_realm_data_version(realm_id):
+    # type: (int) -> Text
+    key = bugdown_realm_data_version_cache_key(realm_id)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    # The version must be stored before the data is read, so that a
+    # change made while we are building is not masked by our version.
+    version = binascii.hexlify(os.urandom(8)).decode('ascii')
+    cache_set(key, version)
+    return version
+
+def get_realm_bugdown_data(realm):
+    # type: (Realm) -> RealmBugdownData
+    version = get_bugdown_realm_data_version(realm.id)
+    data = realm_bugdown_data.get(realm.id)
+    if data is None or data.version != version:
+        data = RealmBugdownData(version, realm)
+        realm_bugdown_data[realm.id] = data
+    return data
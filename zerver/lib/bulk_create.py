@@ -4,6 +4,7 @@ from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Tex
 from zerver.lib.initial_password import initial_password
 from zerver.models import Realm, Stream, UserProfile, Huddle, \
     Subscription, Recipient, Client, RealmAuditLog, get_huddle_hash
+from zerver.lib.cache import flush_bugdown_realm_data
 from zerver.lib.create_user import create_user_profile
 
 def bulk_create_users(realm, users_raw, bot_type=None, tos_version=None, timezone=u""):
@@ -78,6 +79,8 @@ def bulk_create_streams(realm, stream_dict):
     # for python 3.3 and later versions.
     streams_to_create.sort(key=lambda x: x.name)
     Stream.objects.bulk_create(streams_to_create)
+    # bulk_create doesn't send post_save, which is what usually does this.
+    flush_bugdown_realm_data(realm.id)
 
     recipients_to_create = []  # type: List[Recipient]
     for stream in Stream.objects.filter(realm=realm).values('id', 'name'):
@@ -1,17 +1,23 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+from collections import OrderedDict
 from functools import wraps
 
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
-from typing import Any, Callable, Dict, Iterable, List, Optional, Union, TypeVar, Text
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union, TypeVar, Text
 
+from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from six import binary_type
+from six.moves import cPickle as pickle
+import math
 import subprocess
 import time
 import base64
@@ -110,6 +116,148 @@ def bounce_key_prefix_for_testing(test_name):
     # We are taking the hash of the KEY_PREFIX to decrease the size of the key.
     # Memcached keys should have a length of less than 256.
     KEY_PREFIX = hashlib.sha1(KEY_PREFIX.encode('utf-8')).hexdigest()
+    flush_local_cache()
+
+# An optional process-local tier in front of the remote cache, for the
+# small, hot objects (users, streams and display recipients) that are
+# looked up many times per request.  It is an LRU of up to
+# settings.LOCAL_CACHE_SIZE entries, each kept for at most
+# settings.LOCAL_CACHE_TIMEOUT seconds; a size of 0 disables it.
+# Entries are stored pickled, so that callers get their own copy of
+# the object, just as they would from memcached.
+#
+# To keep the processes' copies coherent, every change to one of these
+# keys in the remote cache (e.g. by the flush_* signal handlers below)
+# appends the key to an invalidation log in redis.  Before its first
+# local lookup in each request, and at least once a second, a process
+# reads the part of the log it hasn't seen yet and drops those keys.
+# Fills after a cache miss aren't changes, and aren't logged.
+LOCAL_CACHE_KEY_FAMILIES = frozenset([
+    'bot_profile',
+    'display_recipient_dict',
+    'realm_register_section',
+    'stream_by_realm_and_name',
+    'user_profile',
+    'user_profile_by_email',
+    'user_profile_by_id',
+])
+LOCAL_CACHE_INVALIDATION_LOG_LENGTH = 10000
+LOCAL_CACHE_POLL_INTERVAL = 1.0
+
+local_cache = OrderedDict()  # type: OrderedDict[Text, Tuple[float, binary_type]]
+# The number of invalidations in the log that this process has applied.
+local_cache_invalidations_seen = None  # type: Optional[int]
+local_cache_polled_at = None  # type: Optional[float]
+
+redis_client = get_redis_client()
+
+# Appends the keys ARGV[2:] to the log, numbering them after the
+# current count in KEYS[1], and trims the log to ARGV[1] entries.
+LOCAL_CACHE_INVALIDATE_SCRIPT = """
+local max_length = tonumber(ARGV[1])
+local num_keys = #ARGV - 1
+local count = redis.call('INCRBY', KEYS[1], num_keys)
+for i = 2, #ARGV do
+    local seq = count - num_keys + i - 1
+    redis.call('ZADD', KEYS[2], seq, seq .. ':' .. ARGV[i])
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -max_length - 1)
+return count
+"""
+local_cache_invalidate_script = redis_client.register_script(LOCAL_CACHE_INVALIDATE_SCRIPT)
+
+def local_cache_family(key):
+    # type: (Text) -> Optional[Text]
+    """Returns the key family (the part of the key before the first
+    colon) if the key should be cached locally, and None otherwise."""
+    if settings.LOCAL_CACHE_SIZE == 0:
+        return None
+    family = key.split(u':', 1)[0]
+    if family not in LOCAL_CACHE_KEY_FAMILIES:
+        return None
+    return family
+
+def local_cache_invalidation_keys():
+    # type: () -> List[Text]
+    return [KEY_PREFIX + u'local_cache_invalidations:count',
+            KEY_PREFIX + u'local_cache_invalidations:log']
+
+def flush_local_cache():
+    # type: () -> None
+    global local_cache_invalidations_seen
+    global local_cache_polled_at
+    local_cache.clear()
+    local_cache_invalidations_seen = None
+    local_cache_polled_at = None
+
+def start_local_cache_request():
+    # type: () -> None
+    """Makes the next local cache lookup check for invalidations."""
+    global local_cache_polled_at
+    local_cache_polled_at = None
+
+def apply_local_cache_invalidations():
+    # type: () -> None
+    global local_cache_invalidations_seen
+    global local_cache_polled_at
+    count_key, log_key = local_cache_invalidation_keys()
+    if local_cache_invalidations_seen is None:
+        count = redis_client.get(count_key)
+        entries = []  # type: List[binary_type]
+    else:
+        pipeline = redis_client.pipeline()
+        pipeline.get(count_key)
+        pipeline.zrangebyscore(log_key, '(%d' % (local_cache_invalidations_seen,), '+inf')
+        count, entries = pipeline.execute()
+    count = int(count or 0)
+
+    if local_cache_invalidations_seen is None:
+        # We can't tell what changed before we started following the log.
+        local_cache.clear()
+    elif count != local_cache_invalidations_seen:
+        if count < local_cache_invalidations_seen or \
+                count - local_cache_invalidations_seen > len(entries):
+            # Redis was flushed, or we've fallen so far behind that
+            # the log was trimmed before we read it.
+            local_cache.clear()
+        else:
+            for entry in entries:
+                local_cache.pop(entry.decode('utf-8').split(u':', 1)[1], None)
+    local_cache_invalidations_seen = count
+    local_cache_polled_at = time.time()
+
+def local_cache_get(key, family):
+    # type: (Text, Text) -> Any
+    if local_cache_polled_at is None or \
+            time.time() - local_cache_polled_at > LOCAL_CACHE_POLL_INTERVAL:
+        apply_local_cache_invalidations()
+    entry = local_cache.pop(key, None)
+    if entry is not None and entry[0] > time.time():
+        # Reinserting the entry moves it to the most recently used end.
+        local_cache[key] = entry
+        statsd.incr("cache.local.%s.hit" % (family,))
+        return pickle.loads(entry[1])
+    statsd.incr("cache.local.%s.miss" % (family,))
+    return None
+
+def local_cache_set(key, val):
+    # type: (Text, Any) -> None
+    local_cache.pop(key, None)
+    local_cache[key] = (time.time() + settings.LOCAL_CACHE_TIMEOUT,
+                        pickle.dumps(val, pickle.HIGHEST_PROTOCOL))
+    while len(local_cache) > settings.LOCAL_CACHE_SIZE:
+        local_cache.popitem(last=False)
+
+def invalidate_local_caches(keys):
+    # type: (Iterable[Text]) -> None
+    """Drops any local copies of these keys, in every process."""
+    keys = [key for key in keys if local_cache_family(key) is not None]
+    if len(keys) == 0:
+        return
+    for key in keys:
+        local_cache.pop(key, None)
+    local_cache_invalidate_script(keys=local_cache_invalidation_keys(),
+                                  args=[LOCAL_CACHE_INVALIDATION_LOG_LENGTH] + keys)
 
 def get_cache_backend(cache_name):
     # type: (Optional[str]) -> BaseCache
@@ -139,8 +287,76 @@ def get_cache_with_key(keyfunc, cache_name=None):
 
     return decorator
 
-def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None):
-    # type: (Any, Optional[str], Optional[int], Optional[str]) -> Any
+# Stampede protection.  When a popular key expires or is deleted (or
+# KEY_PREFIX changes on deploy), every process that needs it misses at
+# once and runs the same query.  With a lock_timeout, the first process
+# to miss takes a lock on the key in the remote cache (via `add`) for up
+# to lock_timeout seconds while it computes the value; the others wait
+# for the value to appear, rather than computing it too.  If the lock
+# holder fails or takes too long, they go ahead and compute it.
+#
+# cache_with_key can also keep serving a value for stale_timeout
+# seconds past its timeout, while a single process refreshes it, and
+# with early_recompute_beta > 0 refresh values probabilistically before
+# they expire, more eagerly the longer they took to compute (the
+# "XFetch" algorithm; 1.0 is a good default).  Values cached that way
+# are stored as (value, soft expiry time, compute time) rather than as
+# the usual singleton tuples; as with those, [0] is the value.
+CACHE_LOCK_POLL_INTERVAL = 0.05
+
+def cache_lock_key(key):
+    # type: (Text) -> Text
+    return u'lock:' + key
+
+def acquire_cache_lock(key, lock_timeout, cache_name=None):
+    # type: (Text, int, Optional[str]) -> bool
+    remote_cache_stats_start()
+    acquired = get_cache_backend(cache_name).add(KEY_PREFIX + cache_lock_key(key), True,
+                                                 timeout=lock_timeout)
+    remote_cache_stats_finish()
+    return acquired
+
+def release_cache_lock(key, cache_name=None):
+    # type: (Text, Optional[str]) -> None
+    remote_cache_stats_start()
+    get_cache_backend(cache_name).delete(KEY_PREFIX + cache_lock_key(key))
+    remote_cache_stats_finish()
+
+def wait_for_cache_fill(keys, lock_timeout, cache_name=None):
+    # type: (List[Text], int, Optional[str]) -> Dict[Text, Any]
+    """Waits up to lock_timeout seconds for the processes holding the
+    locks on `keys` to fill them, and returns the values that appeared.
+    Stops waiting for a key if its lock is released without a value."""
+    cache_backend = get_cache_backend(cache_name)
+    deadline = time.time() + lock_timeout
+    found = {}  # type: Dict[Text, Any]
+    while len(keys) > 0 and time.time() < deadline:
+        time.sleep(CACHE_LOCK_POLL_INTERVAL)
+        remote_cache_stats_start()
+        ret = cache_backend.get_many([KEY_PREFIX + key for key in keys] +
+                                     [KEY_PREFIX + cache_lock_key(key) for key in keys])
+        remote_cache_stats_finish()
+        for key in keys:
+            if KEY_PREFIX + key in ret:
+                found[key] = ret[KEY_PREFIX + key]
+        keys = [key for key in keys
+                if key not in found and KEY_PREFIX + cache_lock_key(key) in ret]
+    return found
+
+def needs_refresh(val, early_recompute_beta):
+    # type: (Tuple[Any, ...], float) -> bool
+    if len(val) < 3:
+        return False
+    (_, soft_expiry, compute_time) = val
+    now = time.time()
+    if early_recompute_beta > 0:
+        # 1 - random.random() is in (0, 1], so this only moves `now` forward.
+        now -= compute_time * early_recompute_beta * math.log(1 - random.random())
+    return now >= soft_expiry
+
+def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None,
+                   lock_timeout=None, stale_timeout=0, early_recompute_beta=0.0):
+    # type: (Any, Optional[str], Optional[int], Optional[str], Optional[int], int, float) -> Any
     # This function can't be typed perfectly because returning a generic function
     # isn't supported in mypy - https://github.com/python/mypy/issues/1551.
     """Decorator which applies Django caching to a function.
@@ -148,7 +364,13 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
        Decorator argument is a function which computes a cache key
        from the original function's arguments.  You are responsible
        for avoiding collisions with other uses of this decorator or
-       other uses of caching."""
+       other uses of caching.
+
+       See the comment above for lock_timeout, stale_timeout and
+       early_recompute_beta."""
+    soft_expiry = stale_timeout > 0 or early_recompute_beta > 0
+    if soft_expiry:
+        assert timeout is not None
 
     def decorator(func):
         # type: (Callable[..., Any]) -> (Callable[..., Any])
@@ -168,69 +390,146 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
             else:
                 metric_key = statsd_key(key)
 
-            status = "hit" if val is not None else "miss"
-            statsd.incr("cache%s.%s.%s" % (extra, metric_key, status))
+            def compute(locked):
+                # type: (bool) -> Any
+                start = time.time()
+                try:
+                    val = func(*args, **kwargs)
+                    if soft_expiry:
+                        now = time.time()
+                        cache_set_entry(key, (val, now + timeout, now - start),
+                                        cache_name=cache_name, timeout=timeout + stale_timeout,
+                                        fill=True)
+                    else:
+                        cache_set(key, val, cache_name=cache_name, timeout=timeout, fill=True)
+                finally:
+                    if locked:
+                        release_cache_lock(key, cache_name=cache_name)
+                return val
 
             # Values are singleton tuples so that we can distinguish
             # a result of None from a missing key.
             if val is not None:
-                return val[0]
-
-            val = func(*args, **kwargs)
-
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
-
-            return val
+                if not needs_refresh(val, early_recompute_beta):
+                    statsd.incr("cache%s.%s.hit" % (extra, metric_key))
+                    return val[0]
+                if lock_timeout is not None and \
+                        not acquire_cache_lock(key, lock_timeout, cache_name=cache_name):
+                    # Another process is already refreshing it.
+                    statsd.incr("cache%s.%s.stale" % (extra, metric_key))
+                    return val[0]
+                statsd.incr("cache%s.%s.refresh" % (extra, metric_key))
+                return compute(locked=lock_timeout is not None)
+
+            statsd.incr("cache%s.%s.miss" % (extra, metric_key))
+            if lock_timeout is None:
+                return compute(locked=False)
+            if acquire_cache_lock(key, lock_timeout, cache_name=cache_name):
+                return compute(locked=True)
+            filled = wait_for_cache_fill([key], lock_timeout, cache_name=cache_name)
+            if key in filled:
+                return filled[key][0]
+            return compute(locked=False)
 
         return func_with_caching
 
     return decorator
 
-def cache_set(key, val, cache_name=None, timeout=None):
-    # type: (Text, Any, Optional[str], Optional[int]) -> None
+def cache_set(key, val, cache_name=None, timeout=None, fill=False):
+    # type: (Text, Any, Optional[str], Optional[int], bool) -> None
+    """fill should be True if val was just computed after a cache miss,
+    rather than being a change to the cached value."""
+    cache_set_entry(key, (val,), cache_name=cache_name, timeout=timeout, fill=fill)
+
+def cache_set_entry(key, entry, cache_name=None, timeout=None, fill=False):
+    # type: (Text, Tuple[Any, ...], Optional[str], Optional[int], bool) -> None
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
-    cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
+    cache_backend.set(KEY_PREFIX + key, entry, timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        if fill:
+            if local_cache_family(key) is not None:
+                local_cache_set(key, entry)
+        else:
+            invalidate_local_caches([key])
 
 def cache_get(key, cache_name=None):
     # type: (Text, Optional[str]) -> Any
+    family = local_cache_family(key) if cache_name is None else None
+    if family is not None:
+        ret = local_cache_get(key, family)
+        if ret is not None:
+            return ret
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    if family is not None and ret is not None:
+        local_cache_set(key, ret)
     return ret
 
 def cache_get_many(keys, cache_name=None):
     # type: (List[Text], Optional[str]) -> Dict[Text, Any]
+    local_items = {}  # type: Dict[Text, Any]
+    if cache_name is None:
+        remote_keys = []  # type: List[Text]
+        for key in keys:
+            family = local_cache_family(key)
+            val = local_cache_get(key, family) if family is not None else None
+            if val is not None:
+                local_items[key] = val
+            else:
+                remote_keys.append(key)
+        keys = remote_keys
+        if len(keys) == 0:
+            return local_items
     keys = [KEY_PREFIX + key for key in keys]
     remote_cache_stats_start()
     ret = get_cache_backend(cache_name).get_many(keys)
     remote_cache_stats_finish()
-    return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
-
-def cache_set_many(items, cache_name=None, timeout=None):
-    # type: (Dict[Text, Any], Optional[str], Optional[int]) -> None
+    items = dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
+    if cache_name is None:
+        for key, value in items.items():
+            if local_cache_family(key) is not None:
+                local_cache_set(key, value)
+        items.update(local_items)
+    return items
+
+def cache_set_many(items, cache_name=None, timeout=None, fill=False):
+    # type: (Dict[Text, Any], Optional[str], Optional[int], bool) -> None
+    """See cache_set for fill."""
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        if fill:
+            for key, value in items.items():
+                if local_cache_family(key) is not None:
+                    local_cache_set(key, value)
+        else:
+            invalidate_local_caches(items.keys())
 
 def cache_delete(key, cache_name=None):
     # type: (Text, Optional[str]) -> None
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    if cache_name is None:
+        invalidate_local_caches([key])
 
 def cache_delete_many(items, cache_name=None):
     # type: (Iterable[Text], Optional[str]) -> None
+    items = list(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
+    if cache_name is None:
+        invalidate_local_caches(items)
 
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
@@ -255,9 +554,13 @@ def generic_bulk_cached_fetch(cache_key_function,  # type: Callable[[ObjKT], Tex
                               extractor=lambda obj: obj,  # type: Callable[[CompressedItemT], ItemT]
                               setter=lambda obj: obj,  # type: Callable[[ItemT], CompressedItemT]
                               id_fetcher=lambda obj: obj.id,  # type: Callable[[Any], ObjKT]
-                              cache_transformer=lambda obj: obj  # type: Callable[[Any], ItemT]
+                              cache_transformer=lambda obj: obj,  # type: Callable[[Any], ItemT]
+                              lock_timeout=None  # type: Optional[int]
                               ):
     # type: (...) -> Dict[ObjKT, Any]
+    """With a lock_timeout, takes a lock on each missing key before
+    querying for it; keys whose locks are held by other processes are
+    waited for instead (see the stampede protection comment above)."""
     cache_keys = {}  # type: Dict[ObjKT, Text]
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
@@ -267,16 +570,37 @@ def generic_bulk_cached_fetch(cache_key_function,  # type: Callable[[ObjKT], Tex
         cached_objects[key] = extractor(cached_objects[key][0])
     needed_ids = [object_id for object_id in object_ids if
                   cache_keys[object_id] not in cached_objects]
-    db_objects = query_function(needed_ids)
-
-    items_for_remote_cache = {}  # type: Dict[Text, Any]
-    for obj in db_objects:
-        key = cache_keys[id_fetcher(obj)]
-        item = cache_transformer(obj)
-        items_for_remote_cache[key] = (setter(item),)
-        cached_objects[key] = item
-    if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+
+    def fetch(ids):
+        # type: (List[ObjKT]) -> None
+        if len(ids) == 0:
+            return
+        items_for_remote_cache = {}  # type: Dict[Text, Any]
+        for obj in query_function(ids):
+            key = cache_keys[id_fetcher(obj)]
+            item = cache_transformer(obj)
+            items_for_remote_cache[key] = (setter(item),)
+            cached_objects[key] = item
+        if len(items_for_remote_cache) > 0:
+            cache_set_many(items_for_remote_cache, fill=True)
+
+    if lock_timeout is None:
+        fetch(needed_ids)
+    else:
+        locked_ids = [object_id for object_id in needed_ids
+                      if acquire_cache_lock(cache_keys[object_id], lock_timeout)]
+        try:
+            fetch(locked_ids)
+        finally:
+            for object_id in locked_ids:
+                release_cache_lock(cache_keys[object_id])
+        waiting_keys = [cache_keys[object_id] for object_id in needed_ids
+                        if object_id not in locked_ids]
+        for (key, val) in wait_for_cache_fill(waiting_keys, lock_timeout).items():
+            cached_objects[key] = extractor(val[0])
+        # Anything the lock holders didn't fill in time, we fetch ourselves.
+        fetch([object_id for object_id in needed_ids
+               if cache_keys[object_id] not in cached_objects])
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
@@ -345,6 +669,53 @@ def bot_dicts_in_realm_cache_key(realm):
     # type: (Realm) -> Text
     return u"bot_dicts_in_realm:%s" % (realm.id,)
 
+# The active subscribers of each stream, with the few user fields
+# needed to deliver a message, keyed by the stream's recipient ID.
+# These are deleted when users subscribe, unsubscribe, or change one
+# of these fields, rather than updated in place, since memcached can't
+# update them atomically.
+stream_subscriber_dict_fields = [
+    'id', 'email', 'enable_online_push_notifications',
+    'is_active', 'is_bot', 'bot_type', 'long_term_idle']  # type: List[str]
+
+def stream_subscribers_cache_key(recipient_id):
+    # type: (int) -> Text
+    return u"stream_subscribers:%d" % (recipient_id,)
+
+def delete_stream_subscriber_caches(recipient_ids):
+    # type: (Iterable[int]) -> None
+    """Deletes the cached subscriber lists for `recipient_ids`, both
+    now and once the current transaction (if any) commits, so that a
+    process that fetched the old subscribers from the database before
+    the commit can't leave them cached."""
+    keys = [stream_subscribers_cache_key(recipient_id) for recipient_id in recipient_ids]
+    if len(keys) == 0:
+        return
+    cache_delete_many(keys)
+    transaction.on_commit(lambda: cache_delete_many(keys))
+
+def bugdown_realm_data_version_cache_key(realm_id):
+    # type: (int) -> Text
+    return u"bugdown_realm_data_version:%s" % (realm_id,)
+
+def bugdown_render_cache_key(content_hash, fingerprint):
+    # type: (Text, Text) -> Text
+    return u"bugdown_render:%s:%s" % (content_hash, fingerprint)
+
+def unread_summary_cache_key(user_profile_id):
+    # type: (int) -> Text
+    return u"unread_summary:%d" % (user_profile_id,)
+
+def tex_cache_key(tex, is_inline):
+    # type: (Text, bool) -> Text
+    return u"tex:%s:%d" % (make_safe_digest(tex), is_inline)
+
+def flush_bugdown_realm_data(realm_id):
+    # type: (int) -> None
+    """Makes every process rebuild its realm data for bugdown; see
+    zerver/lib/bugdown/realm_data.py."""
+    cache_delete(bugdown_realm_data_version_cache_key(realm_id))
+
 def get_stream_cache_key(stream_name, realm):
     # type: (Text, Union[Realm, int]) -> Text
     from zerver.models import Realm
@@ -365,11 +736,16 @@ def delete_user_profile_caches(user_profiles):
 
     cache_delete_many(keys)
 
-def delete_display_recipient_cache(user_profile):
-    # type: (UserProfile) -> None
+def get_subscribed_recipient_ids(user_profile):
+    # type: (UserProfile) -> List[int]
     from zerver.models import Subscription  # We need to import here to avoid cyclic dependency.
     recipient_ids = Subscription.objects.filter(user_profile=user_profile)
-    recipient_ids = recipient_ids.values_list('recipient_id', flat=True)
+    return list(recipient_ids.values_list('recipient_id', flat=True))
+
+def delete_display_recipient_cache(user_profile, recipient_ids=None):
+    # type: (UserProfile, Optional[List[int]]) -> None
+    if recipient_ids is None:
+        recipient_ids = get_subscribed_recipient_ids(user_profile)
     keys = [display_recipient_cache_key(rid) for rid in recipient_ids]
     cache_delete_many(keys)
 
@@ -378,6 +754,13 @@ def delete_display_recipient_cache(user_profile):
 def flush_user_profile(sender, **kwargs):
     # type: (Any, **Any) -> None
     user_profile = kwargs['instance']
+    # For saves that don't say which fields they changed, the cached
+    # copy of the user (if there is one) tells us.
+    old_user_profile = None
+    if kwargs.get('update_fields') is None and not kwargs.get('created'):
+        cached = cache_get(user_profile_by_id_cache_key(user_profile.id))
+        if cached is not None:
+            old_user_profile = cached[0]
     delete_user_profile_caches([user_profile])
 
     # Invalidate our active_users_in_realm info dict if any user has changed
@@ -386,10 +769,33 @@ def flush_user_profile(sender, **kwargs):
             len(set(active_user_dict_fields + ['is_active', 'email']) &
                 set(kwargs['update_fields'])) > 0:
         cache_delete(active_user_dicts_in_realm_cache_key(user_profile.realm))
-
-    if kwargs.get('updated_fields') is None or \
-            'email' in kwargs['update_fields']:
-        delete_display_recipient_cache(user_profile)
+        flush_realm_register_section(user_profile.realm_id, 'realm_users')
+        flush_bugdown_realm_data(user_profile.realm_id)
+
+    # A newly created user has no subscriptions yet.
+    if not kwargs.get('created'):
+        recipient_ids = None  # type: Optional[List[int]]
+        if kwargs.get('updated_fields') is None or \
+                'email' in kwargs['update_fields']:
+            recipient_ids = get_subscribed_recipient_ids(user_profile)
+            delete_display_recipient_cache(user_profile, recipient_ids)
+
+        # Drop the subscriber lists of the user's streams if any of the
+        # fields stored there may have changed; this covers deactivation
+        # and reactivation.
+        if kwargs.get('update_fields') is not None:
+            subscriber_fields_changed = bool(set(stream_subscriber_dict_fields) &
+                                             set(kwargs['update_fields']))
+        elif old_user_profile is not None:
+            subscriber_fields_changed = any(
+                getattr(old_user_profile, field) != getattr(user_profile, field)
+                for field in stream_subscriber_dict_fields)
+        else:
+            subscriber_fields_changed = True
+        if subscriber_fields_changed:
+            if recipient_ids is None:
+                recipient_ids = get_subscribed_recipient_ids(user_profile)
+            delete_stream_subscriber_caches(recipient_ids)
 
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
@@ -401,6 +807,7 @@ def flush_user_profile(sender, **kwargs):
     # alert words
     if kwargs.get('update_fields') is None or "alert_words" in kwargs['update_fields']:
         cache_delete(realm_alert_words_cache_key(user_profile.realm))
+        flush_bugdown_realm_data(user_profile.realm_id)
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -413,8 +820,23 @@ def flush_realm(sender, **kwargs):
 
     if realm.deactivated:
         cache_delete(active_user_dicts_in_realm_cache_key(realm))
+        flush_realm_register_section(realm.id, 'realm_users')
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
+        flush_bugdown_realm_data(realm.id)
+
+# Realm-wide sections of the /register response, which are the same
+# for every user in the realm; see zerver/lib/events.py.  Bump the
+# version whenever the format of one of them changes.
+REALM_REGISTER_SECTIONS_VERSION = 1
+
+def realm_register_section_cache_key(realm_id, section):
+    # type: (int, str) -> Text
+    return u'realm_register_section:%s:%s:%s' % (realm_id, section, REALM_REGISTER_SECTIONS_VERSION)
+
+def flush_realm_register_section(realm_id, section):
+    # type: (int, str) -> None
+    cache_delete(realm_register_section_cache_key(realm_id, section))
 
 def realm_alert_words_cache_key(realm):
     # type: (Realm) -> Text
@@ -429,6 +851,9 @@ def flush_stream(sender, **kwargs):
     items_for_remote_cache = {}
     items_for_remote_cache[get_stream_cache_key(stream.name, stream.realm)] = (stream,)
     cache_set_many(items_for_remote_cache)
+    flush_bugdown_realm_data(stream.realm_id)
+    # The stream may be one of the realm's default streams.
+    flush_realm_register_section(stream.realm_id, 'realm_default_streams')
 
     if kwargs.get('update_fields') is None or 'name' in kwargs['update_fields'] and \
        UserProfile.objects.filter(
@@ -436,6 +861,12 @@ def flush_stream(sender, **kwargs):
            Q(default_events_register_stream=stream)).exists():
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
+def fill_remote_cache_checkpoint_key(cache):
+    # type: (str) -> Text
+    # Stored in Redis, not memcached, but under KEY_PREFIX since it
+    # records progress filling this deployment's keys.
+    return u'%sfill_remote_cache:%s' % (KEY_PREFIX, cache)
+
 # TODO: Rename to_dict_cache_key_id and to_dict_cache_key
 def to_dict_cache_key_id(message_id, apply_markdown):
     # type: (int, bool) -> Text
@@ -445,8 +876,21 @@ def to_dict_cache_key(message, apply_markdown):
     # type: (Message, bool) -> Text
     return to_dict_cache_key_id(message.id, apply_markdown)
 
+# Message dicts decoded from (or just written to) the to_dict cache
+# during the current request, by to_dict cache key, so that code that
+# needs the same message several times only fetches and decodes it
+# once.  Cleared by flush_per_request_caches and, for a single message,
+# by flush_message.
+per_request_message_dict_cache = {}  # type: Dict[Text, Dict[str, Any]]
+
+def flush_per_request_message_dict_cache():
+    # type: () -> None
+    per_request_message_dict_cache.clear()
+
 def flush_message(sender, **kwargs):
     # type: (Any, **Any) -> None
     message = kwargs['instance']
-    cache_delete(to_dict_cache_key(message, False))
-    cache_delete(to_dict_cache_key(message, True))
+    for apply_markdown in (False, True):
+        key = to_dict_cache_key(message, apply_markdown)
+        per_request_message_dict_cache.pop(key, None)
+        cache_delete(key)
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 from six import binary_type
-from typing import Any, Callable, Dict, List, Tuple, Text
+from typing import Any, Callable, Dict, List, Optional, Tuple, Text
 
 # This file needs to be different from cache.py because cache.py
 # cannot import anything from zerver.models or we'd have an import
@@ -9,30 +9,55 @@ from typing import Any, Callable, Dict, List, Tuple, Text
 from django.conf import settings
 from zerver.models import Message, UserProfile, Stream, get_stream_cache_key, \
     Recipient, get_recipient_cache_key, Client, get_client_cache_key, \
-    Huddle, huddle_hash_cache_key
+    Huddle, huddle_hash_cache_key, UserActivityInterval, flush_per_request_caches
 from zerver.lib.cache import cache_with_key, cache_set, \
     user_profile_by_email_cache_key, user_profile_by_id_cache_key, \
     user_profile_cache_key, get_remote_cache_time, get_remote_cache_requests, \
-    cache_set_many, to_dict_cache_key_id
+    cache_set_many, to_dict_cache_key_id, fill_remote_cache_checkpoint_key, \
+    redis_client
+from zerver.lib.message import MessageDict, stringify_message_dict
+from zerver.lib.parallel import run_parallel
 from importlib import import_module
 from django.contrib.sessions.models import Session
+from django.db import connections
+from django.db.models import Max, Min, Q
+from django.db.models.query import QuerySet
+from django.utils.timezone import now as timezone_now
+import datetime
 import logging
-from django.db.models import Q
+import six
+import ujson
 
 MESSAGE_CACHE_SIZE = 75000
 
+# Users active this recently are put in the cache before everyone else.
+RECENTLY_ACTIVE_USER_WINDOW = datetime.timedelta(days=1)
+
 def message_fetch_objects():
-    # type: () -> List[Any]
+    # type: () -> QuerySet
     try:
         max_id = Message.objects.only('id').order_by("-id")[0].id
     except IndexError:
-        return []
-    return Message.objects.select_related().filter(~Q(sender__email='tabbott/extra@mit.edu'),
-                                                   id__gt=max_id - MESSAGE_CACHE_SIZE)
+        return Message.objects.none()
+    return Message.objects.only('id').filter(~Q(sender__email='tabbott/extra@mit.edu'),
+                                             id__gt=max_id - MESSAGE_CACHE_SIZE)
+
+def message_fetch_rows(messages):
+    # type: (List[Message]) -> List[Dict[str, Any]]
+    # Fetches everything the message dicts need for the whole batch in
+    # a couple of queries, like get_messages_backend does.
+    return Message.get_raw_db_rows([message.id for message in messages])
 
-def message_cache_items(items_for_remote_cache, message):
-    # type: (Dict[Text, Tuple[binary_type]], Message) -> None
-    items_for_remote_cache[to_dict_cache_key_id(message.id, True)] = (message.to_dict_uncached(True),)
+def message_cache_items(items_for_remote_cache, row):
+    # type: (Dict[Text, Tuple[binary_type]], Dict[str, Any]) -> None
+    message_dict = MessageDict.build_dict_from_raw_db_row(row, True)
+    items_for_remote_cache[to_dict_cache_key_id(row['id'], True)] = (stringify_message_dict(message_dict),)
+
+def recently_active_user_objects():
+    # type: () -> QuerySet
+    cutoff = timezone_now() - RECENTLY_ACTIVE_USER_WINDOW
+    active_user_ids = UserActivityInterval.objects.filter(end__gte=cutoff).values('user_profile_id')
+    return UserProfile.objects.select_related().filter(id__in=active_user_ids)
 
 def user_cache_items(items_for_remote_cache, user_profile):
     # type: (Dict[Text, Tuple[UserProfile]], UserProfile) -> None
@@ -73,28 +98,146 @@ cache_fillers = {
     'client': (lambda: Client.objects.select_related().all(), client_cache_items, 3600*24*7, 10000),
     'recipient': (lambda: Recipient.objects.select_related().all(), recipient_cache_items, 3600*24*7, 10000),
     'stream': (lambda: Stream.objects.select_related().all(), stream_cache_items, 3600*24*7, 10000),
-    # Message cache fetching disabled until we can fix the fact that it
-    # does a bunch of inefficient memcached queries as part of filling
-    # the display_recipient cache
-    #    'message': (message_fetch_objects, message_cache_items, 3600 * 24, 1000),
+    'message': (message_fetch_objects, message_cache_items, 3600*24, 1000),
     'huddle': (lambda: Huddle.objects.select_related().all(), huddle_cache_items, 3600*24*7, 10000),
     'session': (lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
-}  # type: Dict[str, Tuple[Callable[[], List[Any]], Callable[[Dict[Text, Any], Any], None], int, int]]
+}  # type: Dict[str, Tuple[Callable[[], QuerySet], Callable[[Dict[Text, Any], Any], None], int, int]]
+
+# For caches whose items filler takes something other than the model
+# objects, a function to turn each batch of objects into those.
+cache_batch_fetchers = {
+    'message': message_fetch_rows,
+}  # type: Dict[str, Callable[[List[Any]], List[Any]]]
 
-def fill_remote_cache(cache):
-    # type: (str) -> None
+# Objects to put in the cache before the rest.
+cache_priority_objects = {
+    'user': recently_active_user_objects,
+}  # type: Dict[str, Callable[[], QuerySet]]
+
+# Each cache is filled in shards: ranges of primary keys that can be
+# filled in parallel, by separate processes.  Shards are ordered newest
+# (highest ids) first, so that recent messages and users are cached
+# earliest.  Progress through each shard is checkpointed in Redis after
+# every batch, so that an interrupted run can be resumed where it left
+# off.  Since the checkpoints are stored under the remote cache's
+# KEY_PREFIX, they only apply to the same deployment.
+Shard = Tuple[Any, Any]
+
+def get_cache_shards(cache, num_shards):
+    # type: (str, int) -> List[Shard]
+    objects = cache_fillers[cache][0]()
+    bounds = objects.aggregate(low=Min('pk'), high=Max('pk'))
+    (low, high) = (bounds['low'], bounds['high'])
+    if low is None:
+        return []
+    if not isinstance(low, six.integer_types):
+        # Primary keys that aren't integers (sessions) can't be split
+        # into ranges up front.
+        return [(None, None)]
+    shard_size = (high - low) // num_shards + 1
+    shards = [(shard_low, min(shard_low + shard_size - 1, high))
+              for shard_low in range(low, high + 1, shard_size)]
+    shards.reverse()
+    return shards
+
+def fill_remote_cache_objects(cache, objects, checkpoint_field, resume=False):
+    # type: (str, QuerySet, Text, bool) -> int
+    (_, items_filler, timeout, batch_size) = cache_fillers[cache]
+    checkpoint_key = fill_remote_cache_checkpoint_key(cache)
+    last_pk = None  # type: Any
+    if resume:
+        checkpoint = redis_client.hget(checkpoint_key, checkpoint_field)
+        if checkpoint is not None:
+            last_pk = ujson.loads(checkpoint)
+    objects = objects.order_by('pk')
+    count = 0
+    while True:
+        batch_objects = objects
+        if last_pk is not None:
+            batch_objects = objects.filter(pk__gt=last_pk)
+        batch = list(batch_objects[:batch_size])
+        if len(batch) == 0:
+            break
+        items = batch  # type: List[Any]
+        if cache in cache_batch_fetchers:
+            items = cache_batch_fetchers[cache](batch)
+        items_for_remote_cache = {}  # type: Dict[Text, Any]
+        for item in items:
+            items_filler(items_for_remote_cache, item)
+        # These are fills, not changes, so they don't need to
+        # invalidate other processes' local caches.
+        cache_set_many(items_for_remote_cache, timeout=timeout, fill=True)
+        count += len(batch)
+        last_pk = batch[-1].pk
+        redis_client.hset(checkpoint_key, checkpoint_field, ujson.dumps(last_pk))
+        # Don't let the display recipients etc. that were looked up
+        # for this batch pile up for the whole run.
+        flush_per_request_caches()
+    return count
+
+def fill_remote_cache_shard(cache, shard, resume=False):
+    # type: (str, Shard, bool) -> int
+    (low, high) = shard
+    objects = cache_fillers[cache][0]()
+    if low is not None:
+        objects = objects.filter(pk__gte=low, pk__lte=high)
+    return fill_remote_cache_objects(cache, objects, u'shard:%s:%s' % (low, high), resume=resume)
+
+def fill_remote_cache(cache, processes=1, num_shards=None, resume=False):
+    # type: (str, int, Optional[int], bool) -> None
+    """Fills the remote cache for one of cache_fillers, using up to
+    `processes` worker processes.  With resume=True, skips whatever a
+    previous interrupted run already filled."""
     remote_cache_time_start = get_remote_cache_time()
     remote_cache_requests_start = get_remote_cache_requests()
-    items_for_remote_cache = {}  # type: Dict[Text, Any]
-    (objects, items_filler, timeout, batch_size) = cache_fillers[cache]
-    count = 0
-    for obj in objects():
-        items_filler(items_for_remote_cache, obj)
-        count += 1
-        if (count % batch_size == 0):
-            cache_set_many(items_for_remote_cache, timeout=3600*24)
-            items_for_remote_cache = {}
-    cache_set_many(items_for_remote_cache, timeout=3600*24*7)
+    checkpoint_key = fill_remote_cache_checkpoint_key(cache)
+    if not resume:
+        redis_client.delete(checkpoint_key)
+
+    shards = None  # type: Optional[List[Shard]]
+    if resume:
+        saved_shards = redis_client.hget(checkpoint_key, 'shards')
+        if saved_shards is not None:
+            # The shards have to match the checkpoints, even if
+            # objects were created since.
+            shards = [tuple(shard) for shard in ujson.loads(saved_shards)]
+    if shards is None:
+        shards = get_cache_shards(cache, num_shards or processes)
+        redis_client.hset(checkpoint_key, 'shards', ujson.dumps(shards))
+
+    jobs = [None] + shards  # type: List[Optional[Shard]]
+
+    def fill(job):
+        # type: (Optional[Shard]) -> int
+        if job is None:
+            if cache not in cache_priority_objects:
+                return 0
+            objects = cache_priority_objects[cache]()
+            return fill_remote_cache_objects(cache, objects, u'priority', resume=resume)
+        return fill_remote_cache_shard(cache, job, resume=resume)
+
+    if processes == 1:
+        for job in jobs:
+            fill(job)
+    else:
+        def fill_in_subprocess(job):
+            # type: (Optional[Shard]) -> int
+            try:
+                logging.info("Filled %s cache shard %s: %s objects" % (cache, job, fill(job)))
+                return 0
+            except Exception:
+                logging.exception("Error filling %s cache shard %s" % (cache, job))
+                return 1
+
+        # Each worker needs its own database connections.
+        connections.close_all()
+        failed = [job for (status, job) in run_parallel(fill_in_subprocess, jobs, threads=processes)
+                  if status != 0]
+        if failed:
+            raise RuntimeError("Failed to fill %s cache shards %s; rerun with --resume to finish"
+                               % (cache, failed))
+
+    redis_client.delete(checkpoint_key)
     logging.info("Succesfully populated %s cache!  Consumed %s remote cache queries (%s time)" %
                  (cache, get_remote_cache_requests() - remote_cache_requests_start,
                   round(get_remote_cache_time() - remote_cache_time_start, 2)))
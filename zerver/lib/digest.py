@@ -13,6 +13,7 @@ from django.conf import settings
 from zerver.lib.notifications import build_message_list, hash_util_encode, \
     one_click_unsubscribe_link
 from zerver.lib.send_email import send_future_email, FromAddress
+from zerver.lib.soft_deactivation import backfill_missing_messages
 from zerver.models import UserProfile, UserMessage, Recipient, Stream, \
     Subscription, get_active_streams
 from zerver.context_processors import common_context
@@ -150,6 +151,11 @@ def enough_traffic(unread_pms, hot_conversations, new_streams, new_users):
 def handle_digest_email(user_profile_id, cutoff):
     # type: (int, float) -> None
     user_profile = UserProfile.objects.get(id=user_profile_id)
+    if user_profile.long_term_idle:
+        # The digest is built from the user's UserMessage rows.  The
+        # user stays soft-deactivated; later messages are filled in on
+        # the next backfill.
+        backfill_missing_messages(user_profile)
     # Convert from epoch seconds to a datetime object.
     cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=pytz.utc)
 
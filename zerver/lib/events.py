@@ -20,6 +20,7 @@ session_engine = import_module(settings.SESSION_ENGINE)
 from zerver.lib.alert_words import user_alert_words
 from zerver.lib.attachments import user_attachments
 from zerver.lib.avatar import avatar_url, avatar_url_from_dict
+from zerver.lib.cache import cache_with_key, realm_register_section_cache_key
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.message import (
     apply_unread_message_event,
@@ -28,6 +29,7 @@ from zerver.lib.message import (
 from zerver.lib.narrow import check_supported_events_narrow_filter
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.request import JsonableError
+from zerver.lib.soft_deactivation import reactivate_user_if_soft_deactivated
 from zerver.lib.actions import (
     validate_user_access_to_subscribers_helper,
     do_get_streams, get_default_streams_for_realm,
@@ -43,8 +45,8 @@ from zproject.backends import password_auth_enabled
 from version import ZULIP_VERSION
 
 
-def get_realm_user_dicts(user_profile):
-    # type: (UserProfile) -> List[Dict[str, Text]]
+def get_realm_user_dicts(realm):
+    # type: (Realm) -> List[Dict[str, Text]]
     return [{'email': userdict['email'],
              'user_id': userdict['id'],
              'avatar_url': avatar_url_from_dict(userdict),
@@ -52,7 +54,26 @@ def get_realm_user_dicts(user_profile):
              'is_bot': userdict['is_bot'],
              'full_name': userdict['full_name'],
              'timezone': userdict['timezone']}
-            for userdict in get_active_user_dicts_in_realm(user_profile.realm)]
+            for userdict in get_active_user_dicts_in_realm(realm)]
+
+# Some sections of the initial state are the same for every user in
+# the realm, but are expensive to build for large realms (e.g. an avatar
+# URL for every user).  Rather than build them for each of the
+# thousands of clients that re-register after a restart, we cache them
+# as encoded JSON, invalidated by the flush_* hooks for their data (see
+# flush_realm_register_section).  Each user decodes their own copy,
+# since apply_events modifies the state in place.
+@cache_with_key(lambda realm: realm_register_section_cache_key(realm.id, 'realm_users'),
+                timeout=3600*24*7, lock_timeout=10)
+def get_realm_users_json(realm):
+    # type: (Realm) -> str
+    return ujson.dumps(get_realm_user_dicts(realm))
+
+@cache_with_key(lambda realm: realm_register_section_cache_key(realm.id, 'realm_default_streams'),
+                timeout=3600*24*7, lock_timeout=10)
+def get_realm_default_streams_json(realm):
+    # type: (Realm) -> str
+    return ujson.dumps(streams_to_dicts_sorted(get_default_streams_for_realm(realm)))
 
 # Fetch initial data.  When event_types is not specified, clients want
 # all event types.  Whenever you add new code to this function, you
@@ -135,7 +156,7 @@ def fetch_initial_state_data(user_profile, event_types, queue_id,
         state['realm_filters'] = realm_filters_for_realm(user_profile.realm_id)
 
     if want('realm_user'):
-        state['realm_users'] = get_realm_user_dicts(user_profile)
+        state['realm_users'] = ujson.loads(get_realm_users_json(user_profile.realm))
         state['avatar_source'] = user_profile.avatar_source
         state['avatar_url_medium'] = avatar_url(user_profile, medium=True)
         state['avatar_url'] = avatar_url(user_profile)
@@ -167,7 +188,7 @@ def fetch_initial_state_data(user_profile, event_types, queue_id,
     if want('stream'):
         state['streams'] = do_get_streams(user_profile)
     if want('default_streams'):
-        state['realm_default_streams'] = streams_to_dicts_sorted(get_default_streams_for_realm(user_profile.realm))
+        state['realm_default_streams'] = ujson.loads(get_realm_default_streams_json(user_profile.realm))
 
     if want('update_display_settings'):
         for prop in UserProfile.property_types:
@@ -492,6 +513,10 @@ def do_events_register(user_profile, user_client, apply_markdown=True,
     # handling perspective to do it before contacting Tornado
     check_supported_events_narrow_filter(narrow)
 
+    # A soft-deactivated user needs their missing messages before we
+    # can compute their unread counts and so on.
+    reactivate_user_if_soft_deactivated(user_profile)
+
     # Note that we pass event_types, not fetch_event_types here, since
     # that's what controls which future events are sent.
     queue_id = request_event_queue(user_profile, user_client, apply_markdown,
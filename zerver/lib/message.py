@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 
+import binascii
 import datetime
+import logging
+import msgpack
+import os
 import ujson
 import zlib
 
@@ -9,10 +13,13 @@ from six import binary_type
 
 from zerver.lib.avatar import avatar_url_from_dict
 import zerver.lib.bugdown as bugdown
-from zerver.lib.cache import cache_with_key, to_dict_cache_key
+from zerver.lib.cache import cache_delete, cache_delete_many, cache_get, cache_set, \
+    cache_with_key, per_request_message_dict_cache, to_dict_cache_key, \
+    unread_summary_cache_key
 from zerver.lib.request import JsonableError
-from zerver.lib.str_utils import force_bytes, dict_with_str_keys
+from zerver.lib.str_utils import dict_with_str_keys
 from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.lib.utils import statsd
 
 from zerver.models import (
     get_display_recipient_by_id,
@@ -30,18 +37,74 @@ from typing import Any, Dict, List, Optional, Set, Tuple, Text, Union
 
 RealmAlertWords = Dict[int, List[Text]]
 
+# Message dicts are stored in the remote cache in a compact binary
+# format: a msgpack array of the values of MESSAGE_DICT_FIELDS, in that
+# order, followed by a map of any other keys (e.g. stream_id, which
+# only stream messages have).  Not repeating the field names in every
+# entry saves space, and decoding reuses the same key strings for every
+# message.  Entries that are still larger than
+# MESSAGE_DICT_COMPRESS_THRESHOLD bytes are zlib-compressed as well.
+# The first byte says which format an entry is in; use new values for
+# these if MESSAGE_DICT_FIELDS changes.
+MESSAGE_DICT_FIELDS = (
+    'id',
+    'sender_email',
+    'sender_full_name',
+    'sender_short_name',
+    'sender_realm_str',
+    'sender_id',
+    'type',
+    'display_recipient',
+    'recipient_id',
+    'subject',
+    'timestamp',
+    'avatar_url',
+    'client',
+    'subject_links',
+    'content',
+    'content_type',
+    'reactions',
+)
+MESSAGE_DICT_FIELD_SET = frozenset(MESSAGE_DICT_FIELDS)
+MESSAGE_DICT_MSGPACK = b'\x01'
+MESSAGE_DICT_MSGPACK_ZLIB = b'\x02'
+MESSAGE_DICT_COMPRESS_THRESHOLD = 1024
+
 def extract_message_dict(message_bytes):
     # type: (binary_type) -> Dict[str, Any]
-    return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes).decode("utf-8")))
+    message_format = message_bytes[:1]
+    if message_format == MESSAGE_DICT_MSGPACK:
+        packed = message_bytes[1:]
+    elif message_format == MESSAGE_DICT_MSGPACK_ZLIB:
+        packed = zlib.decompress(message_bytes[1:])
+    else:
+        # Entries written before the binary format existed were
+        # zlib-compressed JSON.
+        return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes).decode("utf-8")))
+    values, extra_fields = msgpack.unpackb(packed, encoding='utf-8')
+    message_dict = dict(zip(MESSAGE_DICT_FIELDS, values))
+    message_dict.update(dict_with_str_keys(extra_fields))
+    return message_dict
 
 def stringify_message_dict(message_dict):
     # type: (Dict[str, Any]) -> binary_type
-    return zlib.compress(force_bytes(ujson.dumps(message_dict)))
+    values = [message_dict[field] for field in MESSAGE_DICT_FIELDS]
+    extra_fields = {key: value for key, value in message_dict.items()
+                    if key not in MESSAGE_DICT_FIELD_SET}
+    packed = msgpack.packb([values, extra_fields], use_bin_type=True)
+    if len(packed) > MESSAGE_DICT_COMPRESS_THRESHOLD:
+        return MESSAGE_DICT_MSGPACK_ZLIB + zlib.compress(packed)
+    return MESSAGE_DICT_MSGPACK + packed
 
 def message_to_dict(message, apply_markdown):
     # type: (Message, bool) -> Dict[str, Any]
-    json = message_to_dict_json(message, apply_markdown)
-    return extract_message_dict(json)
+    key = to_dict_cache_key(message, apply_markdown)
+    if key not in per_request_message_dict_cache:
+        per_request_message_dict_cache[key] = \
+            extract_message_dict(message_to_dict_json(message, apply_markdown))
+    # Callers are free to modify the top level of the dict they get
+    # (e.g. to add flags), but not its contents.
+    return dict(per_request_message_dict_cache[key])
 
 @cache_with_key(to_dict_cache_key, timeout=3600*24)
 def message_to_dict_json(message, apply_markdown):
@@ -50,14 +113,19 @@ def message_to_dict_json(message, apply_markdown):
 
 class MessageDict(object):
     @staticmethod
-    def to_dict_uncached(message, apply_markdown):
-        # type: (Message, bool) -> binary_type
-        dct = MessageDict.to_dict_uncached_helper(message, apply_markdown)
+    def to_dict_uncached(message, apply_markdown, reactions=None):
+        # type: (Message, bool, Optional[List[Dict[str, Any]]]) -> binary_type
+        dct = MessageDict.to_dict_uncached_helper(message, apply_markdown, reactions)
         return stringify_message_dict(dct)
 
     @staticmethod
-    def to_dict_uncached_helper(message, apply_markdown):
-        # type: (Message, bool) -> Dict[str, Any]
+    def to_dict_uncached_helper(message, apply_markdown, reactions=None):
+        # type: (Message, bool, Optional[List[Dict[str, Any]]]) -> Dict[str, Any]
+        # Callers that already know the reactions for the message
+        # (e.g. the send path, where there are none yet) can pass them
+        # in to save a database query.
+        if reactions is None:
+            reactions = Reaction.get_raw_db_rows([message.id])
         return MessageDict.build_message_dict(
             apply_markdown = apply_markdown,
             message = message,
@@ -82,7 +150,7 @@ class MessageDict(object):
             recipient_id = message.recipient.id,
             recipient_type = message.recipient.type,
             recipient_type_id = message.recipient.type_id,
-            reactions = Reaction.get_raw_db_rows([message.id])
+            reactions = reactions
         )
 
     @staticmethod
@@ -298,52 +366,80 @@ def render_markdown(message, content, realm=None, realm_alert_words=None, messag
     These are only on this Django object and are not saved in the
     database.
     """
+    return bulk_render_markdown([dict(message=message,
+                                      content=content,
+                                      realm=realm,
+                                      realm_alert_words=realm_alert_words,
+                                      message_users=message_users)])[0]
+
+def bulk_render_markdown(renders):
+    # type: (List[Dict[str, Any]]) -> List[Text]
+    """Batch version of render_markdown; each element of `renders` is a
+    dict of arguments to render_markdown.  The messages are rendered
+    together by bugdown.convert_many, which renders them in parallel
+    if settings.BUGDOWN_RENDER_PROCESSES is set."""
+    convert_requests = []  # type: List[Dict[str, Any]]
+    all_message_user_ids = []  # type: List[Set[int]]
+    for render in renders:
+        message = render['message']
+        realm = render.get('realm')
+        realm_alert_words = render.get('realm_alert_words')
+        message_users = render.get('message_users')
+
+        if message_users is None:
+            message_user_ids = set()  # type: Set[int]
+        else:
+            message_user_ids = {u.id for u in message_users}
+        all_message_user_ids.append(message_user_ids)
 
-    if message_users is None:
-        message_user_ids = set()  # type: Set[int]
-    else:
-        message_user_ids = {u.id for u in message_users}
-
-    if message is not None:
-        message.mentions_wildcard = False
-        message.is_me_message = False
-        message.mentions_user_ids = set()
-        message.alert_words = set()
-        message.links_for_preview = set()
-
-        if realm is None:
-            realm = message.get_realm()
-
-    possible_words = set()  # type: Set[Text]
-    if realm_alert_words is not None:
-        for user_id, words in realm_alert_words.items():
-            if user_id in message_user_ids:
-                possible_words.update(set(words))
-
-    if message is None:
-        # If we don't have a message, then we are in the compose preview
-        # codepath, so we know we are dealing with a human.
-        sent_by_bot = False
-    else:
-        sent_by_bot = get_user_profile_by_id(message.sender_id).is_bot
-
-    # DO MAIN WORK HERE -- call bugdown to convert
-    rendered_content = bugdown.convert(content, message=message, message_realm=realm,
-                                       possible_words=possible_words,
-                                       sent_by_bot=sent_by_bot)
+        if message is not None:
+            message.mentions_wildcard = False
+            message.is_me_message = False
+            message.mentions_user_ids = set()
+            message.alert_words = set()
+            message.links_for_preview = set()
 
-    if message is not None:
-        message.user_ids_with_alert_words = set()
+            if realm is None:
+                realm = message.get_realm()
 
+        possible_words = set()  # type: Set[Text]
         if realm_alert_words is not None:
             for user_id, words in realm_alert_words.items():
                 if user_id in message_user_ids:
-                    if set(words).intersection(message.alert_words):
-                        message.user_ids_with_alert_words.add(user_id)
+                    possible_words.update(set(words))
 
-        message.is_me_message = Message.is_status_message(content, rendered_content)
+        if message is None:
+            # If we don't have a message, then we are in the compose preview
+            # codepath, so we know we are dealing with a human.
+            sent_by_bot = False
+        else:
+            sent_by_bot = get_user_profile_by_id(message.sender_id).is_bot
+
+        convert_requests.append(dict(content=render['content'],
+                                     message=message,
+                                     message_realm=realm,
+                                     possible_words=possible_words,
+                                     sent_by_bot=sent_by_bot))
+
+    # DO MAIN WORK HERE -- call bugdown to convert
+    all_rendered_content = bugdown.convert_many(convert_requests)
+
+    for render, message_user_ids, rendered_content in zip(renders, all_message_user_ids,
+                                                          all_rendered_content):
+        message = render['message']
+        realm_alert_words = render.get('realm_alert_words')
+        if message is not None:
+            message.user_ids_with_alert_words = set()
 
-    return rendered_content
+            if realm_alert_words is not None:
+                for user_id, words in realm_alert_words.items():
+                    if user_id in message_user_ids:
+                        if set(words).intersection(message.alert_words):
+                            message.user_ids_with_alert_words.add(user_id)
+
+            message.is_me_message = Message.is_status_message(render['content'], rendered_content)
+
+    return all_rendered_content
 
 def huddle_users(recipient_id):
     # type: (int) -> str
@@ -358,29 +454,104 @@ def huddle_users(recipient_id):
     user_ids = sorted(user_ids)
     return ','.join(str(uid) for uid in user_ids)
 
-def aggregate_dict(input_rows, lookup_fields, input_field, output_field):
-    # type: (List[Dict[str, Any]], List[str], str, str) -> List[Dict[str, Any]]
-    lookup_dict = dict()  # type: Dict[Any, Dict]
-
-    for input_row in input_rows:
-        lookup_key = tuple([input_row[f] for f in lookup_fields])
-        if lookup_key not in lookup_dict:
-            obj = {}
-            for f in lookup_fields:
-                obj[f] = input_row[f]
-            obj[output_field] = []
-            lookup_dict[lookup_key] = obj
-
-        lookup_dict[lookup_key][output_field].append(input_row[input_field])
-
-    sorted_keys = sorted(lookup_dict.keys())
+# The unread messages in /register (see fetch_initial_state_data) are
+# grouped by conversation.  Computing that grouping from scratch means
+# joining every one of the user's unread UserMessage rows to Message
+# and Recipient, and looking up the members of each huddle, which
+# takes seconds for users with tens of thousands of unread messages.
+#
+# So we keep each user's unread message ids grouped by
+# conversation in the remote cache (the "unread summary").  Which
+# messages are still unread, and which mention the user, are read
+# from the partial indexes on UserMessage each time, so marking
+# messages as read or unread needs no bookkeeping: read messages are
+# dropped from the summary, and only messages the summary doesn't
+# know about yet are looked up in Message.  The grouping of a message
+# only changes when its topic is edited, which deletes the summaries
+# of the users who have it unread (see do_update_message).
+#
+# Summaries carry a random token, which is replaced on every write; a
+# new summary is only stored if the token in the cache is still the
+# one we started from, so that a summary built concurrently with a
+# topic edit doesn't overwrite the edit's invalidation.
+#
+# To keep summaries well under memcached's 1MB item limit, only the
+# newest UNREAD_SUMMARY_MAX_MESSAGES unread messages are included in
+# /register, and summaries are stored delta-encoded and compressed
+# (see encode_unread_summary).  A summary that is still too large
+# isn't stored, and that is logged.
+UNREAD_SUMMARY_CACHE_TIMEOUT = 3600 * 24 * 7
+UNREAD_SUMMARY_MAX_MESSAGES = 50000
+UNREAD_SUMMARY_MAX_BYTES = 900 * 1024
+
+def new_unread_summary():
+    # type: () -> Dict[str, Any]
+    return dict(token=binascii.hexlify(os.urandom(8)).decode('ascii'),
+                streams={},
+                pms={},
+                huddles={})
+
+def encode_message_ids(message_ids):
+    # type: (List[int]) -> List[int]
+    """Sorts `message_ids` and replaces all but the first with the
+    difference from the previous one, which are small numbers."""
+    message_ids = sorted(message_ids)
+    return message_ids[:1] + [message_id - previous for (previous, message_id)
+                              in zip(message_ids, message_ids[1:])]
+
+def decode_message_ids(deltas):
+    # type: (List[int]) -> List[int]
+    message_ids = []  # type: List[int]
+    for delta in deltas:
+        message_ids.append(message_ids[-1] + delta if message_ids else delta)
+    return message_ids
+
+def encode_unread_summary(summary):
+    # type: (Dict[str, Any]) -> binary_type
+    data = dict(
+        token=summary['token'],
+        streams=[[stream_id, topic, encode_message_ids(message_ids)]
+                 for ((stream_id, topic), message_ids) in summary['streams'].items()],
+        pms=[[sender_id, encode_message_ids(message_ids)]
+             for (sender_id, message_ids) in summary['pms'].items()],
+        huddles=[[user_ids_string, encode_message_ids(message_ids)]
+                 for (user_ids_string, message_ids) in summary['huddles'].items()],
+    )
+    return zlib.compress(ujson.dumps(data).encode('utf-8'))
 
-    return [lookup_dict[k] for k in sorted_keys]
+def decode_unread_summary(encoded):
+    # type: (binary_type) -> Dict[str, Any]
+    data = ujson.loads(zlib.decompress(encoded).decode('utf-8'))
+    return dict(
+        token=data['token'],
+        streams={(stream_id, topic): decode_message_ids(deltas)
+                 for (stream_id, topic, deltas) in data['streams']},
+        pms={sender_id: decode_message_ids(deltas) for (sender_id, deltas) in data['pms']},
+        huddles={user_ids_string: decode_message_ids(deltas)
+                 for (user_ids_string, deltas) in data['huddles']},
+    )
 
-def get_unread_message_ids_per_recipient(user_profile):
-    # type: (UserProfile) -> Dict[str, List[Dict[str, Any]]]
+def store_unread_summary(user_profile, summary):
+    # type: (UserProfile, Dict[str, Any]) -> None
+    key = unread_summary_cache_key(user_profile.id)
+    encoded = encode_unread_summary(summary)
+    if len(encoded) > UNREAD_SUMMARY_MAX_BYTES:
+        logging.warning("Unread summary for user %s is too large to cache (%d bytes)"
+                        % (user_profile.id, len(encoded)))
+        statsd.incr('unread_summary.too_large')
+        # Don't leave a smaller, out-of-date summary behind.
+        cache_delete(key)
+        return
+    cache_set(key, encoded, timeout=UNREAD_SUMMARY_CACHE_TIMEOUT)
+
+def fetch_unread_rows(user_profile, message_ids):
+    # type: (UserProfile, Set[int]) -> List[Dict[str, Any]]
+    # Newly unread messages are almost always recent, so rather than
+    # sending a huge list of ids, we fetch the unread rows from the
+    # oldest one on and filter out the ones we already know about.
     user_msgs = UserMessage.objects.filter(
-        user_profile=user_profile
+        user_profile=user_profile,
+        message_id__gte=min(message_ids),
     ).extra(
         where=[UserMessage.where_unread()]
     ).values(
@@ -390,74 +561,118 @@ def get_unread_message_ids_per_recipient(user_profile):
         'message__recipient_id',
         'message__recipient__type',
         'message__recipient__type_id',
-        'flags',
-    )
-
-    rows = list(user_msgs)
-
-    pm_msgs = [
-        dict(
-            sender_id=row['message__sender_id'],
-            message_id=row['message_id'],
-        ) for row in rows
-        if row['message__recipient__type'] == Recipient.PERSONAL]
-
-    pm_objects = aggregate_dict(
-        input_rows=pm_msgs,
-        lookup_fields=[
-            'sender_id',
-        ],
-        input_field='message_id',
-        output_field='unread_message_ids',
     )
+    return [row for row in user_msgs if row['message_id'] in message_ids]
 
-    stream_msgs = [
-        dict(
-            stream_id=row['message__recipient__type_id'],
-            topic=row['message__subject'],
-            message_id=row['message_id'],
-        ) for row in rows
-        if row['message__recipient__type'] == Recipient.STREAM]
-
-    stream_objects = aggregate_dict(
-        input_rows=stream_msgs,
-        lookup_fields=[
-            'stream_id',
-            'topic',
-        ],
-        input_field='message_id',
-        output_field='unread_message_ids',
-    )
+def add_unread_rows(summary, rows):
+    # type: (Dict[str, Any], List[Dict[str, Any]]) -> None
+    huddle_user_ids_strings = {}  # type: Dict[int, str]
+    for row in rows:
+        recipient_type = row['message__recipient__type']
+        if recipient_type == Recipient.STREAM:
+            key = (row['message__recipient__type_id'], row['message__subject'])  # type: Any
+            group = summary['streams']
+        elif recipient_type == Recipient.PERSONAL:
+            key = row['message__sender_id']
+            group = summary['pms']
+        else:
+            recipient_id = row['message__recipient_id']
+            if recipient_id not in huddle_user_ids_strings:
+                huddle_user_ids_strings[recipient_id] = huddle_users(recipient_id)
+            key = huddle_user_ids_strings[recipient_id]
+            group = summary['huddles']
+        group.setdefault(key, []).append(row['message_id'])
+
+def remove_read_messages(summary, unread_message_ids):
+    # type: (Dict[str, Any], Set[int]) -> Tuple[Set[int], bool]
+    """Drops messages that are no longer unread from `summary`.  Returns
+    the ids of the messages that remain, and whether any were dropped."""
+    known_message_ids = set()  # type: Set[int]
+    removed = False
+    for group in (summary['streams'], summary['pms'], summary['huddles']):
+        for key, message_ids in list(group.items()):
+            still_unread = [message_id for message_id in message_ids
+                            if message_id in unread_message_ids]
+            if len(still_unread) != len(message_ids):
+                removed = True
+                if still_unread:
+                    group[key] = still_unread
+                else:
+                    del group[key]
+            known_message_ids.update(still_unread)
+    return known_message_ids, removed
+
+def get_unread_summary(user_profile):
+    # type: (UserProfile) -> Dict[str, Any]
+    key = unread_summary_cache_key(user_profile.id)
+    cached = cache_get(key)
+    if cached is None:
+        summary = new_unread_summary()
+        # Claim the key before reading the database; see above.
+        store_unread_summary(user_profile, summary)
+    else:
+        summary = decode_unread_summary(cached[0])
+    token = summary['token']
 
-    huddle_msgs = [
-        dict(
-            recipient_id=row['message__recipient_id'],
-            message_id=row['message_id'],
-        ) for row in rows
-        if row['message__recipient__type'] == Recipient.HUDDLE]
-
-    huddle_objects = aggregate_dict(
-        input_rows=huddle_msgs,
-        lookup_fields=[
-            'recipient_id',
-        ],
-        input_field='message_id',
-        output_field='unread_message_ids',
-    )
+    unread_message_ids = set(UserMessage.objects.filter(
+        user_profile=user_profile,
+    ).extra(
+        where=[UserMessage.where_unread()]
+    ).order_by('-message_id').values_list(
+        'message_id', flat=True)[:UNREAD_SUMMARY_MAX_MESSAGES])
+
+    known_message_ids, changed = remove_read_messages(summary, unread_message_ids)
+
+    new_message_ids = unread_message_ids - known_message_ids
+    if new_message_ids:
+        add_unread_rows(summary, fetch_unread_rows(user_profile, new_message_ids))
+        changed = True
+
+    if changed:
+        current = cache_get(key)
+        if current is not None and decode_unread_summary(current[0])['token'] == token:
+            summary['token'] = new_unread_summary()['token']
+            store_unread_summary(user_profile, summary)
+    return summary
+
+def delete_unread_summaries(message_ids):
+    # type: (List[int]) -> None
+    """Deletes the unread summaries of every user who received one of
+    these messages, for when their conversations change.  This ignores
+    the read flag: a summary is only brought up to date when it is next
+    fetched, so it can still list a message that has since been marked
+    as read, and that message may be marked as unread again later."""
+    user_ids = UserMessage.objects.filter(
+        message_id__in=message_ids,
+    ).values_list('user_profile_id', flat=True).distinct()
+    cache_delete_many([unread_summary_cache_key(user_id) for user_id in user_ids])
 
-    for huddle in huddle_objects:
-        huddle['user_ids_string'] = huddle_users(huddle['recipient_id'])
-        del huddle['recipient_id']
+def get_unread_message_ids_per_recipient(user_profile):
+    # type: (UserProfile) -> Dict[str, List[Dict[str, Any]]]
+    summary = get_unread_summary(user_profile)
+
+    def group_objects(group, key_fields):
+        # type: (Dict[Any, List[int]], List[str]) -> List[Dict[str, Any]]
+        objects = []
+        for key in sorted(group.keys()):
+            if len(key_fields) == 1:
+                obj = {key_fields[0]: key}
+            else:
+                obj = dict(zip(key_fields, key))
+            obj['unread_message_ids'] = sorted(group[key])
+            objects.append(obj)
+        return objects
 
-    mentioned_message_ids = [
-        row['message_id']
-        for row in rows
-        if (row['flags'] & UserMessage.flags.mentioned) != 0]
+    mentioned_message_ids = list(UserMessage.objects.filter(
+        user_profile=user_profile,
+    ).extra(
+        where=[UserMessage.where_unread(), UserMessage.where_mentioned()]
+    ).order_by('message_id').values_list('message_id', flat=True))
 
     result = dict(
-        pms=pm_objects,
-        streams=stream_objects,
-        huddles=huddle_objects,
+        pms=group_objects(summary['pms'], ['sender_id']),
+        streams=group_objects(summary['streams'], ['stream_id', 'topic']),
+        huddles=group_objects(summary['huddles'], ['user_ids_string']),
         mentions=mentioned_message_ids,
     )
 
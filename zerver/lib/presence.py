@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import os
+
+from typing import Dict, Mapping, Optional, Sequence, Text
+
+from six.moves import zip
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.models import Realm, UserPresence
+
+# Tornado needs to know how recently the recipients of a message were
+# active, to decide whether to send them missed-message notifications.
+# Rather than looking that up from the UserPresence table (which means
+# fetching every presence row in the realm), we keep a compact record
+# of it in redis: a single hash mapping user IDs to the UNIX timestamp
+# at which each user was last active on any client, or 0 if they
+# have only ever been idle.  bulk_update_user_presence writes to it;
+# Tornado reads from it, and never touches the database for it.
+#
+# Users missing from the hash are treated like users of realms with
+# presence disabled, who are never considered idle while they have a
+# queue.  So that users who haven't been active since the hash was
+# introduced (or since redis lost it) aren't, the fill_last_active_times
+# management command, run by restart-server, fills it in from
+# UserPresence.
+
+client = get_redis_client()
+
+KEY_PREFIX = u''
+
+def bounce_presence_key_prefix_for_testing(test_name):
+    # type: (Text) -> None
+    global KEY_PREFIX
+    KEY_PREFIX = test_name + u':' + Text(os.getpid()) + u':'
+
+def last_active_key():
+    # type: () -> Text
+    return u'%spresence:last_active' % (KEY_PREFIX,)
+
+def set_last_active_times(last_active_times):
+    # type: (Mapping[int, int]) -> None
+    if len(last_active_times) == 0:
+        return
+    pipeline = client.pipeline()
+    for user_profile_id, timestamp in last_active_times.items():
+        if timestamp == 0:
+            # Don't forget when an idle user was last active.
+            pipeline.hsetnx(last_active_key(), user_profile_id, 0)
+        else:
+            pipeline.hset(last_active_key(), user_profile_id, timestamp)
+    pipeline.execute()
+
+def get_last_active_times(user_profile_ids):
+    # type: (Sequence[int]) -> Dict[int, int]
+    """Returns a dict mapping those of the given users who have presence
+    data to the UNIX timestamp at which they were last active."""
+    if len(user_profile_ids) == 0:
+        return {}
+    timestamps = client.hmget(last_active_key(), user_profile_ids)
+    return {user_profile_id: int(timestamp)
+            for user_profile_id, timestamp in zip(user_profile_ids, timestamps)
+            if timestamp is not None}
+
+def fill_last_active_times(realm=None):
+    # type: (Optional[Realm]) -> int
+    """Fills in the last-active times of the users (in `realm`, if
+    given) who are missing from the hash from the UserPresence table,
+    and returns how many users have presence data."""
+    rows = UserPresence.objects.filter(user_profile__realm__presence_disabled=False)
+    if realm is not None:
+        rows = rows.filter(user_profile__realm=realm)
+    last_active_times = {}  # type: Dict[int, int]
+    for row in rows.values('user_profile_id', 'status', 'timestamp').iterator():
+        timestamp = 0
+        if row['status'] == UserPresence.ACTIVE:
+            timestamp = datetime_to_timestamp(row['timestamp'])
+        last_active_times[row['user_profile_id']] = max(
+            last_active_times.get(row['user_profile_id'], 0), timestamp)
+
+    # HSETNX, since the user may have become active in the meantime.
+    pipeline = client.pipeline()
+    for user_profile_id, timestamp in last_active_times.items():
+        pipeline.hsetnx(last_active_key(), user_profile_id, timestamp)
+    pipeline.execute()
+    return len(last_active_times)
@@ -2,17 +2,14 @@ from __future__ import absolute_import
 
 import os
 
-from typing import Any, Iterator, List, Tuple, Text
+from typing import Any, Dict, List, Tuple, Text
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
-from six.moves import zip
 
 from zerver.models import UserProfile
 
-import redis
 import time
-import logging
 
 # Implement a rate-limiting scheme inspired by the one described here, but heavily modified
 # http://blog.domaintools.com/2013/04/rate-limiting-with-redis/
@@ -39,7 +36,7 @@ def bounce_redis_key_prefix_for_testing(test_name):
 def redis_key(user, domain):
     # type: (UserProfile, Text) -> List[Text]
     """Return the redis keys for this user"""
-    return ["%sratelimit:%s:%s:%s:%s" % (KEY_PREFIX, type(user), user.id, domain, keytype) for keytype in ['list', 'zset', 'block']]
+    return ["%sratelimit:%s:%s:%s:%s" % (KEY_PREFIX, type(user), user.id, domain, keytype) for keytype in ['list', 'block']]
 
 def max_api_calls(user):
     # type: (UserProfile) -> int
@@ -67,7 +64,7 @@ def remove_ratelimit_rule(range_seconds, num_requests):
 def block_user(user, seconds, domain='all'):
     # type: (UserProfile, int, Text) -> None
     "Manually blocks a user id for the desired number of seconds"
-    _, _, blocking_key = redis_key(user, domain)
+    _, blocking_key = redis_key(user, domain)
     with client.pipeline() as pipe:
         pipe.set(blocking_key, 1)
         pipe.expire(blocking_key, seconds)
@@ -75,7 +72,7 @@ def block_user(user, seconds, domain='all'):
 
 def unblock_user(user, domain='all'):
     # type: (UserProfile, str) -> None
-    _, _, blocking_key = redis_key(user, domain)
+    _, blocking_key = redis_key(user, domain)
     client.delete(blocking_key)
 
 def clear_user_history(user, domain='all'):
@@ -86,150 +83,122 @@ def clear_user_history(user, domain='all'):
     '''
     for key in redis_key(user, domain):
         client.delete(key)
-
-def _get_api_calls_left(user, domain, range_seconds, max_calls):
-    # type: (UserProfile, Text, int, int) -> Tuple[int, float]
-    list_key, set_key, _ = redis_key(user, domain)
-    # Count the number of values in our sorted set
-    # that are between now and the cutoff
-    now = time.time()
-    boundary = now - range_seconds
-
-    with client.pipeline() as pipe:
-        # Count how many API calls in our range have already been made
-        pipe.zcount(set_key, boundary, now)
-        # Get the newest call so we can calculate when the ratelimit
-        # will reset to 0
-        pipe.lindex(list_key, 0)
-
-        results = pipe.execute()
-
-    count = results[0]
-    newest_call = results[1]
-
-    calls_left = max_calls - count
-    if newest_call is not None:
-        time_reset = now + (range_seconds - (now - float(newest_call)))
-    else:
-        time_reset = now
-
-    return calls_left, time_reset
-
-def api_calls_left(user, domain='all'):
-    # type: (UserProfile, Text) -> Tuple[int, float]
-    """Returns how many API calls in this range this client has, as well as when
-       the rate-limit will be reset to 0"""
-    max_window = _rules_for_user(user)[-1][0]
-    max_calls = _rules_for_user(user)[-1][1]
-    return _get_api_calls_left(user, domain, max_window, max_calls)
-
-def is_ratelimited(user, domain='all'):
-    # type: (UserProfile, Text) -> Tuple[bool, float]
-    "Returns a tuple of (rate_limited, time_till_free)"
-    list_key, set_key, blocking_key = redis_key(user, domain)
-
+        local_leases.pop(key, None)
+
+# We keep a list of the timestamps of each user's most recent requests,
+# newest first, and this script checks whether a new request would
+# break any of the user's rules and, if not, records it.  Doing this
+# in a script means the check and the increment happen atomically, in
+# a single round trip to redis.
+#
+# KEYS: the list key and the blocking key
+# ARGV: the current time, the length of the list to keep (the largest
+#       number of requests of any rule), the longest rule's range, the
+#       number of requests to record, and then the (range_seconds,
+#       num_requests) pairs of the rules, shortest range first
+#
+# Returns [1, secs_to_freedom, 0, 0] if the user is rate-limited, and
+# otherwise [0, '0', calls_remaining, requests_recorded], where
+# calls_remaining is for the longest rule.  We return secs_to_freedom
+# as a string, since redis truncates numbers returned from scripts to
+# integers.
+RATE_LIMIT_SCRIPT = """
+local list_key = KEYS[1]
+local blocking_key = KEYS[2]
+local now = tonumber(ARGV[1])
+local max_calls = tonumber(ARGV[2])
+local max_window = tonumber(ARGV[3])
+local lease = tonumber(ARGV[4])
+
+-- Check if there is a manual block on this user
+if redis.call('EXISTS', blocking_key) == 1 then
+    return {1, tostring(redis.call('TTL', blocking_key)), 0, 0}
+end
+
+for i = 5, #ARGV, 2 do
+    local range_seconds = tonumber(ARGV[i])
+    local num_requests = tonumber(ARGV[i + 1])
+    -- If the nth newest request is within the rule's range, we've hit
+    -- our limit for this rule
+    local timestamp = redis.call('LINDEX', list_key, num_requests - 1)
+    if timestamp and tonumber(timestamp) + range_seconds > now then
+        return {1, tostring(tonumber(timestamp) + range_seconds - now), 0, 0}
+    end
+    -- Only record extra requests for the caller to use later if the
+    -- user would still be far from the limit after making them
+    if lease > 1 then
+        timestamp = redis.call('LINDEX', list_key, math.max(num_requests - 2 * lease, 0))
+        if num_requests < 2 * lease or (timestamp and tonumber(timestamp) + range_seconds > now) then
+            lease = 1
+        end
+    end
+end
+
+local timestamps = {}
+for i = 1, lease do
+    timestamps[i] = ARGV[1]
+end
+redis.call('LPUSH', list_key, unpack(timestamps))
+redis.call('LTRIM', list_key, 0, max_calls - 1)
+redis.call('EXPIRE', list_key, max_window)
+
+-- Binary search for the number of requests within the longest rule's range
+local boundary = now - max_window
+local low = 0
+local high = max_calls
+while low < high do
+    local mid = math.floor((low + high) / 2)
+    local timestamp = redis.call('LINDEX', list_key, mid)
+    if timestamp and tonumber(timestamp) >= boundary then
+        low = mid + 1
+    else
+        high = mid
+    end
+end
+return {0, '0', max_calls - low, lease}
+"""
+rate_limit_script = client.register_script(RATE_LIMIT_SCRIPT)
+
+# With RATE_LIMITING_LOCAL_LEASE set, a request from a user who is far
+# below all of their limits records several requests at once, and this
+# process then allows that many more requests from the user without
+# asking redis.  Maps list keys to (requests left, expiry time, calls
+# remaining in redis).
+local_leases = {}  # type: Dict[Text, Tuple[int, float, int]]
+
+def check_and_incr_ratelimit(user, domain='all'):
+    # type: (UserProfile, Text) -> Tuple[bool, float, int]
+    """Checks whether the user is over any of their rate limits, and if
+    not, records this request.
+
+    Returns a tuple of (rate_limited, time_till_free, calls_remaining).
+    If the request was allowed, time_till_free is the number of
+    seconds until the longest rule resets, and calls_remaining is the
+    number of requests left under that rule."""
     rules = _rules_for_user(user)
-
     if len(rules) == 0:
-        return False, 0.0
-
-    # Go through the rules from shortest to longest,
-    # seeing if this user has violated any of them. First
-    # get the timestamps for each nth items
-    with client.pipeline() as pipe:
-        for _, request_count in rules:
-            pipe.lindex(list_key, request_count - 1)  # 0-indexed list
-
-        # Get blocking info
-        pipe.get(blocking_key)
-        pipe.ttl(blocking_key)
-
-        rule_timestamps = pipe.execute()
-
-    # Check if there is a manual block on this API key
-    blocking_ttl = rule_timestamps.pop()
-    key_blocked = rule_timestamps.pop()
-
-    if key_blocked is not None:
-        # We are manually blocked. Report for how much longer we will be
-        if blocking_ttl is None:
-            blocking_ttl = 0.5
-        else:
-            blocking_ttl = int(blocking_ttl)
-        return True, blocking_ttl
-
+        return False, 0.0, 0
+    max_window, max_calls = rules[-1]
+    list_key, blocking_key = redis_key(user, domain)
     now = time.time()
-    for timestamp, (range_seconds, num_requests) in zip(rule_timestamps, rules):
-        # Check if the nth timestamp is newer than the associated rule. If so,
-        # it means we've hit our limit for this rule
-        if timestamp is None:
-            continue
-
-        timestamp = float(timestamp)
-        boundary = timestamp + range_seconds
-        if boundary > now:
-            free = boundary - now
-            return True, free
-
-    # No api calls recorded yet
-    return False, 0.0
-
-def incr_ratelimit(user, domain='all'):
-    # type: (UserProfile, Text) -> None
-    """Increases the rate-limit for the specified user"""
-    list_key, set_key, _ = redis_key(user, domain)
-    now = time.time()
-
-    # If we have no rules, we don't store anything
-    if len(rules) == 0:
-        return
 
-    # Start redis transaction
-    with client.pipeline() as pipe:
-        count = 0
-        while True:
-            try:
-                # To avoid a race condition between getting the element we might trim from our list
-                # and removing it from our associated set, we abort this whole transaction if
-                # another agent manages to change our list out from under us
-                # When watching a value, the pipeline is set to Immediate mode
-                pipe.watch(list_key)
-
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(user) - 1)
-
-                # Restart buffered execution
-                pipe.multi()
-
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
-
-                # Trim our list to the oldest rule we have
-                pipe.ltrim(list_key, 0, max_api_calls(user) - 1)
-
-                # Add our new value to the sorted set that we keep
-                # We need to put the score and val both as timestamp,
-                # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
-
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
-
-                # Set the TTL for our keys as well
-                api_window = max_api_window(user)
-                pipe.expire(list_key, api_window)
-                pipe.expire(set_key, api_window)
-
-                pipe.execute()
-
-                # If no exception was raised in the execution, there were no transaction conflicts
-                break
-            except redis.WatchError:
-                if count > 10:
-                    logging.error("Failed to complete incr_ratelimit transaction without interference 10 times "
-                                  "in a row! Aborting rate-limit increment")
-                    break
-                count += 1
-
-                continue
+    if list_key in local_leases:
+        (requests_left, expiry, calls_remaining) = local_leases[list_key]
+        if requests_left > 0 and now < expiry:
+            local_leases[list_key] = (requests_left - 1, expiry, calls_remaining)
+            return False, float(max_window), calls_remaining + requests_left - 1
+        del local_leases[list_key]
+
+    args = [now, max_calls, max_window, max(settings.RATE_LIMITING_LOCAL_LEASE, 1)]  # type: List[Any]
+    for range_seconds, num_requests in rules:
+        args.extend([range_seconds, num_requests])
+    ratelimited, time_till_free, calls_remaining, recorded = \
+        rate_limit_script(keys=[list_key, blocking_key], args=args)
+    if ratelimited:
+        return True, float(time_till_free), 0
+
+    if recorded > 1:
+        # Our extra requests are recorded as having been made now, so we
+        # have to use them within the shortest rule's range.
+        local_leases[list_key] = (recorded - 1, now + rules[0][0], calls_remaining)
+    return False, float(max_window), calls_remaining + recorded - 1
@@ -0,0 +1,196 @@
+from __future__ import absolute_import
+
+# Soft deactivation of long-idle users.
+#
+# In large organizations, most subscribers of a busy stream may not
+# have logged in for months, but every message sent to the stream
+# still costs each of them a UserMessage row.  Users who haven't used
+# Zulip for a long time can be "soft-deactivated" (see the
+# soft_deactivate_users management command): they are marked as
+# long_term_idle, and do_send_messages skips creating UserMessage
+# rows for them for stream messages, unless they are mentioned in the
+# message or it contains one of their alert words.  Private messages
+# are always delivered.
+#
+# When a soft-deactivated user comes back (they register an event
+# queue, which also happens when loading the webapp), we create the
+# UserMessage rows for the stream messages they missed from the
+# streams' history, using the subscription events in RealmAuditLog to
+# work out which messages were sent while they were subscribed.
+# Subscriptions that predate those events are assumed to have been
+# active the whole time if they are active now.
+
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, List, Optional
+
+import datetime
+import logging
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils.timezone import now as timezone_now
+
+from zerver.models import Message, Realm, RealmAuditLog, Recipient, Subscription, \
+    UserActivity, UserMessage, UserProfile
+
+SUBSCRIPTION_EVENT_TYPES = ['subscription_created', 'subscription_activated',
+                            'subscription_deactivated']
+
+def filter_by_subscription_history(messages, subscription_logs, subscribed=False):
+    # type: (List[Dict[str, Any]], List[RealmAuditLog], bool) -> List[Dict[str, Any]]
+    """Returns the messages in `messages` (which are sorted by id) that
+    were sent to a stream while the user was subscribed to it, given the
+    user's subscription events for that stream, sorted by
+    event_last_message_id, and whether the user was subscribed before
+    the first of them."""
+    messages_to_add = []  # type: List[Dict[str, Any]]
+    index = 0
+    for log in subscription_logs:
+        # Messages up to event_last_message_id were sent before this
+        # event, so while the previous subscription state applied.
+        last_message_id = log.event_last_message_id or 0
+        while index < len(messages) and messages[index]['id'] <= last_message_id:
+            if subscribed:
+                messages_to_add.append(messages[index])
+            index += 1
+        subscribed = log.event_type != 'subscription_deactivated'
+    if subscribed:
+        messages_to_add.extend(messages[index:])
+    return messages_to_add
+
+def add_missing_messages(user_profile, max_message_id):
+    # type: (UserProfile, int) -> None
+    """Creates the UserMessage rows for the stream messages up to
+    `max_message_id` that a soft-deactivated user didn't receive."""
+    last_active_message_id = user_profile.last_active_message_id or 0
+    stream_subscriptions = Subscription.objects.filter(
+        user_profile=user_profile,
+        recipient__type=Recipient.STREAM).values('recipient_id', 'recipient__type_id', 'active')
+    stream_ids_by_recipient_id = dict((sub['recipient_id'], sub['recipient__type_id'])
+                                      for sub in stream_subscriptions)
+    active_recipient_ids = set(sub['recipient_id'] for sub in stream_subscriptions
+                               if sub['active'])
+
+    # Sorting by event_last_message_id is what makes
+    # filter_by_subscription_history work.
+    subscription_logs = RealmAuditLog.objects.filter(
+        modified_user=user_profile,
+        modified_stream_id__in=list(stream_ids_by_recipient_id.values()),
+        event_type__in=SUBSCRIPTION_EVENT_TYPES).order_by('event_last_message_id', 'id')
+    subscription_logs_by_stream_id = defaultdict(list)  # type: DefaultDict[int, List[RealmAuditLog]]
+    for log in subscription_logs:
+        subscription_logs_by_stream_id[log.modified_stream_id].append(log)
+
+    # We don't need to look at the history of streams the user left
+    # before being soft-deactivated.
+    recipient_ids = []  # type: List[int]
+    for recipient_id, stream_id in stream_ids_by_recipient_id.items():
+        logs = subscription_logs_by_stream_id[stream_id]
+        if not logs:
+            if recipient_id not in active_recipient_ids:
+                logging.info("Not backfilling stream %s for user %s: no subscription history"
+                             % (stream_id, user_profile.id))
+                continue
+        elif (logs[-1].event_type == 'subscription_deactivated' and
+                (logs[-1].event_last_message_id or 0) <= last_active_message_id):
+            continue
+        recipient_ids.append(recipient_id)
+
+    messages = []  # type: List[Dict[str, Any]]
+    if recipient_ids:
+        messages = list(Message.objects.filter(
+            recipient_id__in=recipient_ids,
+            id__gt=last_active_message_id,
+            id__lte=max_message_id).order_by('id').values('id', 'recipient_id'))
+
+    # Mentioned users get their UserMessage rows when the message is
+    # sent, and this may run more than once, so skip existing rows.
+    existing_message_ids = set(UserMessage.objects.filter(
+        user_profile=user_profile,
+        message_id__gt=last_active_message_id).values_list('message_id', flat=True))
+
+    messages_by_recipient_id = defaultdict(list)  # type: DefaultDict[int, List[Dict[str, Any]]]
+    for message in messages:
+        if message['id'] not in existing_message_ids:
+            messages_by_recipient_id[message['recipient_id']].append(message)
+
+    user_messages = []  # type: List[UserMessage]
+    for recipient_id in recipient_ids:
+        stream_id = stream_ids_by_recipient_id[recipient_id]
+        logs = subscription_logs_by_stream_id[stream_id]
+        # Without any events, the subscription is active (see above).
+        subscribed = not logs
+        for message in filter_by_subscription_history(messages_by_recipient_id[recipient_id],
+                                                      logs, subscribed):
+            user_messages.append(UserMessage(user_profile=user_profile,
+                                             message_id=message['id'],
+                                             flags=0))
+    with transaction.atomic():
+        UserMessage.objects.bulk_create(user_messages)
+        # Later calls only need to look at newer messages.
+        user_profile.last_active_message_id = max_message_id
+        user_profile.save(update_fields=['last_active_message_id'])
+
+def backfill_missing_messages(user_profile):
+    # type: (UserProfile) -> None
+    """Runs add_missing_messages up to the newest message, holding a
+    lock on the user's row so that concurrent backfills don't both
+    create the same rows."""
+    with transaction.atomic():
+        locked_user = UserProfile.objects.select_for_update().get(id=user_profile.id)
+        max_message_id = Message.objects.aggregate(Max('id'))['id__max'] or 0
+        add_missing_messages(locked_user, max_message_id)
+    user_profile.last_active_message_id = locked_user.last_active_message_id
+
+def do_soft_deactivate_users(users):
+    # type: (List[UserProfile]) -> None
+    last_message_ids = dict(UserMessage.objects.filter(
+        user_profile__in=users,
+    ).values('user_profile_id').annotate(
+        last_message_id=Max('message_id'),
+    ).values_list('user_profile_id', 'last_message_id'))
+    event_time = timezone_now()
+    for user_profile in users:
+        if user_profile.long_term_idle:
+            continue
+        user_profile.long_term_idle = True
+        user_profile.last_active_message_id = last_message_ids.get(user_profile.id, 0)
+        user_profile.save(update_fields=['long_term_idle', 'last_active_message_id'])
+        RealmAuditLog.objects.create(realm=user_profile.realm, modified_user=user_profile,
+                                     event_type='user_soft_deactivated', event_time=event_time)
+
+def reactivate_user_if_soft_deactivated(user_profile):
+    # type: (UserProfile) -> None
+    if not user_profile.long_term_idle:
+        return
+    # Clear the flag and commit first, so that messages sent from now
+    # on are delivered normally.  The row lock makes sure only one
+    # request reactivates the user.
+    with transaction.atomic():
+        locked_user = UserProfile.objects.select_for_update().get(id=user_profile.id)
+        if not locked_user.long_term_idle:
+            user_profile.long_term_idle = False
+            return
+        locked_user.long_term_idle = False
+        locked_user.save(update_fields=['long_term_idle'])
+        RealmAuditLog.objects.create(realm=user_profile.realm, modified_user=user_profile,
+                                     event_type='user_soft_activated', event_time=timezone_now())
+    user_profile.long_term_idle = False
+
+    # Then fill in the messages the user missed, up to the newest
+    # message id read after the commit; messages sent later see that
+    # the user is no longer idle.
+    backfill_missing_messages(user_profile)
+
+def get_users_for_soft_deactivation(inactive_for_days, realm=None):
+    # type: (int, Optional[Realm]) -> List[UserProfile]
+    """Returns the active human users who haven't used Zulip (according
+    to UserActivity) in the last `inactive_for_days` days."""
+    cutoff = timezone_now() - datetime.timedelta(days=inactive_for_days)
+    users = UserProfile.objects.filter(is_active=True, is_bot=False, long_term_idle=False,
+                                       date_joined__lt=cutoff)
+    if realm is not None:
+        users = users.filter(realm=realm)
+    users = users.exclude(id__in=UserActivity.objects.filter(
+        last_visit__gte=cutoff).values('user_profile_id'))
+    return list(users.select_related('realm'))
@@ -33,6 +33,7 @@ from zerver.lib.test_helpers import (
 )
 
 from zerver.models import (
+    flush_per_request_caches,
     get_stream,
     get_user,
     get_user_profile_by_email,
@@ -72,6 +73,7 @@ def flush_caches_for_testing():
     # type: () -> None
     global API_KEYS
     API_KEYS = {}
+    flush_per_request_caches()
 
 class UploadSerializeMixin(SerializeMixin):
     """
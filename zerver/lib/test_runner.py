@@ -18,6 +18,7 @@ from django.test.signals import template_rendered
 
 from zerver.lib import test_classes, test_helpers
 from zerver.lib.cache import bounce_key_prefix_for_testing
+from zerver.lib.presence import bounce_presence_key_prefix_for_testing
 from zerver.lib.rate_limiter import bounce_redis_key_prefix_for_testing
 from zerver.lib.test_classes import flush_caches_for_testing
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
@@ -118,6 +119,7 @@ def run_test(test, result):
 
     bounce_key_prefix_for_testing(test_name)
     bounce_redis_key_prefix_for_testing(test_name)
+    bounce_presence_key_prefix_for_testing(test_name)
 
     flush_caches_for_testing()
 
@@ -2,11 +2,173 @@ from __future__ import absolute_import
 
 import logging
 import os
+import select
 import subprocess
+import threading
+import time
+import ujson
+from collections import OrderedDict
 from django.conf import settings
-from typing import Optional, Text
+from typing import Any, Dict, List, Optional, Text, Tuple
+from zerver.lib.cache import cache_get_many, cache_set_many, tex_cache_key
 from zerver.lib.str_utils import force_bytes
 
+# Rendering a formula with cli.js means starting a new node process,
+# which takes hundreds of milliseconds, so instead each Zulip process
+# keeps a long-running KaTeX server (static/third/katex/server.js)
+# that renders batches of formulas sent to it over a pipe.  Rendered
+# formulas are cached, both in a small in-process LRU cache and in the
+# remote cache, keyed on the TeX and whether it's rendered inline.
+#
+# Since bugdown may abandon a render that's taking too long (see
+# zerver/lib/timeout.py), any error or exception during a request to
+# the server, including an asynchronous TimeoutExpired, kills the
+# server, so that a later request can't read a stale response; a new
+# server is started on the next request.
+
+KATEX_TIMEOUT = 3
+TEX_CACHE_SIZE = 1000
+TEX_CACHE_TIMEOUT = 3600 * 24 * 7
+
+# Maps (tex, is_inline) to the rendered HTML, or None for TeX that
+# KaTeX can't render.
+tex_cache = OrderedDict()  # type: Dict[Tuple[Text, bool], Optional[Text]]
+
+def get_katex_path(filename):
+    # type: (str) -> Optional[str]
+    katex_path = os.path.join(settings.STATIC_ROOT, 'third/katex', filename)
+    if not os.path.isfile(katex_path):
+        logging.error("Cannot find KaTeX for latex rendering!")
+        return None
+    return katex_path
+
+class KatexServerError(Exception):
+    pass
+
+class KatexServer(object):
+    def __init__(self, server_path):
+        # type: (str) -> None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(['node', server_path],
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=devnull)
+        self.alive = True
+
+    def read_line(self, deadline):
+        # type: (float) -> bytes
+        stdout_fd = self.process.stdout.fileno()
+        chunks = []  # type: List[bytes]
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise KatexServerError("Timed out after %s seconds" % (KATEX_TIMEOUT,))
+            ready, _, _ = select.select([stdout_fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(stdout_fd, 65536)
+            if not chunk:
+                raise KatexServerError("KaTeX server exited")
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                return b''.join(chunks)
+
+    def render(self, formulas):
+        # type: (List[Tuple[Text, bool]]) -> List[Optional[Text]]
+        request = [dict(tex=tex, display_mode=not is_inline) for (tex, is_inline) in formulas]
+        with self.lock:
+            if not self.alive:
+                raise KatexServerError("KaTeX server was killed")
+            try:
+                self.process.stdin.write(force_bytes(ujson.dumps(request) + '\n'))
+                self.process.stdin.flush()
+                results = ujson.loads(self.read_line(time.time() + KATEX_TIMEOUT).decode('utf-8'))
+            except BaseException:
+                self.kill()
+                raise
+        if len(results) != len(formulas):
+            self.kill()
+            raise KatexServerError("Expected %d results, got %d" % (len(formulas), len(results)))
+        return [result.strip() if result is not None else None for result in results]
+
+    def kill(self):
+        # type: () -> None
+        self.alive = False
+        try:
+            self.process.kill()
+        except OSError:
+            # The server has already exited.
+            pass
+        self.process.wait()
+
+katex_server = None  # type: Optional[KatexServer]
+
+def get_katex_server():
+    # type: () -> Optional[KatexServer]
+    global katex_server
+    # A server belongs to the process that started it; after a fork
+    # (e.g. into a bugdown worker), the new process needs its own.
+    if katex_server is None or not katex_server.alive or katex_server.pid != os.getpid():
+        server_path = get_katex_path('server.js')
+        if server_path is None:
+            return None
+        katex_server = KatexServer(server_path)
+    return katex_server
+
+def render_tex_with_server(formulas):
+    # type: (List[Tuple[Text, bool]]) -> Optional[List[Optional[Text]]]
+    """Renders `formulas` with the KaTeX server, returning None if the
+    server failed (as opposed to KaTeX failing to render a formula)."""
+    try:
+        server = get_katex_server()
+        if server is None:
+            return None
+        return server.render(formulas)
+    except (KatexServerError, EnvironmentError, ValueError):
+        logging.exception("Error rendering %d formulas with the KaTeX server" % (len(formulas),))
+        return None
+
+def remember_rendered_tex(formula, html):
+    # type: (Tuple[Text, bool], Optional[Text]) -> None
+    tex_cache[formula] = html
+    while len(tex_cache) > TEX_CACHE_SIZE:
+        tex_cache.popitem(last=False)
+
+def render_tex_many(formulas):
+    # type: (List[Tuple[Text, bool]]) -> List[Optional[Text]]
+    """Renders a batch of (tex, is_inline) pairs; see render_tex."""
+    results = {}  # type: Dict[Tuple[Text, bool], Optional[Text]]
+    for formula in formulas:
+        if formula in tex_cache:
+            results[formula] = tex_cache[formula]
+            # Mark the formula as recently used.
+            del tex_cache[formula]
+            tex_cache[formula] = results[formula]
+
+    missing = [formula for formula in OrderedDict.fromkeys(formulas) if formula not in results]
+    if missing:
+        keys = dict((tex_cache_key(tex, is_inline), (tex, is_inline)) for (tex, is_inline) in missing)
+        for key, cached in cache_get_many(list(keys.keys())).items():
+            results[keys[key]] = cached[0]
+            remember_rendered_tex(keys[key], cached[0])
+        missing = [formula for formula in missing if formula not in results]
+
+    if missing:
+        rendered = render_tex_with_server(missing)
+        if rendered is None:
+            # Don't cache anything if the server failed.
+            return [results.get(formula) for formula in formulas]
+        items_for_remote_cache = {}  # type: Dict[Text, Any]
+        for (tex, is_inline), html in zip(missing, rendered):
+            results[(tex, is_inline)] = html
+            remember_rendered_tex((tex, is_inline), html)
+            items_for_remote_cache[tex_cache_key(tex, is_inline)] = (html,)
+        cache_set_many(items_for_remote_cache, timeout=TEX_CACHE_TIMEOUT)
+
+    return [results[formula] for formula in formulas]
+
 def render_tex(tex, is_inline=True):
     # type: (Text, bool) -> Optional[Text]
     """Render a TeX string into HTML using KaTeX
@@ -21,10 +183,14 @@ def render_tex(tex, is_inline=True):
                  will show the content centered, and in the "expanded" form
                  (default True)
     """
+    return render_tex_many([(tex, is_inline)])[0]
 
-    katex_path = os.path.join(settings.STATIC_ROOT, 'third/katex/cli.js')
-    if not os.path.isfile(katex_path):
-        logging.error("Cannot find KaTeX for latex rendering!")
+def render_tex_in_subprocess(tex, is_inline=True):
+    # type: (Text, bool) -> Optional[Text]
+    """Like render_tex, but starts a new KaTeX process for the formula,
+    and doesn't use the caches; used by the benchmark_tex command."""
+    katex_path = get_katex_path('cli.js')
+    if katex_path is None:
         return None
     command = ['node', katex_path]
     if not is_inline:
@@ -11,7 +11,6 @@ from django.conf import settings
 from optparse import make_option
 
 import logging
-import time
 
 class Command(BaseCommand):
     help = """Checks redis to make sure our rate limiting system hasn't grown a bug and left redis with a bunch of data
@@ -55,7 +54,6 @@ than max_api_calls! (trying to trim) %s %s" % (key, count))
 
         # Find all keys, and make sure they're all within size constraints
         wildcard_list = "ratelimit:*:*:list"
-        wildcard_zset = "ratelimit:*:*:zset"
 
         trim_func = lambda key, max_calls: client.ltrim(key, 0, max_calls - 1)
         if not options['trim']:
@@ -66,13 +64,3 @@ than max_api_calls! (trying to trim) %s %s" % (key, count))
             self._check_within_range(list_name,
                                      lambda: client.llen(list_name),
                                      trim_func)
-
-        zsets = client.keys(wildcard_zset)
-        for zset in zsets:
-            now = time.time()
-            # We can warn on our zset being too large, but we don't know what
-            # elements to trim. We'd have to go through every list item and take
-            # the intersection. The best we can do is expire it
-            self._check_within_range(zset,
-                                     lambda: client.zcount(zset, 0, now),
-                                     lambda key, max_calls: None)
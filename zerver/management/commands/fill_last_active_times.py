@@ -0,0 +1,26 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from argparse import ArgumentParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.presence import fill_last_active_times
+
+class Command(ZulipBaseCommand):
+    help = """Fill in the last-active times Tornado uses to decide whether
+users are idle from the UserPresence table, for users who don't have one
+yet; see zerver/lib/presence.py.
+
+Usage: ./manage.py fill_last_active_times [-r <realm>]"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        self.add_realm_args(parser)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        num_users = fill_last_active_times(realm)
+        print("Filled in last-active times for %d users." % (num_users,))
@@ -11,12 +11,21 @@ class Command(BaseCommand):
         # type: (ArgumentParser) -> None
         parser.add_argument('--cache', dest="cache", default=None,
                             help="Populate the memcached cache of messages.")
+        parser.add_argument('--processes', dest="processes", type=int, default=1,
+                            help="Number of worker processes to fill each cache with.")
+        parser.add_argument('--shards', dest="shards", type=int, default=None,
+                            help="Number of id ranges to split each cache into "
+                                 "(default: the number of processes).")
+        parser.add_argument('--resume', dest="resume", action="store_true", default=False,
+                            help="Continue an interrupted run, skipping what it already filled.")
 
     def handle(self, *args, **options):
-        # type: (*Any, **str) -> None
+        # type: (*Any, **Any) -> None
         if options["cache"] is not None:
-            fill_remote_cache(options["cache"])
-            return
+            caches = [options["cache"]]
+        else:
+            caches = list(cache_fillers.keys())
 
-        for cache in cache_fillers.keys():
-            fill_remote_cache(cache)
+        for cache in caches:
+            fill_remote_cache(cache, processes=options["processes"],
+                              num_shards=options["shards"], resume=options["resume"])
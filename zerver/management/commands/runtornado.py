@@ -20,8 +20,10 @@ from zerver.lib.debug import interactive_debug_listen
 from zerver.tornado.application import create_tornado_application, \
     setup_tornado_rabbitmq
 from zerver.tornado.event_queue import add_client_gc_hook, \
-    missedmessage_hook, process_notification, setup_event_queue
+    missedmessage_hook, process_notification_batch, setup_event_queue
 from zerver.tornado.socket import respond_send_message
+from zerver.tornado.sharding import get_shard_for_port, is_sharded, \
+    notify_tornado_queue_name, tornado_return_queue_name
 
 import logging
 import sys
@@ -70,6 +72,16 @@ class Command(BaseCommand):
         if not port.isdigit():
             raise CommandError("%r is not a valid port number." % (port,))
 
+        # Each Tornado process in a sharded deployment serves the
+        # event queues for the shard corresponding to its port.
+        shard = 0
+        if is_sharded():
+            try:
+                shard = get_shard_for_port(int(port))
+            except ValueError as e:
+                raise CommandError(str(e))
+        settings.TORNADO_SHARD = shard
+
         xheaders = options.get('xheaders', True)
         no_keep_alive = options.get('no_keep_alive', False)
         quit_command = 'CTRL-C'
@@ -93,8 +105,10 @@ class Command(BaseCommand):
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(notify_tornado_queue_name(shard),
+                                                    process_notification_batch)
+                queue_client.register_json_consumer(tornado_return_queue_name(shard),
+                                                    respond_send_message)
 
             try:
                 # Application is an instance of Django's standard wsgi handler.
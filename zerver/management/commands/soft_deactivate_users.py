@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, List
+
+from argparse import ArgumentParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.soft_deactivation import do_soft_deactivate_users, \
+    get_users_for_soft_deactivation, reactivate_user_if_soft_deactivated
+from zerver.models import UserProfile
+
+class Command(ZulipBaseCommand):
+    help = """Soft-deactivate users who haven't used Zulip in a long time.
+
+Soft-deactivated users don't get UserMessage rows for most stream
+messages until they come back; see zerver/lib/soft_deactivation.py.
+
+Usage: ./manage.py soft_deactivate_users [--days=75] [-r <realm>] [-f]
+       ./manage.py soft_deactivate_users --activate -r <realm> <email> [<email> ...]"""
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('-d', '--days',
+                            dest='days',
+                            type=int,
+                            default=75,
+                            help='Soft-deactivate users who have been idle for this many days')
+        parser.add_argument('-a', '--activate',
+                            dest='activate',
+                            action='store_true',
+                            default=False,
+                            help='Soft-reactivate the given users instead')
+        parser.add_argument('-f', '--for-real',
+                            dest='for_real',
+                            action='store_true',
+                            default=False,
+                            help='Actually soft-deactivate the users. Default is a dry run.')
+        parser.add_argument('emails', metavar='<email>', type=str, nargs='*',
+                            help='Email addresses of users to soft-deactivate or reactivate')
+        self.add_realm_args(parser)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        if options['emails']:
+            users = [self.get_user(email, realm)
+                     for email in options['emails']]  # type: List[UserProfile]
+        elif options['activate']:
+            print("Pass the email addresses of the users to reactivate.")
+            exit(1)
+        else:
+            users = get_users_for_soft_deactivation(options['days'], realm)
+
+        if options['activate']:
+            for user_profile in users:
+                reactivate_user_if_soft_deactivated(user_profile)
+                print("Soft-reactivated %s" % (user_profile.email,))
+            return
+
+        for user_profile in users:
+            print("%s (%s)" % (user_profile.email, user_profile.realm.string_id))
+        if not options['for_real']:
+            print("%d users would be soft-deactivated. This was a dry run; "
+                  "pass -f to actually soft-deactivate them." % (len(users),))
+            exit(1)
+
+        do_soft_deactivate_users(users)
+        print("Soft-deactivated %d users." % (len(users),))
@@ -21,7 +21,9 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     display_recipient_cache_key, cache_delete, \
     get_stream_cache_key, active_user_dicts_in_realm_cache_key, \
     bot_dicts_in_realm_cache_key, active_user_dict_fields, \
-    bot_dict_fields, flush_message, bot_profile_cache_key
+    bot_dict_fields, flush_message, bot_profile_cache_key, \
+    flush_per_request_message_dict_cache, start_local_cache_request, \
+    flush_realm_register_section
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from zerver.lib.str_utils import ModelReprMixin
 from django.db import transaction
@@ -77,6 +79,8 @@ def flush_per_request_caches():
     per_request_display_recipient_cache = {}
     global per_request_realm_filters_cache
     per_request_realm_filters_cache = {}
+    flush_per_request_message_dict_cache()
+    start_local_cache_request()
 
 @cache_with_key(lambda *args: display_recipient_cache_key(args[0]),
                 timeout=3600*24*7)
@@ -494,7 +498,8 @@ def realm_filters_for_realm(realm_id):
         per_request_realm_filters_cache[realm_id] = realm_filters_for_realm_remote_cache(realm_id)
     return per_request_realm_filters_cache[realm_id]
 
-@cache_with_key(get_realm_filters_cache_key, timeout=3600*24*7)
+@cache_with_key(get_realm_filters_cache_key, timeout=3600*24*7,
+                lock_timeout=10, stale_timeout=60, early_recompute_beta=1.0)
 def realm_filters_for_realm_remote_cache(realm_id):
     # type: (int) -> List[Tuple[Text, Text, int]]
     filters = []
@@ -1280,6 +1285,12 @@ class AbstractUserMessage(ModelReprMixin, models.Model):
         # Grep the code for example usage.
         return 'flags & 1 = 0'
 
+    @staticmethod
+    def where_mentioned():
+        # type: () -> str
+        # Like where_unread, for the partial index on mentions.
+        return 'flags & 8 != 0'
+
     def flags_list(self):
         # type: () -> List[str]
         return [flag for flag in self.flags.keys() if getattr(self.flags, flag).is_set]
@@ -1415,6 +1426,15 @@ def get_user_profile_by_id(uid):
     # type: (int) -> UserProfile
     return UserProfile.objects.select_related().get(id=uid)
 
+def bulk_get_user_profiles_by_id(uids):
+    # type: (Iterable[int]) -> Dict[int, UserProfile]
+    """Like get_user_profile_by_id, for many users at once; users that
+    don't exist are left out of the result."""
+    return generic_bulk_cached_fetch(
+        user_profile_by_id_cache_key,
+        lambda uids: UserProfile.objects.select_related().filter(id__in=uids),
+        list(set(uids)))
+
 @cache_with_key(user_profile_by_email_cache_key, timeout=3600*24*7)
 def get_user_profile_by_email(email):
     # type: (Text) -> UserProfile
@@ -1437,13 +1457,13 @@ def get_system_bot(email):
     # type: (Text) -> UserProfile
     return UserProfile.objects.select_related().get(email__iexact=email.strip())
 
-@cache_with_key(active_user_dicts_in_realm_cache_key, timeout=3600*24*7)
+@cache_with_key(active_user_dicts_in_realm_cache_key, timeout=3600*24*7, lock_timeout=10)
 def get_active_user_dicts_in_realm(realm):
     # type: (Realm) -> List[Dict[str, Any]]
     return UserProfile.objects.filter(realm=realm, is_active=True) \
                               .values(*active_user_dict_fields)
 
-@cache_with_key(bot_dicts_in_realm_cache_key, timeout=3600*24*7)
+@cache_with_key(bot_dicts_in_realm_cache_key, timeout=3600*24*7, lock_timeout=10)
 def get_bot_dicts_in_realm(realm):
     # type: (Realm) -> List[Dict[str, Any]]
     return UserProfile.objects.filter(realm=realm, is_bot=True).values(*bot_dict_fields)
@@ -1620,7 +1640,7 @@ class UserPresence(models.Model):
         )
 
         mobile_user_ids = [row['user'] for row in PushDeviceToken.objects.filter(
-            user__realm_id=1,
+            user__realm_id=realm_id,
             user__is_active=True,
             user__is_bot=False,
         ).distinct("user").values("user")]
@@ -1695,6 +1715,13 @@ class DefaultStream(models.Model):
     class Meta(object):
         unique_together = ("realm", "stream")
 
+def flush_default_streams(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    flush_realm_register_section(kwargs['instance'].realm_id, 'realm_default_streams')
+
+post_save.connect(flush_default_streams, sender=DefaultStream)
+post_delete.connect(flush_default_streams, sender=DefaultStream)
+
 class AbstractScheduledJob(models.Model):
     scheduled_timestamp = models.DateTimeField(db_index=True)  # type: datetime.datetime
     # JSON representation of arguments to consumer
@@ -4,13 +4,16 @@ from __future__ import absolute_import
 from django.conf import settings
 from django.test import TestCase, override_settings
 
-from zerver.lib import bugdown
+from zerver.lib import bugdown, tex
 from zerver.lib.actions import (
+    do_change_full_name,
     do_remove_realm_emoji,
     do_set_alert_words,
     get_realm,
 )
 from zerver.lib.alert_words import alert_words_in_realm
+from zerver.lib.bugdown.pool import BugdownWorkerPool, get_bugdown_pool
+from zerver.lib.bugdown.realm_data import AlertWordMatcher, get_realm_bugdown_data
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.message import render_markdown
@@ -39,12 +42,13 @@ from zerver.models import (
 import copy
 import mock
 import os
+import time
 import ujson
 import six
 
 from six.moves import urllib
 from zerver.lib.str_utils import NonBinaryStr
-from typing import Any, AnyStr, Dict, List, Optional, Tuple, Text
+from typing import Any, AnyStr, Dict, List, Optional, Set, Tuple, Text
 
 class FencedBlockPreprocessorTest(TestCase):
     def test_simple_quoting(self):
@@ -692,6 +696,69 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(render(msg, content), "<p>We have a NOTHINGWORD day today!</p>")
         self.assertEqual(msg.user_ids_with_alert_words, set())
 
+    def test_alert_word_matcher(self):
+        # type: () -> None
+        matcher = AlertWordMatcher([u'foo', u'Foo', u'foo bar', u'bar', u'a.b'])
+        self.assertEqual(matcher.find(u'FOO bar'), {u'foo', u'Foo', u'foo bar', u'bar'})
+        self.assertEqual(matcher.find(u'(foo) and a.b!'), {u'foo', u'Foo', u'a.b'})
+        self.assertEqual(matcher.find(u'food barn'), set())
+        self.assertEqual(matcher.find(u'xbar\nfoo\n'), {u'foo', u'Foo'})
+        self.assertEqual(AlertWordMatcher([]).find(u'anything'), set())
+
+    def test_realm_bugdown_data(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        data = get_realm_bugdown_data(realm)
+        self.assertIs(get_realm_bugdown_data(realm), data)
+
+        # Changing a user's alert words rebuilds the realm's data
+        user_profile = self.example_user('othello')
+        do_set_alert_words(user_profile, ["newalertword"])
+        new_data = get_realm_bugdown_data(realm)
+        self.assertIsNot(new_data, data)
+        self.assertIn(u'newalertword', new_data.alert_word_matcher.words)
+
+        # As does creating a stream
+        Stream.objects.create(realm=realm, name=u'newstream')
+        self.assertIn(u'newstream', get_realm_bugdown_data(realm).stream_names)
+
+        # And changing a user's name
+        do_change_full_name(user_profile, u'Othello the Great', user_profile)
+        self.assertIn(u'othello the great', get_realm_bugdown_data(realm).full_names)
+
+    def test_render_cache(self):
+        # type: () -> None
+        user_profile = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+
+        def render(content, realm_alert_words=None):
+            # type: (Text, Optional[Dict[int, List[Text]]]) -> Tuple[Text, Message, int]
+            msg = Message(sender=user_profile, sending_client=get_client("test"))
+            hits = bugdown.get_bugdown_render_cache_hits()
+            rendered = render_markdown(msg, content, realm_alert_words=realm_alert_words,
+                                       message_users={user_profile, hamlet})
+            return rendered, msg, bugdown.get_bugdown_render_cache_hits() - hits
+
+        content = u"cached *content* with an alertword"
+        rendered, msg, hits = render(content)
+        self.assertEqual(hits, 0)
+        rendered_again, msg, hits = render(content)
+        self.assertEqual((rendered_again, hits), (rendered, 1))
+        self.assertEqual(msg.alert_words, set())
+
+        # Alert words are still found on a cache hit
+        realm_alert_words = {hamlet.id: [u'alertword', u'otherword']}
+        rendered_again, msg, hits = render(content, realm_alert_words)
+        self.assertEqual((rendered_again, hits), (rendered, 1))
+        self.assertEqual(msg.alert_words, {u'alertword'})
+
+        # Content with mentions depends on the realm's users, so isn't cached
+        content = u"cached content for @**King Hamlet**"
+        render(content)
+        rendered, msg, hits = render(content)
+        self.assertEqual(hits, 0)
+        self.assertEqual(msg.mentions_user_ids, {hamlet.id})
+
     def test_mention_wildcard(self):
         # type: () -> None
         user_profile = self.example_user('othello')
@@ -1006,6 +1073,98 @@ class BugdownErrorTests(ZulipTestCase):
                 self.send_message(self.example_email("othello"), "Denmark", Recipient.STREAM, message)
 
 
+def fake_render_request(request):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    if request['content'] == 'hang':
+        time.sleep(60)
+    if request['content'] == 'fail':
+        raise ValueError('failed')
+    return dict(rendered_content=request['content'].upper(), pid=os.getpid())
+
+class BugdownWorkerPoolTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.pool = BugdownWorkerPool(2, 1, render_function=fake_render_request)
+
+    def tearDown(self):
+        # type: () -> None
+        self.pool.close()
+
+    def test_render_in_parallel(self):
+        # type: () -> None
+        results = self.pool.render([dict(content=content) for content in ['a', 'b', 'c', 'd']])
+        self.assertEqual([result['rendered_content'] for result in results], ['A', 'B', 'C', 'D'])
+        self.assertEqual({result['pid'] for result in results},
+                         {worker.process.pid for worker in self.pool.workers})
+
+    def test_failures(self):
+        # type: () -> None
+        old_pids = {worker.process.pid for worker in self.pool.workers}
+        with mock.patch('logging.warning') as mock_warning:
+            results = self.pool.render([dict(content='hang'), dict(content='fail'),
+                                        dict(content='ok')])
+        self.assertIn('Timed out', results[0]['error'])
+        self.assertIn('ValueError', results[1]['error'])
+        self.assertEqual(results[2]['rendered_content'], 'OK')
+        self.assertEqual(mock_warning.call_count, 1)
+
+        # The hung worker was killed and replaced
+        self.assertEqual(len(self.pool.workers), 2)
+        self.assertNotEqual({worker.process.pid for worker in self.pool.workers}, old_pids)
+        self.assertEqual(self.pool.render([dict(content='x')])[0]['rendered_content'], 'X')
+
+class BugdownRenderInPoolTest(ZulipTestCase):
+    @override_settings(BUGDOWN_RENDER_PROCESSES=1)
+    def test_render_message_in_pool(self):
+        # type: () -> None
+        # Renders a real message in a forked worker, which has to open
+        # its own database connection to look up the realm's users,
+        # and send back the mentions and alert words it found.
+        othello = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        with mock.patch('zerver.lib.bugdown.pool.bugdown_pool', None):
+            try:
+                rendered = render_markdown(msg, u"@**King Hamlet** has an alertword",
+                                           realm_alert_words={hamlet.id: [u'alertword']},
+                                           message_users={othello, hamlet})
+                pool = get_bugdown_pool()
+                self.assertEqual(len(pool.workers), 1)
+                self.assertNotEqual(pool.workers[0].process.pid, os.getpid())
+            finally:
+                get_bugdown_pool().close()
+        self.assertEqual(rendered,
+                         '<p><span class="user-mention" data-user-email="%s" data-user-id="%s">'
+                         '@King Hamlet</span> has an alertword</p>' % (hamlet.email, hamlet.id))
+        self.assertEqual(msg.mentions_user_ids, {hamlet.id})
+        self.assertEqual(msg.alert_words, {u'alertword'})
+        self.assertFalse(msg.mentions_wildcard)
+
+class TexRenderTest(ZulipTestCase):
+    def test_render_tex_many_caching(self):
+        # type: () -> None
+        tex.tex_cache.clear()
+        with mock.patch('zerver.lib.tex.render_tex_with_server',
+                        return_value=[u'<span>a</span>', None]) as server:
+            self.assertEqual(tex.render_tex_many([(u'a', True), (u'\\bad', False), (u'a', True)]),
+                             [u'<span>a</span>', None, u'<span>a</span>'])
+        self.assertEqual(server.call_args[0][0], [(u'a', True), (u'\\bad', False)])
+
+        # Both the rendered formula and the TeX error are cached, in
+        # this process and in the remote cache.
+        with mock.patch('zerver.lib.tex.render_tex_with_server') as server:
+            self.assertEqual(tex.render_tex(u'a'), u'<span>a</span>')
+            tex.tex_cache.clear()
+            self.assertEqual(tex.render_tex(u'\\bad', is_inline=False), None)
+        self.assertEqual(server.call_count, 0)
+
+        # Failures of the KaTeX server itself aren't cached.
+        with mock.patch('zerver.lib.tex.render_tex_with_server', return_value=None):
+            self.assertEqual(tex.render_tex(u'b'), None)
+        with mock.patch('zerver.lib.tex.render_tex_with_server',
+                        return_value=[u'<span>b</span>']):
+            self.assertEqual(tex.render_tex(u'b'), u'<span>b</span>')
+
 class BugdownAvatarTestCase(ZulipTestCase):
     def test_avatar_with_id(self):
         # type: () -> None
@@ -0,0 +1,281 @@
+from __future__ import absolute_import
+
+import mock
+
+from django.contrib.sessions.models import Session
+from django.test import override_settings
+
+from zerver.lib import cache
+from zerver.lib.cache import (
+    LOCAL_CACHE_INVALIDATION_LOG_LENGTH,
+    acquire_cache_lock,
+    cache_get,
+    cache_get_many,
+    cache_set,
+    cache_with_key,
+    fill_remote_cache_checkpoint_key,
+    generic_bulk_cached_fetch,
+    get_remote_cache_requests,
+    local_cache_invalidate_script,
+    local_cache_invalidation_keys,
+    start_local_cache_request,
+    to_dict_cache_key_id,
+    user_profile_by_id_cache_key,
+)
+from zerver.lib.cache_helpers import (
+    cache_fillers,
+    cache_priority_objects,
+    fill_remote_cache,
+    get_cache_shards,
+    user_cache_items,
+)
+from zerver.lib.test_classes import ZulipTestCase
+from typing import Any, Callable, List
+from zerver.models import Message, UserProfile, flush_per_request_caches, get_user_profile_by_id
+
+@override_settings(LOCAL_CACHE_SIZE=3, LOCAL_CACHE_TIMEOUT=60)
+class LocalCacheTest(ZulipTestCase):
+    def invalidate_from_other_process(self, key):
+        # type: (str) -> None
+        # Logs an invalidation without dropping our own copy, as
+        # another process changing the key would.
+        local_cache_invalidate_script(keys=local_cache_invalidation_keys(),
+                                      args=[LOCAL_CACHE_INVALIDATION_LOG_LENGTH, key])
+
+    def test_local_hits(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        first = get_user_profile_by_id(hamlet.id)
+        requests = get_remote_cache_requests()
+        second = get_user_profile_by_id(hamlet.id)
+        self.assertEqual(get_remote_cache_requests(), requests)
+        self.assertEqual(second.email, hamlet.email)
+        # Callers get their own copy of the object.
+        self.assertIsNot(first, second)
+
+        with mock.patch('zerver.lib.cache.statsd') as statsd:
+            get_user_profile_by_id(hamlet.id)
+        statsd.incr.assert_any_call('cache.local.user_profile_by_id.hit')
+
+        # Keys outside the local key families always go to memcached.
+        cache_set(u'unread_summary:1', 5)
+        requests = get_remote_cache_requests()
+        self.assertEqual(cache_get(u'unread_summary:1'), (5,))
+        self.assertEqual(get_remote_cache_requests(), requests + 1)
+
+    def test_invalidation(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        get_user_profile_by_id(hamlet.id)
+        get_user_profile_by_id(othello.id)
+
+        # Changes in this process apply immediately.
+        hamlet.full_name = u'Prince Hamlet'
+        hamlet.save(update_fields=['full_name'])
+        self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, u'Prince Hamlet')
+
+        # Changes from other processes apply from the next request.
+        key = user_profile_by_id_cache_key(othello.id)
+        cache.get_cache_backend(None).set(cache.KEY_PREFIX + key, (hamlet,))
+        self.invalidate_from_other_process(key)
+        self.assertEqual(get_user_profile_by_id(othello.id).id, othello.id)
+        flush_per_request_caches()
+        self.assertEqual(get_user_profile_by_id(othello.id).id, hamlet.id)
+
+    def test_invalidation_log_trimmed(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        get_user_profile_by_id(hamlet.id)
+        get_user_profile_by_id(othello.id)
+        with mock.patch('zerver.lib.cache.LOCAL_CACHE_INVALIDATION_LOG_LENGTH', 1):
+            cache.invalidate_local_caches([u'bot_profile:a', u'bot_profile:b'])
+            self.assertEqual(len(cache.local_cache), 2)
+            start_local_cache_request()
+            cache_get(u'bot_profile:c')
+        # We missed an invalidation, so everything was dropped.
+        self.assertEqual(len(cache.local_cache), 0)
+
+    def test_size_and_timeout(self):
+        # type: () -> None
+        users = [self.example_user(name) for name in ['hamlet', 'othello', 'iago', 'cordelia']]
+        for user in users:
+            get_user_profile_by_id(user.id)
+        self.assertEqual(list(cache.local_cache.keys()),
+                         [user_profile_by_id_cache_key(user.id) for user in users[1:]])
+
+        cache_get_many([user_profile_by_id_cache_key(users[1].id)])
+        self.assertEqual(list(cache.local_cache.keys())[-1], user_profile_by_id_cache_key(users[1].id))
+
+        with mock.patch('zerver.lib.cache.time.time', return_value=cache.time.time() + 61):
+            requests = get_remote_cache_requests()
+            get_user_profile_by_id(users[1].id)
+            self.assertEqual(get_remote_cache_requests(), requests + 1)
+
+class CacheStampedeTest(ZulipTestCase):
+    def make_cached_function(self, **kwargs):
+        # type: (**Any) -> Callable[[], int]
+        self.computations = 0
+
+        @cache_with_key(lambda: u'stampede_test', **kwargs)
+        def compute():
+            # type: () -> int
+            self.computations += 1
+            return self.computations
+        return compute
+
+    def test_waits_for_lock_holder(self):
+        # type: () -> None
+        compute = self.make_cached_function(timeout=3600, lock_timeout=10)
+        self.assertTrue(acquire_cache_lock(u'stampede_test', 10))
+
+        # Another process fills the key while we wait for it.
+        def fill(seconds):
+            # type: (float) -> None
+            cache_set(u'stampede_test', 42)
+        with mock.patch('zerver.lib.cache.time.sleep', side_effect=fill):
+            self.assertEqual(compute(), 42)
+        self.assertEqual(self.computations, 0)
+
+        # If the lock holder gives up, we compute it ourselves.
+        cache.cache_delete(u'stampede_test')
+        with mock.patch('zerver.lib.cache.time.sleep',
+                        side_effect=lambda seconds: cache.release_cache_lock(u'stampede_test')):
+            self.assertEqual(compute(), 1)
+        self.assertEqual(compute(), 1)
+
+    def test_serves_stale_while_refreshing(self):
+        # type: () -> None
+        compute = self.make_cached_function(timeout=60, lock_timeout=10, stale_timeout=60)
+        self.assertEqual(compute(), 1)
+        later = cache.time.time() + 61
+        with mock.patch('zerver.lib.cache.time.time', return_value=later):
+            self.assertTrue(acquire_cache_lock(u'stampede_test', 10))
+            with mock.patch('zerver.lib.cache.statsd') as statsd:
+                self.assertEqual(compute(), 1)
+            statsd.incr.assert_any_call('cache.stampede_test.stale')
+
+            # Once nobody else is refreshing it, we do.
+            cache.release_cache_lock(u'stampede_test')
+            self.assertEqual(compute(), 2)
+            self.assertEqual(compute(), 2)
+
+    def test_early_recompute(self):
+        # type: () -> None
+        compute = self.make_cached_function(timeout=60, early_recompute_beta=1.0)
+        self.assertEqual(compute(), 1)
+        self.assertEqual(cache_get(u'stampede_test')[0], 1)
+        # The closer to expiry, and the more expensive the value, the
+        # more likely it is to be refreshed early.
+        key = cache.KEY_PREFIX + u'stampede_test'
+        (val, soft_expiry, compute_time) = cache.get_cache_backend(None).get(key)
+        cache.get_cache_backend(None).set(key, (val, soft_expiry, 10))
+        with mock.patch('zerver.lib.cache.random.random', return_value=0.5):
+            self.assertEqual(compute(), 1)
+            with mock.patch('zerver.lib.cache.time.time', return_value=soft_expiry - 5):
+                self.assertEqual(compute(), 2)
+
+    def test_bulk_fetch_locks(self):
+        # type: () -> None
+        queried = []  # type: List[List[int]]
+
+        def query(ids):
+            # type: (List[int]) -> List[int]
+            queried.append(sorted(ids))
+            return ids
+
+        def fetch():
+            # type: () -> Any
+            return generic_bulk_cached_fetch(lambda i: u'stampede_test:%d' % (i,), query,
+                                             [1, 2, 3], id_fetcher=lambda i: i,
+                                             lock_timeout=10)
+
+        self.assertTrue(acquire_cache_lock(u'stampede_test:2', 10))
+        self.assertTrue(acquire_cache_lock(u'stampede_test:3', 10))
+
+        # The holder of 2 fills it; the holder of 3 gives up.
+        def sleep(seconds):
+            # type: (float) -> None
+            cache_set(u'stampede_test:2', 2)
+            cache.release_cache_lock(u'stampede_test:3')
+        with mock.patch('zerver.lib.cache.time.sleep', side_effect=sleep):
+            self.assertEqual(fetch(), {1: 1, 2: 2, 3: 3})
+        self.assertEqual(queried, [[1], [3]])
+
+        self.assertEqual(fetch(), {1: 1, 2: 2, 3: 3})
+        self.assertEqual(len(queried), 2)
+
+class FillRemoteCacheTest(ZulipTestCase):
+    def test_fill(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        fill_remote_cache('user', num_shards=3)
+        self.assertEqual(cache_get(user_profile_by_id_cache_key(hamlet.id))[0].email, hamlet.email)
+        self.assertFalse(cache.redis_client.exists(fill_remote_cache_checkpoint_key('user')))
+
+        message_id = Message.objects.order_by('-id')[0].id
+        fill_remote_cache('message')
+        self.assertIsNotNone(cache_get(to_dict_cache_key_id(message_id, True)))
+
+    def test_shards(self):
+        # type: () -> None
+        user_ids = UserProfile.objects.values_list('id', flat=True)
+        shards = get_cache_shards('user', 3)
+        self.assertEqual(len(shards), 3)
+        # Newest first, and covering every user exactly once.
+        self.assertEqual(shards, sorted(shards, reverse=True))
+        self.assertEqual(sorted(user_id for user_id in user_ids
+                                for (low, high) in shards if low <= user_id <= high),
+                         sorted(user_ids))
+
+    def test_session_shard(self):
+        # type: () -> None
+        Session.objects.all().delete()
+        self.assertEqual(get_cache_shards('session', 3), [])
+
+        # Session keys aren't integers, so sessions are filled as a
+        # single shard.
+        self.login(self.example_email('hamlet'))
+        session = Session.objects.get()
+        self.assertEqual(get_cache_shards('session', 3), [(None, None)])
+        with mock.patch('zerver.lib.cache_helpers.cache_set_many') as cache_set_many:
+            fill_remote_cache('session', num_shards=3)
+        self.assertEqual([list(call[0][0].values()) for call in cache_set_many.call_args_list],
+                         [[session.get_decoded()]])
+
+    def test_priority(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        with mock.patch.dict(cache_priority_objects,
+                             {'user': lambda: UserProfile.objects.filter(id=hamlet.id)}), \
+                mock.patch('zerver.lib.cache_helpers.cache_set_many') as cache_set_many:
+            fill_remote_cache('user')
+        first_items = cache_set_many.call_args_list[0][0][0]
+        self.assertEqual(set(first_items.keys()),
+                         {user_profile_by_id_cache_key(hamlet.id),
+                          cache.user_profile_by_email_cache_key(hamlet.email),
+                          cache.user_profile_cache_key(hamlet.email, hamlet.realm)})
+
+    def test_resume(self):
+        # type: () -> None
+        user_ids = sorted(UserProfile.objects.values_list('id', flat=True))
+
+        def filled_user_ids(calls):
+            # type: (Any) -> List[int]
+            return sorted(user_profile.id for call in calls
+                          for (key, (user_profile,)) in call[0][0].items()
+                          if key.startswith(u'user_profile_by_id:'))
+
+        filler = (lambda: UserProfile.objects.all(), user_cache_items, 3600, 2)
+        with mock.patch.dict(cache_fillers, {'user': filler}), \
+                mock.patch.dict(cache_priority_objects, {}, clear=True):
+            with mock.patch('zerver.lib.cache_helpers.cache_set_many',
+                            side_effect=[None, Exception()]) as cache_set_many:
+                with self.assertRaises(Exception):
+                    fill_remote_cache('user', num_shards=1)
+            self.assertEqual(filled_user_ids(cache_set_many.call_args_list[:1]), user_ids[:2])
+
+            with mock.patch('zerver.lib.cache_helpers.cache_set_many') as cache_set_many:
+                fill_remote_cache('user', resume=True)
+            self.assertEqual(filled_user_ids(cache_set_many.call_args_list), user_ids[2:])
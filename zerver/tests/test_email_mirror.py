@@ -18,7 +18,8 @@ from zerver.models import (
     get_display_recipient,
     get_realm,
     get_stream,
-    Recipient
+    Recipient,
+    UserMessage,
 )
 
 from zerver.lib.actions import (
@@ -31,6 +32,7 @@ from zerver.lib.email_mirror import (
 )
 
 from zerver.lib.digest import handle_digest_email
+from zerver.lib.soft_deactivation import do_soft_deactivate_users
 from zerver.lib.send_email import FromAddress
 from zerver.lib.notifications import (
     handle_missedmessage_emails,
@@ -287,6 +289,29 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertEqual(mock_send_future_email.call_count, 1)
         self.assertEqual(mock_send_future_email.call_args[1]['to_user_id'], user_profile.id)
 
+    @mock.patch('zerver.lib.digest.enough_traffic')
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_digest_for_soft_deactivated_user(self, mock_send_future_email, mock_enough_traffic):
+        # type: (mock.MagicMock, mock.MagicMock) -> None
+        user_profile = self.example_user('hamlet')
+        do_soft_deactivate_users([user_profile])
+        message_id = self.send_message(self.example_email('cordelia'), "Denmark",
+                                       Recipient.STREAM)
+        self.assertFalse(UserMessage.objects.filter(user_profile=user_profile,
+                                                    message_id=message_id).exists())
+
+        cutoff = time.mktime(datetime.datetime(year=2016, month=1, day=1).timetuple())
+        handle_digest_email(user_profile.id, cutoff)
+        self.assertEqual(mock_send_future_email.call_count, 1)
+
+        # The missed stream message was backfilled for the digest, but
+        # the user is still soft-deactivated.
+        self.assertTrue(UserMessage.objects.filter(user_profile=user_profile,
+                                                   message_id=message_id).exists())
+        user_profile.refresh_from_db()
+        self.assertTrue(user_profile.long_term_idle)
+        self.assertEqual(user_profile.last_active_message_id, message_id)
+
 class TestReplyExtraction(ZulipTestCase):
     def test_reply_is_extracted_from_plain(self):
         # type: () -> None
@@ -6,10 +6,12 @@ from __future__ import print_function
 from typing import Any, Callable, Dict, List, Optional, Union, Text, Tuple
 import os
 import shutil
+import tempfile
 
 from django.conf import settings
+from django.db.models import F
 from django.http import HttpRequest, HttpResponse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.timezone import now as timezone_now
 
 from zerver.models import (
@@ -68,13 +70,15 @@ from zerver.lib.actions import (
     do_update_user_presence,
     log_event,
     notify_realm_custom_profile_fields,
+    set_default_streams,
 )
 from zerver.lib.events import (
     apply_events,
     fetch_initial_state_data,
 )
-from zerver.lib.message import render_markdown
-from zerver.lib.test_helpers import POSTRequestMock, get_subscription
+from zerver.lib.cache import cache_delete, cache_get, unread_summary_cache_key
+from zerver.lib.message import get_unread_message_ids_per_recipient, render_markdown
+from zerver.lib.test_helpers import POSTRequestMock, get_subscription, queries_captured
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
@@ -85,8 +89,16 @@ from zerver.lib.validator import (
 
 from zerver.views.events_register import _default_all_public_streams, _default_narrow
 
-from zerver.tornado.event_queue import allocate_client_descriptor, EventQueue
-from zerver.tornado.views import get_events_backend
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import allocate_client_descriptor, ClientDescriptor, \
+    EventQueue, gc_event_queues, missedmessage_hook, split_users_by_shard
+from zerver.tornado.event_encoding import encode_events_response, get_message_json
+from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.journal import EventQueueJournal, journal_filename, read_journal, \
+    read_snapshot, write_snapshot
+from zerver.tornado.sharding import get_queue_id_shard, get_shard_for_port, \
+    get_tornado_uri, get_user_shard, make_queue_id, notify_tornado_queue_name
+from zerver.tornado.views import cleanup_event_queue, get_events_backend
 
 from collections import OrderedDict
 import mock
@@ -236,6 +248,47 @@ class GetEventsTest(ZulipTestCase):
         request = POSTRequestMock(post_data, user_profile)
         return view_func(request, user_profile)
 
+    @override_settings(TORNADO_PROCESSES=2)
+    def test_cleanup_queue_on_other_shard(self):
+        # type: () -> None
+        # A queue_id passed in the body of a DELETE reaches the default
+        # shard, which can't tell it apart from an expired queue
+        # unless it checks the shard prefix.
+        user_profile = self.example_user('hamlet')
+        result = self.tornado_call(cleanup_event_queue, user_profile, {"queue_id": "1:15:3"})
+        self.assert_json_error(result, "queue_id must be passed in the query string")
+
+        with self.assertRaises(BadEventQueueIdError):
+            self.tornado_call(cleanup_event_queue, user_profile, {"queue_id": "0:15:3"})
+
+    @override_settings(EVENT_QUEUE_MAX_EVENTS=2)
+    def test_get_events_overflow(self):
+        # type: () -> None
+        user_profile = self.example_user('hamlet')
+        result = self.tornado_call(get_events_backend, user_profile,
+                                   {"apply_markdown": ujson.dumps(True),
+                                    "event_types": ujson.dumps(["message"]),
+                                    "user_client": "website",
+                                    "dont_block": ujson.dumps(True),
+                                    })
+        queue_id = ujson.loads(result.content)["queue_id"]
+        for i in range(3):
+            self.send_message(self.example_email('othello'), user_profile.email,
+                              Recipient.PERSONAL)
+
+        get_events_query = {"queue_id": queue_id,
+                            "user_client": "website",
+                            "last_event_id": -1,
+                            "dont_block": ujson.dumps(True),
+                            }
+        result = self.tornado_call(get_events_backend, user_profile, get_events_query)
+        events = ujson.loads(result.content)["events"]
+        self.assertEqual(events, [{"id": 3, "type": "resync_required"}])
+
+        get_events_query["last_event_id"] = 3
+        with self.assertRaises(BadEventQueueIdError):
+            self.tornado_call(get_events_backend, user_profile, get_events_query)
+
     def test_get_events(self):
         # type: () -> None
         user_profile = self.example_user('hamlet')
@@ -1629,6 +1682,40 @@ class FetchInitialStateDataTest(ZulipTestCase):
         result = fetch_initial_state_data(user_profile, None, "")
         self.assertTrue(len(result['realm_bots']) > 5)
 
+    def test_realm_register_sections_shared(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        event_types = ['realm_user', 'default_streams']
+        first = fetch_initial_state_data(hamlet, event_types, "")
+
+        # Other users in the realm get the cached sections, without
+        # rebuilding the user dicts.
+        with mock.patch('zerver.lib.events.avatar_url_from_dict') as avatar_url_from_dict:
+            second = fetch_initial_state_data(othello, event_types, "")
+        avatar_url_from_dict.assert_not_called()
+        self.assertEqual(second['realm_users'], first['realm_users'])
+        self.assertEqual(second['realm_default_streams'], first['realm_default_streams'])
+        # Each gets their own copy, since apply_events modifies them.
+        self.assertIsNot(second['realm_users'], first['realm_users'])
+
+        do_change_full_name(othello, u'New Othello', othello)
+        stream = get_stream('Scotland', hamlet.realm)
+        do_add_default_stream(stream)
+        do_change_stream_description(stream, u'New description')
+        state = fetch_initial_state_data(hamlet, event_types, "")
+        self.assertIn(u'New Othello', [user['full_name'] for user in state['realm_users']])
+        self.assertIn(u'New description', [default_stream['description']
+                                           for default_stream in state['realm_default_streams']])
+
+        set_default_streams(hamlet.realm, {'Verona': {'invite_only': False,
+                                                      'description': u''}})
+        state = fetch_initial_state_data(hamlet, event_types, "")
+        default_stream_names = [default_stream['name']
+                                for default_stream in state['realm_default_streams']]
+        self.assertIn('Verona', default_stream_names)
+        self.assertNotIn('Scotland', default_stream_names)
+
     def test_max_message_id_with_no_history(self):
         # type: () -> None
         user_profile = self.example_user('aaron')
@@ -1693,6 +1780,78 @@ class FetchInitialStateDataTest(ZulipTestCase):
         result = get_unread_data()
         self.assertEqual(result['mentions'], [stream_message_id])
 
+    def test_unread_msgs_summary(self):
+        # type: () -> None
+        cordelia = self.example_user('cordelia')
+        user_profile = self.example_user('hamlet')
+        UserMessage.objects.filter(user_profile=user_profile).update(
+            flags=F('flags').bitor(UserMessage.flags.read))
+
+        message_ids = [self.send_message(cordelia.email, "Denmark", Recipient.STREAM, "hello")
+                       for i in range(3)]
+
+        def get_stream_unreads():
+            # type: () -> Dict[Text, List[int]]
+            result = get_unread_message_ids_per_recipient(user_profile)
+            return {obj['topic']: obj['unread_message_ids'] for obj in result['streams']}
+
+        self.assertEqual(get_stream_unreads(), {'test': message_ids})
+
+        # Once the summary is built, only the unread and mentioned
+        # message ids are queried.
+        with queries_captured() as queries:
+            self.assertEqual(get_stream_unreads(), {'test': message_ids})
+        self.assert_length(queries, 2)
+
+        do_update_message_flags(user_profile, 'add', 'read', [message_ids[0]], False, None, None)
+        self.assertEqual(get_stream_unreads(), {'test': message_ids[1:]})
+
+        do_update_message_flags(user_profile, 'remove', 'read', [message_ids[0]], False, None, None)
+        self.assertEqual(get_stream_unreads(), {'test': message_ids})
+
+        message = Message.objects.get(id=message_ids[2])
+        do_update_message(cordelia, message, 'new topic', 'change_one', None, None)
+        self.assertEqual(get_stream_unreads(), {'test': message_ids[:2], 'new topic': message_ids[2:]})
+
+        # A message that is read when its topic changes, but is still in
+        # the cached summary, is moved too once it is unread again.
+        message = Message.objects.get(id=message_ids[1])
+        do_update_message_flags(user_profile, 'add', 'read', [message_ids[1]], False, None, None)
+        do_update_message(cordelia, message, 'newer topic', 'change_one', None, None)
+        do_update_message_flags(user_profile, 'remove', 'read', [message_ids[1]], False, None, None)
+        self.assertEqual(get_stream_unreads(), {'test': message_ids[:1],
+                                                'newer topic': message_ids[1:2],
+                                                'new topic': message_ids[2:]})
+
+    def test_unread_msgs_summary_limits(self):
+        # type: () -> None
+        cordelia = self.example_user('cordelia')
+        user_profile = self.example_user('hamlet')
+        UserMessage.objects.filter(user_profile=user_profile).update(
+            flags=F('flags').bitor(UserMessage.flags.read))
+        message_ids = [self.send_message(cordelia.email, "Denmark", Recipient.STREAM, "hello")
+                       for i in range(3)]
+
+        def get_stream_unreads():
+            # type: () -> Dict[Text, List[int]]
+            result = get_unread_message_ids_per_recipient(user_profile)
+            return {obj['topic']: obj['unread_message_ids'] for obj in result['streams']}
+
+        # Only the newest unread messages are included.
+        with mock.patch('zerver.lib.message.UNREAD_SUMMARY_MAX_MESSAGES', 2):
+            self.assertEqual(get_stream_unreads(), {'test': message_ids[1:]})
+            self.assertEqual(get_stream_unreads(), {'test': message_ids[1:]})
+        self.assertEqual(get_stream_unreads(), {'test': message_ids})
+
+        # Summaries that are too large to cache are computed every time.
+        key = unread_summary_cache_key(user_profile.id)
+        cache_delete(key)
+        with mock.patch('zerver.lib.message.UNREAD_SUMMARY_MAX_BYTES', 1), \
+                mock.patch('logging.warning') as mock_warning:
+            self.assertEqual(get_stream_unreads(), {'test': message_ids})
+        self.assertTrue(mock_warning.called)
+        self.assertIsNone(cache_get(key))
+
 class EventQueueTest(TestCase):
     def test_one_event(self):
         # type: () -> None
@@ -1827,6 +1986,483 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_presence_collapsing(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        queue.push({"type": "presence",
+                    "email": "hamlet@zulip.com",
+                    "server_timestamp": 1,
+                    "presence": {"website": {"status": "active", "timestamp": 1}}})
+        queue.push({"type": "presence",
+                    "email": "othello@zulip.com",
+                    "server_timestamp": 2,
+                    "presence": {"website": {"status": "active", "timestamp": 2}}})
+        queue.push({"type": "presence",
+                    "email": "hamlet@zulip.com",
+                    "server_timestamp": 3,
+                    "presence": {"ZulipMobile": {"status": "idle", "timestamp": 3}}})
+        self.assertEqual(queue.contents(),
+                         [{"id": 1,
+                           "type": "presence",
+                           "email": "othello@zulip.com",
+                           "server_timestamp": 2,
+                           "presence": {"website": {"status": "active", "timestamp": 2}}},
+                          {"id": 2,
+                           "type": "presence",
+                           "email": "hamlet@zulip.com",
+                           "server_timestamp": 3,
+                           "presence": {"website": {"status": "active", "timestamp": 1},
+                                        "ZulipMobile": {"status": "idle", "timestamp": 3}}}])
+
+    def test_collapsing_doesnt_modify_events(self):
+        # type: () -> None
+        # Events are shared by every queue they're sent to.
+        presence_event = {"type": "presence",
+                          "email": "hamlet@zulip.com",
+                          "server_timestamp": 1,
+                          "presence": {"website": {"status": "active", "timestamp": 1}}}
+        flags_event = {"type": "update_message_flags",
+                       "flag": "read",
+                       "operation": "add",
+                       "all": False,
+                       "messages": [1, 2]}
+        queue = EventQueue("1")
+        queue.push(presence_event)
+        queue.push(flags_event)
+        queue.push({"type": "presence",
+                    "email": "hamlet@zulip.com",
+                    "server_timestamp": 2,
+                    "presence": {"ZulipMobile": {"status": "idle", "timestamp": 2}}})
+        queue.push({"type": "update_message_flags",
+                    "flag": "read",
+                    "operation": "add",
+                    "all": False,
+                    "messages": [3]})
+        self.assertEqual(presence_event["presence"],
+                         {"website": {"status": "active", "timestamp": 1}})
+        self.assertEqual(flags_event["messages"], [1, 2])
+
+    def test_typing_collapsing(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        for op in ["start", "stop", "start", "stop"]:
+            queue.push({"type": "typing",
+                        "op": op,
+                        "sender": {"user_id": 1, "email": "hamlet@zulip.com"},
+                        "recipients": [{"user_id": 2, "email": "othello@zulip.com"},
+                                       {"user_id": 1, "email": "hamlet@zulip.com"}]})
+        queue.push({"type": "typing",
+                    "op": "start",
+                    "sender": {"user_id": 1, "email": "hamlet@zulip.com"},
+                    "recipients": [{"user_id": 3, "email": "iago@zulip.com"},
+                                   {"user_id": 1, "email": "hamlet@zulip.com"}]})
+        self.assertEqual([(event["id"], event["op"]) for event in queue.contents()],
+                         [(3, "stop"), (4, "start")])
+
+    def test_update_message_collapsing(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        queue.push({"type": "update_message",
+                    "message_id": 5,
+                    "message_ids": [5],
+                    "flags": [],
+                    "orig_content": "a",
+                    "content": "b",
+                    "edit_timestamp": 1})
+        queue.push({"type": "update_message",
+                    "message_id": 5,
+                    "message_ids": [5],
+                    "orig_subject": "old",
+                    "subject": "new",
+                    "edit_timestamp": 2})
+        queue.push({"type": "update_message",
+                    "message_id": 5,
+                    "message_ids": [5],
+                    "flags": ["mentioned"],
+                    "orig_content": "b",
+                    "content": "c",
+                    "edit_timestamp": 3})
+        events = queue.contents()
+        # Topic edits aren't merged
+        self.assertEqual([event["id"] for event in events], [1, 2])
+        self.assertEqual(events[0]["subject"], "new")
+        self.assertEqual(events[1],
+                         {"id": 2,
+                          "type": "update_message",
+                          "message_id": 5,
+                          "message_ids": [5],
+                          "flags": ["mentioned"],
+                          "orig_content": "a",
+                          "content": "c",
+                          "edit_timestamp": 3})
+
+    @override_settings(EVENT_QUEUE_MAX_EVENTS=3)
+    def test_overflow_event_count(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        for i in range(3):
+            queue.push({"type": "unknown", "timestamp": str(i)})
+        # Virtual events count towards the limit too
+        queue.push({"type": "pointer", "pointer": 1, "timestamp": "1"})
+        self.assertTrue(queue.overflowed)
+        self.assertEqual(queue.contents(), [{'id': 4, 'type': 'resync_required'}])
+
+        # Later events are dropped
+        queue.push({"type": "unknown", "timestamp": "1"})
+        self.assertEqual(queue.contents(), [{'id': 4, 'type': 'resync_required'}])
+
+        # The overflowed state survives a restart
+        queue = EventQueue.from_dict(queue.to_dict())
+        self.assertTrue(queue.overflowed)
+        queue.prune(4)
+        self.assertTrue(queue.empty())
+
+    @override_settings(EVENT_QUEUE_MAX_BYTES=1000)
+    def test_overflow_event_size(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        queue.push({"type": "unknown", "content": "x" * 400})
+        queue.push({"type": "unknown", "content": "x" * 400})
+        self.assertFalse(queue.overflowed)
+        queue.prune(0)
+        queue.push({"type": "unknown", "content": "x" * 400})
+        self.assertFalse(queue.overflowed)
+        # Pointer events replace each other rather than adding up
+        for pointer in range(10):
+            queue.push({"type": "pointer", "pointer": pointer}, size=100)
+        self.assertFalse(queue.overflowed)
+        queue.push({"type": "unknown", "content": "x" * 400})
+        self.assertTrue(queue.overflowed)
+
+class MessageOverlayTest(TestCase):
+    def test_message_overlay(self):
+        # type: () -> None
+        message = {'id': 1, 'content': 'hello'}
+        queue = EventQueue("1")
+        queue.push({'type': 'message',
+                    'message': message,
+                    'flags': ['mentioned'],
+                    'message_overlay': {'is_mentioned': True}})
+        queue.push({'type': 'message',
+                    'message': message,
+                    'flags': []})
+        self.assertEqual(queue.contents(),
+                         [{'id': 0,
+                           'type': 'message',
+                           'flags': ['mentioned'],
+                           'message': {'id': 1, 'content': 'hello', 'is_mentioned': True}},
+                          {'id': 1,
+                           'type': 'message',
+                           'flags': [],
+                           'message': {'id': 1, 'content': 'hello'}}])
+
+        # The shared message dict and the stored events are unchanged
+        self.assertEqual(message, {'id': 1, 'content': 'hello'})
+        self.assertEqual(queue.raw_contents()[0]['message_overlay'], {'is_mentioned': True})
+
+    def test_encode_events_response(self):
+        # type: () -> None
+        message = {'id': 1, 'content': 'hello'}
+        queue = EventQueue("1")
+        queue.push({'type': 'message',
+                    'message': message,
+                    'flags': ['mentioned'],
+                    'message_overlay': {'is_mentioned': True}})
+        queue.push({'type': 'message',
+                    'message': message,
+                    'flags': []})
+        queue.push({'type': 'pointer', 'pointer': 1})
+        encoded = encode_events_response(dict(result='success', msg=''), queue.raw_contents())
+        self.assertEqual(ujson.loads(encoded),
+                         dict(result='success', msg='', events=queue.contents()))
+
+        # The shared message dict is only encoded once
+        self.assertEqual(get_message_json(message), ujson.dumps(message))
+        with mock.patch('zerver.tornado.event_encoding.ujson.dumps') as mock_dumps:
+            get_message_json(message)
+        mock_dumps.assert_not_called()
+
+class EventQueueGCTest(TestCase):
+    def allocate_client(self, last_connection_time, user_profile_id=1):
+        # type: (float, int) -> ClientDescriptor
+        return allocate_client_descriptor(
+            dict(user_profile_id=user_profile_id,
+                 user_profile_email='hamlet@zulip.com',
+                 realm_id=1,
+                 event_types=None,
+                 client_type_name='website',
+                 apply_markdown=True,
+                 all_public_streams=False,
+                 queue_timeout=600,
+                 last_connection_time=last_connection_time,
+                 narrow=[]))
+
+    def test_gc_event_queues(self):
+        # type: () -> None
+        now = time.time()
+        idle_client = self.allocate_client(now - 700)
+        connected_client = self.allocate_client(now - 700)
+        connected_client.current_handler_id = 1
+        reconnected_client = self.allocate_client(now - 700)
+        reconnected_client.last_connection_time = now
+        fresh_client = self.allocate_client(now)
+
+        with mock.patch.object(ClientDescriptor, 'idle', autospec=True,
+                               side_effect=ClientDescriptor.idle) as mock_idle:
+            gc_event_queues()
+        # Queues that can't have expired yet aren't looked at
+        self.assertNotIn(fresh_client, [call[0][0] for call in mock_idle.call_args_list])
+
+        self.assertNotIn(idle_client.event_queue.id, event_queue.clients)
+        for client in [connected_client, reconnected_client, fresh_client]:
+            self.assertIn(client.event_queue.id, event_queue.clients)
+        scheduled = dict((id, expiry) for (expiry, id) in event_queue.gc_heap)
+        self.assertEqual(scheduled[reconnected_client.event_queue.id], now + 600)
+        self.assertLessEqual(scheduled[connected_client.event_queue.id], time.time())
+
+        connected_client.current_handler_id = None
+        gc_event_queues()
+        self.assertNotIn(connected_client.event_queue.id, event_queue.clients)
+        event_queue.do_gc_event_queues({reconnected_client.event_queue.id,
+                                        fresh_client.event_queue.id}, {1}, {1})
+
+    @override_settings(EVENT_QUEUE_MAX_EVENTS=2)
+    def test_gc_overflowed_queue_sends_notifications(self):
+        # type: () -> None
+        client = self.allocate_client(time.time() - 700, user_profile_id=1000)
+        client.add_event(dict(type='message', message={'id': 1}, flags=['mentioned'],
+                              push_notified=True))
+        client.add_event(dict(type='message', message={'id': 2}, flags=[]))
+        client.add_event(dict(type='message', message={'id': 3}, flags=['mentioned', 'read']))
+        self.assertTrue(client.event_queue.overflowed)
+        # Messages sent after the overflow are dropped too
+        client.add_event(dict(type='message', message={'id': 4}, flags=['mentioned']))
+        # The missed notifications survive a restart
+        client.event_queue = EventQueue.from_dict(client.event_queue.to_dict())
+
+        with mock.patch.object(event_queue, 'gc_hooks', [missedmessage_hook]), \
+                mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+            gc_event_queues()
+        self.assertNotIn(client.event_queue.id, event_queue.clients)
+        notifications = [(call[0][0], call[0][1]['message_id'])
+                         for call in mock_publish.call_args_list
+                         if call[0][1]['user_profile_id'] == 1000]
+        self.assertEqual(notifications, [('missedmessage_emails', 1),
+                                         ('missedmessage_mobile_notifications', 4),
+                                         ('missedmessage_emails', 4)])
+
+class EventQueueJournalTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "event_queues.json.journal")
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_journal_round_trip(self):
+        # type: () -> None
+        journal = EventQueueJournal(self.filename, 3)
+        message = {'id': 5, 'content': 'hello'}
+        journal.record_create('1:0', {'user_profile_id': 1})
+        journal.record_event('1:0', {'type': 'message', 'message': message, 'flags': []})
+        journal.record_event('1:1', {'type': 'message', 'message': message, 'flags': ['read']})
+        journal.record_event('1:0', {'type': 'pointer', 'pointer': 5})
+        journal.record_prune('1:0', 0)
+        journal.record_gc(['1:1'])
+        journal.close()
+
+        # The message dict is only written once
+        with open(self.filename) as f:
+            self.assertEqual(f.read().count('hello'), 1)
+
+        records = list(read_journal(self.filename, 3))
+        self.assertEqual([record['op'] for record in records],
+                         ['create', 'event', 'event', 'event', 'prune', 'gc'])
+        self.assertEqual(records[1]['event']['message'], message)
+        self.assertEqual(records[2]['event']['message'], message)
+        self.assertEqual(records[2]['event']['flags'], ['read'])
+
+        # A journal from a different generation is ignored
+        self.assertEqual(list(read_journal(self.filename, 4)), [])
+
+    def test_truncated_journal(self):
+        # type: () -> None
+        journal = EventQueueJournal(self.filename, 0)
+        journal.record_create('1:0', {'user_profile_id': 1})
+        journal.close()
+        with open(self.filename, 'a') as f:
+            f.write('{"op": "ev')
+        records = list(read_journal(self.filename, 0))
+        self.assertEqual([record['op'] for record in records], ['create'])
+
+    def test_snapshot(self):
+        # type: () -> None
+        snapshot_filename = os.path.join(self.tmp_dir, "event_queues.json")
+        write_snapshot(snapshot_filename, 7, [('1:0', {'user_profile_id': 1})])
+        with open(snapshot_filename) as f:
+            self.assertEqual(read_snapshot(f.read()), (7, [['1:0', {'user_profile_id': 1}]]))
+
+        # Snapshots from before the journal existed are plain lists
+        self.assertEqual(read_snapshot('[["1:0", {}]]'), (None, [['1:0', {}]]))
+
+class LoadEventQueuesTest(TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "event_queues.json")
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tmp_dir)
+
+    def client_dict(self, queue_id):
+        # type: (str) -> Dict[str, Any]
+        return ClientDescriptor.from_dict(
+            dict(user_profile_id=1,
+                 user_profile_email='hamlet@zulip.com',
+                 realm_id=1,
+                 event_types=None,
+                 client_type_name='website',
+                 apply_markdown=True,
+                 all_public_streams=False,
+                 queue_timeout=600,
+                 last_connection_time=time.time(),
+                 narrow=[],
+                 event_queue=EventQueue(queue_id).to_dict())).to_dict()
+
+    def load(self):
+        # type: () -> Dict[str, ClientDescriptor]
+        with mock.patch.object(event_queue, 'clients', {}), \
+                mock.patch.object(event_queue, 'user_clients', {}), \
+                mock.patch.object(event_queue, 'realm_clients_all_streams', {}), \
+                mock.patch.object(event_queue, 'gc_heap', []), \
+                mock.patch.object(event_queue, 'journal', None), \
+                mock.patch.object(event_queue, 'EVENT_QUEUE_BACKUP_DIR', self.tmp_dir), \
+                mock.patch('zerver.tornado.event_queue.persistent_queue_filename',
+                           return_value=self.filename):
+            event_queue.load_event_queues()
+            event_queue.journal.close()
+            return event_queue.clients
+
+    def test_replay_journal_record(self):
+        # type: () -> None
+        with mock.patch.object(event_queue, 'clients', {}):
+            replay = event_queue.replay_journal_record
+            replay(dict(op='create', queue_id='1:0', client=self.client_dict('1:0')))
+            replay(dict(op='create', queue_id='1:1', client=self.client_dict('1:1')))
+            for word in ['first', 'second']:
+                replay(dict(op='event', queue_id='1:0', event={'type': 'alert_words', 'alert_words': [word]}))
+            replay(dict(op='prune', queue_id='1:0', through_id=0))
+            replay(dict(op='connect', queue_id='1:0', last_connection_time=1234.5))
+            replay(dict(op='gc', queue_ids=['1:1']))
+            # Records for queues we don't have are ignored.
+            replay(dict(op='event', queue_id='1:2', event={'type': 'alert_words', 'alert_words': []}))
+
+            self.assertEqual(list(event_queue.clients.keys()), ['1:0'])
+            client = event_queue.clients['1:0']
+            self.assertEqual(client.event_queue.contents(),
+                             [{'type': 'alert_words', 'alert_words': ['second'], 'id': 1}])
+            self.assertEqual(client.last_connection_time, 1234.5)
+
+    def test_replay_prunes_coalesced_events(self):
+        # type: () -> None
+        # Coalesced events are only folded into the queue when the
+        # client fetches them, which isn't journaled, so replaying a
+        # prune has to drop them from the virtual events too.
+        with mock.patch.object(event_queue, 'clients', {}):
+            replay = event_queue.replay_journal_record
+            replay(dict(op='create', queue_id='1:0', client=self.client_dict('1:0')))
+            for pointer in [1, 2]:
+                replay(dict(op='event', queue_id='1:0',
+                            event={'type': 'pointer', 'pointer': pointer, 'timestamp': '1'}))
+            replay(dict(op='prune', queue_id='1:0', through_id=1))
+            replay(dict(op='event', queue_id='1:0',
+                        event={'type': 'alert_words', 'alert_words': ['word']}))
+
+            queue = event_queue.clients['1:0'].event_queue
+            self.assertEqual(queue.contents(),
+                             [{'type': 'alert_words', 'alert_words': ['word'], 'id': 2}])
+            self.assertEqual(queue.size_bytes, sum(queue.event_sizes.values()))
+
+    def test_load_snapshot_and_journal(self):
+        # type: () -> None
+        write_snapshot(self.filename, 3, [('1:0', self.client_dict('1:0'))])
+        journal = EventQueueJournal(journal_filename(self.filename), 3)
+        journal.record_event('1:0', {'type': 'alert_words', 'alert_words': ['word']})
+        journal.record_create('1:1', self.client_dict('1:1'))
+        journal.close()
+
+        clients = self.load()
+        self.assertEqual(sorted(clients.keys()), ['1:0', '1:1'])
+        self.assertEqual(clients['1:0'].event_queue.contents(),
+                         [{'type': 'alert_words', 'alert_words': ['word'], 'id': 0}])
+
+        # What was loaded is compacted into a new snapshot, with a new
+        # journal generation, and the old files are kept.
+        with open(self.filename) as f:
+            generation, queues = read_snapshot(f.read())
+        self.assertEqual(generation, 4)
+        self.assertEqual(sorted(qid for (qid, client) in queues), ['1:0', '1:1'])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "event_queues.json.last")))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "event_queues.json.journal.last")))
+
+        # Loading again doesn't replay the old journal on top.
+        clients = self.load()
+        self.assertEqual(len(clients['1:0'].event_queue.contents()), 1)
+
+    def test_load_unreadable_snapshot(self):
+        # type: () -> None
+        with open(self.filename, 'w') as f:
+            f.write('{"journal_generation": 3, "queues": [[')
+        with mock.patch('logging.exception') as mock_exception:
+            clients = self.load()
+        mock_exception.assert_called_once_with("Could not deserialize event queues")
+        self.assertEqual(clients, {})
+        # The unreadable snapshot is kept for recovery.
+        with open(os.path.join(self.tmp_dir, "event_queues.json.last")) as f:
+            self.assertEqual(f.read(), '{"journal_generation": 3, "queues": [[')
+
+class EventQueueShardingTest(TestCase):
+    @override_settings(TORNADO_PROCESSES=3, TORNADO_SERVER='http://127.0.0.1:9993')
+    def test_sharding_helpers(self):
+        # type: () -> None
+        self.assertEqual(get_user_shard(7), 1)
+        self.assertEqual(get_tornado_uri(0), 'http://127.0.0.1:9993')
+        self.assertEqual(get_tornado_uri(2), 'http://127.0.0.1:9995')
+        self.assertEqual(get_shard_for_port(9994), 1)
+        with self.assertRaises(ValueError):
+            get_shard_for_port(9996)
+        self.assertEqual(notify_tornado_queue_name(1), 'notify_tornado_shard1')
+        with self.settings(TORNADO_SHARD=2):
+            self.assertEqual(make_queue_id(15, 3), '2:15:3')
+        self.assertEqual(get_queue_id_shard('2:15:3'), 2)
+        self.assertEqual(get_queue_id_shard('15:3'), None)
+
+    @override_settings(TORNADO_PROCESSES=1)
+    def test_unsharded_helpers(self):
+        # type: () -> None
+        self.assertEqual(make_queue_id(15, 3), '15:3')
+        self.assertEqual(notify_tornado_queue_name(0), 'notify_tornado')
+
+    @override_settings(TORNADO_PROCESSES=2)
+    def test_split_users_by_shard(self):
+        # type: () -> None
+        event = dict(type='pointer', pointer=5)
+        self.assertEqual(split_users_by_shard(event, [1, 2, 3]),
+                         {0: [2], 1: [1, 3]})
+
+        # Public stream messages go to every shard, so that
+        # all_public_streams queues see them.
+        event = dict(type='message', stream_name='Denmark', realm_id=1)
+        self.assertEqual(split_users_by_shard(event, [dict(id=2, flags=[])]),
+                         {0: [dict(id=2, flags=[])], 1: []})
+
+        event = dict(type='message', stream_name='Denmark', realm_id=1, invite_only=True)
+        self.assertEqual(split_users_by_shard(event, [dict(id=2, flags=[])]),
+                         {0: [dict(id=2, flags=[])]})
+
 class TestEventsRegisterAllPublicStreamsDefaults(ZulipTestCase):
     def setUp(self):
         # type: () -> None
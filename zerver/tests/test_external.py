@@ -6,10 +6,14 @@ from django.http import HttpResponse
 
 from zerver.forms import email_is_not_mit_mailing_list
 
+from zerver.lib import rate_limiter
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    block_user,
+    check_and_incr_ratelimit,
     clear_user_history,
     remove_ratelimit_rule,
+    unblock_user,
 )
 
 from zerver.lib.actions import compute_mit_user_fullname
@@ -123,3 +127,39 @@ class RateLimitTests(ZulipTestCase):
             result = self.send_api_message(email, "Good message")
 
             self.assert_json_success(result)
+
+    def test_ratelimit_local_lease(self):
+        # type: () -> None
+        user = self.example_user('hamlet')
+        clear_user_history(user)
+
+        results = []
+        with self.settings(RATE_LIMITING_LOCAL_LEASE=2), \
+                mock.patch('time.time', return_value=time.time()), \
+                mock.patch('zerver.lib.rate_limiter.rate_limit_script',
+                           side_effect=rate_limiter.rate_limit_script) as mock_script:
+            for i in range(6):
+                results.append(check_and_incr_ratelimit(user))
+
+        # The first request reserves a second one, which doesn't need
+        # redis; after that, the user isn't far enough from the limit of
+        # 5 requests per second to reserve more.
+        self.assertEqual(mock_script.call_count, 5)
+        self.assertEqual([ratelimited for (ratelimited, _, _) in results],
+                         [False] * 5 + [True])
+        self.assertEqual([calls_remaining for (_, _, calls_remaining) in results[:5]],
+                         [99, 98, 97, 96, 95])
+        self.assertEqual(results[5][1], 1.0)
+
+    def test_blocked_user(self):
+        # type: () -> None
+        user = self.example_user('hamlet')
+        clear_user_history(user)
+        block_user(user, 60)
+        ratelimited, time_till_free, _ = check_and_incr_ratelimit(user)
+        self.assertTrue(ratelimited)
+        self.assertEqual(time_till_free, 60)
+
+        unblock_user(user)
+        ratelimited, time_till_free, _ = check_and_incr_ratelimit(user)
+        self.assertFalse(ratelimited)
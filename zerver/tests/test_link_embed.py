@@ -201,6 +201,22 @@ class PreviewTestCase(ZulipTestCase):
         msg = Message.objects.select_related("sender").get(id=msg_id)
         self.assertIn(embedded_link, msg.rendered_content)
 
+    @override_settings(INLINE_URL_EMBED_PREVIEW=True)
+    def test_message_event_sent_before_embed_links(self):
+        # type: () -> None
+        # The embed worker's update_message event must not reach
+        # Tornado before the message event itself.
+        calls = mock.Mock()
+        with mock.patch('zerver.lib.actions.send_event_batch') as send_event_batch, \
+                mock.patch('zerver.lib.actions.queue_json_publish') as queue_json_publish:
+            calls.attach_mock(send_event_batch, 'send_event_batch')
+            calls.attach_mock(queue_json_publish, 'queue_json_publish')
+            self.send_message(self.example_email('hamlet'), self.example_email('cordelia'),
+                              Recipient.PERSONAL, subject="url", content='http://test.org/')
+        self.assertEqual([call[0] for call in calls.mock_calls],
+                         ['send_event_batch', 'queue_json_publish'])
+        self.assertEqual(queue_json_publish.call_args[0][0], 'embed_links')
+
     @override_settings(INLINE_URL_EMBED_PREVIEW=True)
     def _send_message_with_test_org_url(self, sender_email, queue_should_run=True, relative_url=False):
         # type: (str, bool, bool) -> Message
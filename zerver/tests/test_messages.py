@@ -8,12 +8,15 @@ from django.utils.timezone import now as timezone_now
 from zerver.lib import bugdown
 from zerver.decorator import JsonableError
 from zerver.lib.test_runner import slow
-from zerver.lib.cache import get_stream_cache_key, cache_delete
+from zerver.lib.cache import get_stream_cache_key, cache_delete, cache_get, \
+    cache_set, stream_subscribers_cache_key
 from zilencer.models import Deployment
 
 from zerver.lib.message import (
     MessageDict,
+    extract_message_dict,
     message_to_dict,
+    stringify_message_dict,
 )
 
 from zerver.lib.test_helpers import (
@@ -23,6 +26,7 @@ from zerver.lib.test_helpers import (
     most_recent_message,
     most_recent_usermessage,
     queries_captured,
+    tornado_redirected_to_list,
 )
 
 from zerver.lib.test_classes import (
@@ -39,11 +43,17 @@ from zerver.models import (
 from zerver.lib.actions import (
     check_message,
     check_send_message,
+    do_deactivate_user,
+    do_send_messages,
     do_set_realm_property,
+    do_update_message,
     extract_recipients,
     do_create_user,
     get_client,
     get_recipient,
+    get_recipient_user_profiles,
+    internal_prep_private_message,
+    internal_prep_stream_message,
 )
 
 from zerver.lib.upload import create_attachment
@@ -55,8 +65,9 @@ import DNS
 import mock
 import time
 import ujson
+import zlib
 from six.moves import range
-from typing import Any, List, Optional, Text
+from typing import Any, List, Mapping, Optional, Set, Text
 
 class TopicHistoryTest(ZulipTestCase):
     def test_topics_history(self):
@@ -490,7 +501,85 @@ class StreamMessagesTest(ZulipTestCase):
         with queries_captured() as queries:
             send_message()
 
-        self.assert_length(queries, 16)
+        self.assert_length(queries, 12)
+
+    def test_send_messages_batch(self):
+        # type: () -> None
+        sender = self.example_user('hamlet')
+        realm = sender.realm
+        for email in [self.example_email("iago"), self.example_email("cordelia")]:
+            self.subscribe_to_stream(email, "Denmark")
+        self.subscribe_to_stream(self.example_email("othello"), "Scotland")
+
+        messages = [
+            internal_prep_stream_message(realm, sender, "Denmark", "batch", "first"),
+            internal_prep_stream_message(realm, sender, "Scotland", "batch", "second"),
+            internal_prep_private_message(realm, sender, self.example_email("othello"), "third"),
+        ]
+        events = []  # type: List[Mapping[str, Any]]
+        with tornado_redirected_to_list(events):
+            message_ids = do_send_messages(messages)
+
+        # All messages in the batch are delivered, in order, by a
+        # single notify_tornado publish.
+        self.assert_length(message_ids, 3)
+        self.assertEqual([event['event']['message'] for event in events], message_ids)
+
+        denmark_user_ids = {user['id'] for user in events[0]['users']}
+        scotland_user_ids = {user['id'] for user in events[1]['users']}
+        pm_user_ids = {user['id'] for user in events[2]['users']}
+        self.assertIn(self.example_user('iago').id, denmark_user_ids)
+        self.assertNotIn(self.example_user('othello').id, denmark_user_ids)
+        self.assertIn(self.example_user('othello').id, scotland_user_ids)
+        self.assertEqual(pm_user_ids, {sender.id, self.example_user('othello').id})
+        self.assertEqual(events[1]['event']['message_dict_no_markdown']['content'], 'second')
+
+    def test_stream_subscriber_cache(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        stream = get_stream('Denmark', realm)
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        iago = self.example_user('iago')
+        othello = self.example_user('othello')
+        self.subscribe_to_stream(iago.email, 'Denmark')
+
+        def subscriber_ids():
+            # type: () -> Set[int]
+            get_recipient_user_profiles(recipient, iago.id)
+            with queries_captured() as queries:
+                users = get_recipient_user_profiles(recipient, iago.id)
+            # After the first fetch, the subscriber list comes from the cache
+            self.assert_length(queries, 0)
+            return {user.id for user in users}
+
+        self.assertIn(iago.id, subscriber_ids())
+        self.assertNotIn(othello.id, subscriber_ids())
+
+        self.subscribe_to_stream(othello.email, 'Denmark')
+        self.assertIn(othello.id, subscriber_ids())
+
+        self.unsubscribe_from_stream(othello.email, 'Denmark', realm)
+        self.assertNotIn(othello.id, subscriber_ids())
+
+        do_deactivate_user(iago)
+        users = get_recipient_user_profiles(recipient, iago.id)
+        self.assertFalse([user for user in users if user.id == iago.id][0].is_active)
+
+        # Changes are applied by deleting the cached list, again once
+        # the transaction commits.
+        key = stream_subscribers_cache_key(recipient.id)
+        with mock.patch('zerver.lib.cache.transaction.on_commit') as on_commit:
+            self.subscribe_to_stream(othello.email, 'Denmark')
+        self.assertIsNone(cache_get(key))
+        cache_set(key, [])
+        for call in on_commit.call_args_list:
+            call[0][0]()
+        self.assertIsNone(cache_get(key))
+
+        # The cached lists match what the database says
+        cache_delete(stream_subscribers_cache_key(recipient.id))
+        uncached_ids = {user.id for user in get_recipient_user_profiles(recipient, iago.id)}
+        self.assertEqual(subscriber_ids(), uncached_ids)
 
     def test_stream_message_dict(self):
         # type: () -> None
@@ -722,6 +811,70 @@ class MessageDictTest(ZulipTestCase):
         self.assertEqual(msg_dict['reactions'][0]['user']['full_name'],
                          sender.full_name)
 
+    def test_stringify_message_dict(self):
+        # type: () -> None
+        sender = self.example_user('othello')
+        stream_id = self.send_message(sender.email, "Verona", Recipient.STREAM,
+                                      content="hello **world**")
+        pm_id = self.send_message(sender.email, self.example_email('hamlet'), Recipient.PERSONAL,
+                                  content="x" * 5000)
+        stream_message = Message.objects.get(id=stream_id)
+        stream_message.last_edit_time = timezone_now()
+        stream_message.edit_history = ujson.dumps([dict(user_id=sender.id, timestamp=1,
+                                                        prev_content="hello")])
+        pm_message = Message.objects.get(id=pm_id)
+        Reaction.objects.create(user_profile=sender, message=pm_message,
+                                emoji_name='simple_smile')
+
+        for message in [stream_message, pm_message]:
+            for apply_markdown in [True, False]:
+                message_dict = MessageDict.to_dict_uncached_helper(message, apply_markdown)
+                message_bytes = stringify_message_dict(message_dict)
+                self.assertEqual(extract_message_dict(message_bytes), message_dict)
+
+                # Entries in the old format are still read correctly.
+                legacy_bytes = zlib.compress(ujson.dumps(message_dict).encode('utf-8'))
+                self.assertEqual(extract_message_dict(legacy_bytes), message_dict)
+
+        # Only large messages are compressed.
+        message_dict = MessageDict.to_dict_uncached_helper(stream_message, True)
+        self.assertIn('stream_id', message_dict)
+        self.assertIn('edit_history', message_dict)
+        self.assertEqual(stringify_message_dict(message_dict)[:1], b'\x01')
+        message_dict = MessageDict.to_dict_uncached_helper(pm_message, False)
+        self.assertEqual(stringify_message_dict(message_dict)[:1], b'\x02')
+
+    def test_message_to_dict_per_request_cache(self):
+        # type: () -> None
+        message_id = self.send_message(self.example_email('othello'), "Verona", Recipient.STREAM,
+                                       content="hello")
+        message = Message.objects.get(id=message_id)
+        flush_per_request_caches()
+        with mock.patch('zerver.lib.message.extract_message_dict',
+                        wraps=extract_message_dict) as extract_mock:
+            first = message_to_dict(message, False)
+            first['flags'] = ['read']
+            second = message_to_dict(message, False)
+        self.assertEqual(extract_mock.call_count, 1)
+        self.assertNotIn('flags', second)
+        self.assertEqual(second['content'], 'hello')
+
+        # Saving the message drops it from the per-request cache.
+        message.content = 'goodbye'
+        message.save()
+        self.assertEqual(message_to_dict(message, False)['content'], 'goodbye')
+
+        # So does moving it to another topic along with an earlier
+        # message, which updates it without saving it.
+        othello = self.example_user('othello')
+        first_id = self.send_message(othello.email, "Verona", Recipient.STREAM, subject="lunch")
+        second_id = self.send_message(othello.email, "Verona", Recipient.STREAM, subject="lunch")
+        second = Message.objects.get(id=second_id)
+        self.assertEqual(message_to_dict(second, False)['subject'], 'lunch')
+        do_update_message(othello, Message.objects.get(id=first_id), 'dinner',
+                          'change_later', None, None)
+        self.assertEqual(message_to_dict(second, False)['subject'], 'dinner')
+
 
 class SewMessageAndReactionTest(ZulipTestCase):
     def test_sew_messages_and_reaction(self):
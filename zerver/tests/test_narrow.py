@@ -34,13 +34,15 @@ from zerver.lib.test_classes import (
 )
 from zerver.views.messages import (
     exclude_muting_conditions,
-    get_messages_backend, ok_to_include_history,
+    add_narrow_conditions, get_base_query,
+    get_messages_backend, get_messages_page_backend, ok_to_include_history,
     NarrowBuilder, BadNarrowOperator, Query,
-    LARGER_THAN_MAX_MESSAGE_ID,
+    LARGER_THAN_MAX_MESSAGE_ID, MAX_MESSAGES_PER_PAGE,
 )
 
 from typing import Dict, List, Mapping, Sequence, Tuple, Generic, Union, Any, Text
 from six.moves import range
+import mock
 import os
 import re
 import ujson
@@ -1434,3 +1436,150 @@ class GetOldMessagesTest(ZulipTestCase):
             ('<p>How are you doing, <span class="user-mention" data-user-email="%s" data-user-id="6">' +
              '@<span class="highlight">Othello</span>, the Moor of Venice</span>?</p>') % (
                  self.example_email("othello"),))
+
+class GetMessagesPageTest(ZulipTestCase):
+
+    def get_page(self, params):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        result = self.client_get("/json/messages/page", params)
+        self.assert_json_success(result)
+        return ujson.loads(result.content)
+
+    def get_all_pages(self, params):
+        # type: (Dict[str, Any]) -> List[List[int]]
+        pages = []  # type: List[List[int]]
+        while True:
+            page = self.get_page(params)
+            pages.append([message['id'] for message in page['messages']])
+            if page['cursor'] is None:
+                return pages
+            params = dict(cursor=page['cursor'], num_messages=params['num_messages'])
+
+    def test_newer_pages(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        ids = [m.id for m in get_user_messages(self.example_user('hamlet'))]
+        pages = self.get_all_pages(dict(anchor=ids[-7], num_messages=3))
+        self.assertEqual(pages, [ids[-7:-4], ids[-4:-1], ids[-1:]])
+
+        # A full last page is followed by an empty one.
+        pages = self.get_all_pages(dict(anchor=ids[-6], num_messages=3))
+        self.assertEqual(pages, [ids[-6:-3], ids[-3:], []])
+
+    def test_older_pages(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        ids = [m.id for m in get_user_messages(self.example_user('hamlet'))]
+        page = self.get_page(dict(direction='older', num_messages=2))
+        self.assertEqual([m['id'] for m in page['messages']], [ids[-1], ids[-2]])
+        page = self.get_page(dict(cursor=page['cursor'], num_messages=3))
+        self.assertEqual([m['id'] for m in page['messages']], [ids[-3], ids[-4], ids[-5]])
+
+        pages = self.get_all_pages(dict(direction='older', anchor=ids[4], num_messages=3))
+        self.assertEqual(pages, [ids[4:1:-1], ids[1::-1]])
+
+    def test_narrow(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        othello = self.example_email("othello")
+        for i in range(3):
+            self.send_message(othello, self.example_email("hamlet"), Recipient.PERSONAL)
+        narrow = ujson.dumps([dict(operator='pm-with', operand=othello)])
+        pages = self.get_all_pages(dict(narrow=narrow, direction='older', num_messages=2))
+
+        result = self.client_get("/json/messages", dict(narrow=narrow, anchor=LARGER_THAN_MAX_MESSAGE_ID,
+                                                        num_before=1000, num_after=0))
+        ids = [m['id'] for m in ujson.loads(result.content)['messages']]
+        self.assertEqual(sum(pages, []), list(reversed(ids)))
+
+    def test_narrow_not_modified(self):
+        # type: () -> None
+        # The narrow is saved in the cursor after it's applied, so
+        # applying it mustn't combine the search terms in place.
+        user_profile = self.example_user('hamlet')
+        narrow = [dict(operator='search', operand='lunch'),
+                  dict(operator='search', operand='plans')]
+        query, inner_msg_id_col = get_base_query(user_profile, narrow, False, need_flags=False)
+        query, is_search = add_narrow_conditions(user_profile, inner_msg_id_col, query, narrow)
+        self.assertTrue(is_search)
+        self.assertEqual(narrow, [dict(operator='search', operand='lunch'),
+                                  dict(operator='search', operand='plans')])
+
+    def test_first_unread_anchor(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        self.send_message(self.example_email("othello"), "Scotland", Recipient.STREAM)
+        first_unread_id = self.send_message(self.example_email("othello"),
+                                            self.example_email("hamlet"), Recipient.PERSONAL)
+        self.send_message(self.example_email("othello"), self.example_email("hamlet"),
+                          Recipient.PERSONAL)
+        page = self.get_page(dict(use_first_unread_anchor='true', num_messages=10))
+        self.assertEqual(page['messages'][0]['id'], first_unread_id)
+        self.assertEqual(len(page['messages']), 2)
+        self.assertIsNone(page['cursor'])
+
+    def test_page_queries(self):
+        # type: () -> None
+        user_profile = self.example_user('hamlet')
+        request = POSTRequestMock(dict(num_messages=5), user_profile)
+        result = get_messages_page_backend(request, user_profile)
+        cursor = ujson.loads(result.content)['cursor']
+        last_id = [m.id for m in get_user_messages(user_profile)][4]
+
+        request = POSTRequestMock(dict(cursor=cursor, num_messages=5), user_profile)
+        with queries_captured() as queries:
+            get_messages_page_backend(request, user_profile)
+        queries = [q for q in queries if '/* get_messages */' in q['sql']]
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertNotIn('UNION', sql)
+        self.assertIn('WHERE user_profile_id = %d AND message_id > %d ORDER BY message_id ASC'
+                      % (user_profile.id, last_id), sql)
+
+    def test_streamed_response(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        ids = [m.id for m in get_user_messages(self.example_user('hamlet'))]
+        with mock.patch('zerver.views.messages.STREAM_CHUNK_SIZE', 2):
+            result = self.client_get("/json/messages/page",
+                                     dict(anchor=ids[-5], num_messages=4, stream='true'))
+            self.assertEqual(result.status_code, 200)
+            self.assertTrue(result.streaming)
+            data = ujson.loads(b''.join(result.streaming_content))
+        self.assertEqual(data['result'], 'success')
+        self.assertEqual([m['id'] for m in data['messages']], ids[-5:-1])
+
+        page = self.get_page(dict(cursor=data['cursor'], num_messages=4))
+        self.assertEqual([m['id'] for m in page['messages']], ids[-1:])
+        self.assertIsNone(page['cursor'])
+
+        with mock.patch('zerver.views.messages.STREAM_CHUNK_SIZE', 2):
+            result = self.client_get("/json/messages/page",
+                                     dict(anchor=ids[-3], num_messages=10, stream='true'))
+            data = ujson.loads(b''.join(result.streaming_content))
+        self.assertEqual([m['id'] for m in data['messages']], ids[-3:])
+        self.assertIsNone(data['cursor'])
+
+    def test_bad_params(self):
+        # type: () -> None
+        self.login(self.example_email("hamlet"))
+        result = self.client_get("/json/messages/page", dict(direction='sideways'))
+        self.assert_json_error(result, "Invalid direction")
+
+        result = self.client_get("/json/messages/page", dict(num_messages=MAX_MESSAGES_PER_PAGE + 1))
+        self.assert_json_error(result, "Too many messages requested (maximum %d)." % (
+            MAX_MESSAGES_PER_PAGE,))
+
+        for stream in [False, True]:
+            result = self.client_get("/json/messages/page",
+                                     dict(num_messages=0, stream=ujson.dumps(stream)))
+            self.assert_json_error(result, "num_messages must be at least 1")
+
+        result = self.client_get("/json/messages/page", dict(cursor='not a cursor'))
+        self.assert_json_error(result, "Invalid cursor")
+
+        # Cursors only work for the user they were issued to.
+        page = self.get_page(dict(num_messages=1))
+        self.login(self.example_email("othello"))
+        result = self.client_get("/json/messages/page", dict(cursor=page['cursor']))
+        self.assert_json_error(result, "Invalid cursor")
@@ -8,6 +8,7 @@ from mock import mock
 
 from typing import Any, Dict
 from zerver.lib.actions import do_deactivate_user
+from zerver.lib.presence import fill_last_active_times, get_last_active_times
 from zerver.lib.test_helpers import (
     make_client,
     queries_captured,
@@ -16,6 +17,7 @@ from zerver.lib.test_classes import (
     ZulipTestCase,
 )
 from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.tornado.event_queue import receiver_is_idle
 from zerver.models import (
     email_to_domain,
     Client,
@@ -26,6 +28,7 @@ from zerver.models import (
 )
 
 import datetime
+import time
 import ujson
 
 class ActivityTest(ZulipTestCase):
@@ -210,6 +213,71 @@ class UserPresenceTests(ZulipTestCase):
         for email in json['presences'].keys():
             self.assertEqual(email_to_domain(email), 'zulip.com')
 
+    def test_last_active_time(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        UserPresence.objects.filter(user_profile=hamlet).delete()
+        self.assertEqual(get_last_active_times([hamlet.id]), {})
+
+        # Users who have presence data but were never active are idle
+        self.login(hamlet.email)
+        self.client_post("/json/users/me/presence", {'status': 'idle'})
+        self.assertEqual(get_last_active_times([hamlet.id]), {hamlet.id: 0})
+
+        self.client_post("/json/users/me/presence", {'status': 'active'})
+        last_active_time = get_last_active_times([hamlet.id])[hamlet.id]
+        self.assertAlmostEqual(last_active_time, time.time(), delta=5)
+        self.assertEqual(get_last_active_times([]), {})
+
+        # Presence is disabled in zephyr mirror realms
+        espuser = self.mit_user("espuser")
+        self.login(espuser.email)
+        self.client_post("/json/users/me/presence", {'status': 'active'})
+        self.assertEqual(get_last_active_times([hamlet.id, espuser.id]),
+                         {hamlet.id: last_active_time})
+
+    def test_fill_last_active_times(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        UserPresence.objects.filter(user_profile__in=[hamlet, othello]).delete()
+        active_time = timezone_now() - datetime.timedelta(minutes=10)
+        UserPresence.objects.create(user_profile=hamlet, client=make_client('website'),
+                                    timestamp=active_time, status=UserPresence.ACTIVE)
+        UserPresence.objects.create(user_profile=hamlet, client=make_client('ZulipAndroid'),
+                                    timestamp=timezone_now(), status=UserPresence.IDLE)
+
+        # Tornado never falls back to the database.
+        with queries_captured() as queries:
+            self.assertEqual(get_last_active_times([hamlet.id, othello.id]), {})
+        self.assertEqual(len(queries), 0)
+
+        fill_last_active_times(hamlet.realm)
+        expected = {hamlet.id: datetime_to_timestamp(active_time)}
+        self.assertEqual(get_last_active_times([hamlet.id, othello.id]), expected)
+
+        # Existing times aren't overwritten.
+        UserPresence.objects.filter(user_profile=hamlet).update(timestamp=timezone_now())
+        fill_last_active_times()
+        self.assertEqual(get_last_active_times([hamlet.id, othello.id]), expected)
+
+    def test_receiver_is_idle(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        now = int(time.time())
+        with mock.patch('zerver.tornado.event_queue.get_client_descriptors_for_user',
+                        return_value=[]):
+            self.assertTrue(receiver_is_idle(hamlet.id, None))
+            self.assertTrue(receiver_is_idle(hamlet.id, now))
+
+        client = mock.Mock()
+        client.accepts_messages.return_value = True
+        with mock.patch('zerver.tornado.event_queue.get_client_descriptors_for_user',
+                        return_value=[client]):
+            self.assertFalse(receiver_is_idle(hamlet.id, None))
+            self.assertFalse(receiver_is_idle(hamlet.id, now))
+            self.assertTrue(receiver_is_idle(hamlet.id, now - 200))
+
 class SingleUserPresenceTests(ZulipTestCase):
     def test_single_user_get(self):
         # type: () -> None
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import datetime
 import os
 import time
 import ujson
@@ -8,12 +9,15 @@ import ujson
 from django.conf import settings
 from django.http import HttpResponse
 from django.test import TestCase
+from django.utils.timezone import now as timezone_now
 from mock import patch
 from typing import Any, Callable, Dict, List, Mapping, Tuple
 
-from zerver.lib.test_helpers import simulated_queue_client
+from zerver.lib.actions import bulk_update_user_activity, bulk_update_user_presence
+from zerver.lib.test_helpers import simulated_queue_client, tornado_redirected_to_list
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import get_client, UserActivity
+from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.models import get_client, UserActivity, UserActivityInterval, UserPresence
 from zerver.worker import queue_processors
 
 class WorkerTest(ZulipTestCase):
@@ -33,6 +37,12 @@ class WorkerTest(ZulipTestCase):
                 callback = self.consumers[queue_name]
                 callback(data)
 
+        def drain_queue(self, queue_name, json):
+            # type: (str, bool) -> List[Dict[str, Any]]
+            events = [data for (name, data) in self.queue if name == queue_name]
+            self.queue = [(name, data) for (name, data) in self.queue if name != queue_name]
+            return events
+
     def test_mirror_worker(self):
         # type: () -> None
         fake_client = self.FakeClient()
@@ -83,7 +93,7 @@ class WorkerTest(ZulipTestCase):
         with simulated_queue_client(lambda: fake_client):
             worker = queue_processors.UserActivityWorker()
             worker.setup()
-            worker.start()
+            worker.process_one_batch()
             activity_records = UserActivity.objects.filter(
                 user_profile = user.id,
                 client = get_client('ios')
@@ -91,6 +101,95 @@ class WorkerTest(ZulipTestCase):
             self.assertTrue(len(activity_records), 1)
             self.assertTrue(activity_records[0].count, 1)
 
+        # Events for the same user, client and query are coalesced
+        for i in range(3):
+            fake_client.queue.append(('user_activity', dict(data, time=data['time'] + i)))
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            worker.process_one_batch()
+        activity = UserActivity.objects.get(user_profile=user, client=get_client('ios'),
+                                            query='send_message')
+        self.assertEqual(activity.count, 4)
+        self.assertEqual(datetime_to_timestamp(activity.last_visit), int(data['time']) + 2)
+
+    def test_UserPresenceWorker(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        user = self.example_user('hamlet')
+        UserPresence.objects.filter(user_profile=user).delete()
+        now = int(time.time())
+        for (offset, status) in [(0, 'active'), (20, 'active'), (10, 'idle')]:
+            fake_client.queue.append(('user_presence', dict(
+                user_profile_id = user.id,
+                client = 'website',
+                time = now + offset,
+                status = UserPresence.status_from_string(status),
+            )))
+            fake_client.queue.append(('user_activity_interval', dict(
+                user_profile_id = user.id,
+                time = now + offset,
+            )))
+        # Events for users that no longer exist are dropped
+        fake_client.queue.append(('user_presence', dict(
+            user_profile_id = 999999, client = 'website', time = now, status = UserPresence.ACTIVE)))
+
+        events = []  # type: List[Mapping[str, Any]]
+        with simulated_queue_client(lambda: fake_client), \
+                tornado_redirected_to_list(events):
+            for worker in [queue_processors.UserPresenceWorker(),
+                           queue_processors.UserActivityIntervalWorker()]:
+                worker.setup()
+                worker.process_one_batch()
+        self.assertEqual(fake_client.queue, [])
+
+        # Only the newest update is recorded, and the user appears online once
+        presence = UserPresence.objects.get(user_profile=user)
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+        self.assertEqual(datetime_to_timestamp(presence.timestamp), now + 20)
+        self.assertEqual([event['event']['type'] for event in events], ['presence'])
+
+        interval = UserActivityInterval.objects.filter(user_profile=user).order_by('-end')[0]
+        self.assertEqual(datetime_to_timestamp(interval.start), now)
+        self.assertEqual(interval.end - interval.start,
+                         UserActivityInterval.MIN_INTERVAL_LENGTH + datetime.timedelta(seconds=20))
+
+    def test_insert_conflicts(self):
+        # type: () -> None
+        user = self.example_user('hamlet')
+        client = get_client('website')
+        UserActivity.objects.filter(user_profile=user).delete()
+        UserPresence.objects.filter(user_profile=user).delete()
+        UserActivity.objects.create(user_profile=user, client=client, query='send_message',
+                                    count=1, last_visit=timezone_now())
+        UserPresence.objects.create(user_profile=user, client=client, timestamp=timezone_now(),
+                                    status=UserPresence.IDLE)
+
+        # Pretend that another worker inserted the rows just after our
+        # first SELECT; the INSERT fails and the batch is retried.
+        def miss_once(queryset_method):
+            # type: (Callable[..., Any]) -> Callable[..., Any]
+            calls = []  # type: List[bool]
+
+            def method(*args, **kwargs):
+                # type: (*Any, **Any) -> Any
+                calls.append(True)
+                if len(calls) == 1:
+                    return queryset_method(*args, **kwargs).none()
+                return queryset_method(*args, **kwargs)
+            return method
+
+        with patch.object(UserActivity.objects, 'select_for_update',
+                          miss_once(UserActivity.objects.select_for_update)):
+            bulk_update_user_activity([(user, client, 'send_message', timezone_now())])
+        self.assertEqual(UserActivity.objects.get(user_profile=user, client=client).count, 2)
+
+        with patch.object(UserPresence.objects, 'select_related',
+                          miss_once(UserPresence.objects.select_related)):
+            bulk_update_user_presence([(user, client, timezone_now(), UserPresence.ACTIVE)])
+        self.assertEqual(UserPresence.objects.get(user_profile=user, client=client).status,
+                         UserPresence.ACTIVE)
+
     def test_error_handling(self):
         # type: () -> None
         processed = []
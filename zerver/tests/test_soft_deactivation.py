@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import datetime
+
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.soft_deactivation import do_soft_deactivate_users, \
+    get_users_for_soft_deactivation, reactivate_user_if_soft_deactivated
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.models import Client, Message, RealmAuditLog, Recipient, UserActivity, \
+    UserMessage, UserProfile, get_stream
+
+class SoftDeactivationTest(ZulipTestCase):
+    def get_user_message(self, user_profile, message_id):
+        # type: (UserProfile, int) -> UserMessage
+        return UserMessage.objects.filter(user_profile=user_profile,
+                                          message_id=message_id).first()
+
+    def test_messages_skipped_and_backfilled(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        cordelia_email = self.example_email('cordelia')
+        do_soft_deactivate_users([hamlet])
+        hamlet.refresh_from_db()
+        self.assertTrue(hamlet.long_term_idle)
+
+        stream_message_id = self.send_message(cordelia_email, "Denmark", Recipient.STREAM)
+        mention_message_id = self.send_message(cordelia_email, "Denmark", Recipient.STREAM,
+                                               u"@**King Hamlet** hi")
+        private_message_id = self.send_message(cordelia_email, hamlet.email, Recipient.PERSONAL)
+        self.assertIsNone(self.get_user_message(hamlet, stream_message_id))
+        self.assertTrue(self.get_user_message(hamlet, mention_message_id).flags.mentioned)
+        self.assertIsNotNone(self.get_user_message(hamlet, private_message_id))
+
+        # Messages sent to streams after the user left aren't backfilled
+        self.unsubscribe_from_stream(hamlet.email, "Scotland", hamlet.realm)
+        unsubscribed_message_id = self.send_message(cordelia_email, "Scotland", Recipient.STREAM)
+
+        reactivate_user_if_soft_deactivated(hamlet)
+        hamlet.refresh_from_db()
+        self.assertFalse(hamlet.long_term_idle)
+        user_message = self.get_user_message(hamlet, stream_message_id)
+        self.assertFalse(user_message.flags.read)
+        self.assertIsNone(self.get_user_message(hamlet, unsubscribed_message_id))
+
+        self.assertEqual(hamlet.last_active_message_id,
+                         Message.objects.order_by('-id').first().id)
+
+        # Once reactivated, messages are delivered as usual
+        new_message_id = self.send_message(cordelia_email, "Denmark", Recipient.STREAM)
+        self.assertIsNotNone(self.get_user_message(hamlet, new_message_id))
+
+    def test_backfill_without_subscription_history(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        cordelia_email = self.example_email('cordelia')
+        do_soft_deactivate_users([hamlet])
+        hamlet.refresh_from_db()
+
+        # Subscriptions from before subscription events were logged
+        # have no history; active ones are backfilled.
+        RealmAuditLog.objects.filter(
+            modified_user=hamlet,
+            modified_stream=get_stream("Denmark", hamlet.realm)).delete()
+        message_id = self.send_message(cordelia_email, "Denmark", Recipient.STREAM)
+        self.assertIsNone(self.get_user_message(hamlet, message_id))
+
+        reactivate_user_if_soft_deactivated(hamlet)
+        self.assertFalse(hamlet.long_term_idle)
+        self.assertIsNotNone(self.get_user_message(hamlet, message_id))
+
+    def test_get_users_for_soft_deactivation(self):
+        # type: () -> None
+        hamlet = self.example_user('hamlet')
+        realm = hamlet.realm
+        UserProfile.objects.filter(realm=realm).update(
+            date_joined=timezone_now() - datetime.timedelta(days=100))
+        UserActivity.objects.all().update(last_visit=timezone_now() - datetime.timedelta(days=100))
+        UserActivity.objects.create(user_profile=hamlet, client=Client.objects.first(),
+                                    query='get_events_backend', count=1,
+                                    last_visit=timezone_now())
+
+        users = get_users_for_soft_deactivation(30, realm)
+        self.assertNotIn(hamlet, users)
+        self.assertIn(self.example_user('othello'), users)
+        self.assertFalse(any(user.is_bot for user in users))
@@ -9,6 +9,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 
+import mock
 import time
 
 import ujson
@@ -96,6 +97,10 @@ class TornadoWebTestCase(AsyncHTTPTestCase, ZulipTestCase):
         headers.update(self.get_session_cookie())
         kwargs['headers'] = headers
 
+    def get_api_auth_header(self, email):
+        # type: (Text) -> Dict[str, Text]
+        return {'Authorization': self.api_auth(email)['HTTP_AUTHORIZATION']}
+
     def create_queue(self, **kwargs):
         # type: (**Any) -> str
         response = self.client_get('/json/events?dont_block=true')
@@ -143,6 +148,44 @@ class EventsTestCase(TornadoWebTestCase):
         self.assertEqual(events[0]['data'], 'test data')
         self.assertEqual(data['result'], 'success')
 
+    def test_events_fast_path(self):
+        # type: () -> None
+        user_profile = self.example_user('hamlet')
+        self.login(user_profile.email)
+        queue_id = self.create_queue()
+        process_event(dict(type='test', data='test data'), [user_profile.id])
+        path = '/api/v1/events?{}'.format(urllib_parse.urlencode({
+            'queue_id': queue_id,
+            'last_event_id': -1,
+            'dont_block': 'true',
+        }))
+
+        # The fast path doesn't need Django's middleware.
+        with mock.patch('zerver.tornado.handlers.AsyncDjangoHandler.load_middleware') as mock_load:
+            response = self.fetch(path, method='GET',
+                                  headers=self.get_api_auth_header(user_profile.email))
+        self.assertFalse(mock_load.called)
+        self.assertEqual(response.code, 200)
+        data = ujson.loads(response.body)
+        self.assertEqual([event['data'] for event in data['events']], ['test data'])
+
+        # Errors from the view are handled like in Django
+        response = self.fetch(path, method='GET',
+                              headers=self.get_api_auth_header(self.example_email('cordelia')))
+        self.assertEqual(response.code, 400)
+        self.assertIn('not authorized', ujson.loads(response.body)['msg'])
+
+        # Requests without credentials fall back to Django
+        path = path.replace('/api/v1/', '/json/')
+        response = self.fetch(path, method='GET')
+        self.assertEqual(response.code, 401)
+
+        with self.settings(TORNADO_EVENTS_FAST_PATH=False):
+            response = self.client_get(path)
+        self.assertEqual(response.code, 200)
+        data = ujson.loads(response.body)
+        self.assertEqual([event['data'] for event in data['events']], ['test data'])
+
 class WebSocketBaseTestCase(AsyncHTTPTestCase, ZulipTestCase):
 
     def setUp(self):
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from django.http import HttpResponse
+import ujson
+
+from typing import Any, Dict, Iterable, Mapping, Tuple
+
+# When a message is sent to a busy stream, the same message dict is
+# delivered to thousands of event queues (see process_message_event),
+# so we JSON-encode each shared message dict once, and build the
+# responses to GET /json/events by splicing together these
+# pre-encoded fragments.
+#
+# The cache is keyed on id() of the message dict; we keep a reference
+# to the dict itself in the cache, both so that its id() can't be
+# reused and so we can check we have the right dict.  The shared
+# message dicts are never modified once they're in an event queue.
+MESSAGE_JSON_CACHE_SIZE = 1000
+message_json_cache = OrderedDict()  # type: Dict[int, Tuple[Mapping[str, Any], str]]
+
+def get_message_json(message_dict):
+    # type: (Mapping[str, Any]) -> str
+    entry = message_json_cache.get(id(message_dict))
+    if entry is not None and entry[0] is message_dict:
+        return entry[1]
+
+    message_json = ujson.dumps(message_dict)
+    message_json_cache[id(message_dict)] = (message_dict, message_json)
+    while len(message_json_cache) > MESSAGE_JSON_CACHE_SIZE:
+        message_json_cache.popitem(last=False)
+    return message_json
+
+def splice_json_objects(first, second):
+    # type: (str, str) -> str
+    """Combines the JSON encodings of two objects with no keys in
+    common into the encoding of a single object with all their keys."""
+    if first == '{}':
+        return second
+    if second == '{}':
+        return first
+    return first[:-1] + ',' + second[1:]
+
+def encode_event(event):
+    # type: (Mapping[str, Any]) -> str
+    """JSON-encodes an event from an event queue in the format we send
+    to clients, applying any message_overlay (see
+    apply_message_overlay in zerver/tornado/event_queue.py)."""
+    if event['type'] != 'message' or 'message' not in event:
+        return ujson.dumps(event)
+
+    message_json = get_message_json(event['message'])
+    if event.get('message_overlay'):
+        message_json = splice_json_objects(message_json, ujson.dumps(event['message_overlay']))
+
+    rest = dict(event)
+    del rest['message']
+    rest.pop('message_overlay', None)
+    return splice_json_objects(ujson.dumps(rest), '{"message":' + message_json + '}')
+
+def encode_events_response(response, events):
+    # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> str
+    """JSON-encodes `response` with an added `events` key."""
+    events_json = '[' + ','.join(encode_event(event) for event in events) + ']'
+    return splice_json_objects(ujson.dumps(response), '{"events":' + events_json + '}')
+
+def json_events_response(response, status=200):
+    # type: (Dict[str, Any], int) -> HttpResponse
+    """Like json_success(response), for a response containing a list
+    of events from an event queue."""
+    content = dict(result='success', msg='')  # type: Dict[str, Any]
+    content.update(response)
+    events = content.pop('events')
+    return HttpResponse(content=encode_events_response(content, events) + "\n",
+                        content_type='application/json', status=status)
@@ -2,13 +2,12 @@
 # high-level documentation on how this system works.
 from __future__ import absolute_import
 from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Union
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
-from django.utils.timezone import now as timezone_now
 from collections import deque
-import datetime
+import heapq
 import os
 import time
 import socket
@@ -29,12 +28,16 @@ from zerver.tornado.handlers import clear_handler_by_id, get_handler_by_id, \
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_restart
 from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.presence import get_last_active_times
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
-from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
-import copy
+from zerver.tornado.journal import EventQueueJournal, journal_filename, read_journal, \
+    read_snapshot, write_snapshot
+from zerver.tornado.sharding import get_current_shard, get_tornado_shard_count, \
+    get_user_shard, get_user_tornado_uri, get_tornado_uri, make_queue_id, \
+    notify_tornado_queue_name, persistent_queue_filename
 import six
 
 requests_client = requests.Session()
@@ -50,6 +53,12 @@ for host in ['127.0.0.1', 'localhost']:
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
 
+# How often we write buffered journal records to disk (bounding how
+# much is lost if Tornado crashes) and how often we compact the
+# journal into a fresh snapshot of all the event queues.
+EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS = 1000
+EVENT_QUEUE_SNAPSHOT_FREQ_MSECS = 1000 * 60 * 10
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -132,13 +141,21 @@ class ClientDescriptor(object):
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event):
-        # type: (Dict[str, Any]) -> None
+    def add_event(self, event, size=None):
+        # type: (Dict[str, Any], Optional[int]) -> None
+        if self.event_queue.overflowed:
+            # The client needs to register a new queue anyway, so we
+            # only keep track of the notifications it's missing.
+            if self.event_queue.record_missed_notification(event) and journal is not None:
+                journal.record_event(self.event_queue.id, event)
+            return
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_restart(handler._request)
 
-        self.event_queue.push(event)
+        self.event_queue.push(event, size)
+        if journal is not None:
+            journal.record_event(self.event_queue.id, event)
         self.finish_current_handler()
 
     def finish_current_handler(self):
@@ -147,7 +164,7 @@ class ClientDescriptor(object):
             err_msg = "Got error finishing handler for queue %s" % (self.event_queue.id,)
             try:
                 finish_handler(self.current_handler_id, self.event_queue.id,
-                               self.event_queue.contents(), self.apply_markdown)
+                               self.event_queue.raw_contents(), self.apply_markdown)
             except Exception:
                 logging.exception(err_msg)
             finally:
@@ -182,6 +199,8 @@ class ClientDescriptor(object):
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        if journal is not None:
+            journal.record_connect(self.event_queue.id, self.last_connection_time)
 
         def timeout_callback():
             # type: () -> None
@@ -221,6 +240,21 @@ class ClientDescriptor(object):
         do_gc_event_queues({self.event_queue.id}, {self.user_profile_id},
                            {self.realm_id})
 
+def apply_message_overlay(event):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Message events for a given message all share a single message
+    dict, which must never be modified.  Any per-client changes to the
+    message (e.g. is_mentioned) are stored in the event's
+    message_overlay, and are only merged in here, when the event is
+    actually being sent to the client."""
+    if 'message_overlay' not in event:
+        return event
+    client_event = dict(event)
+    message = dict(client_event['message'])
+    message.update(client_event.pop('message_overlay'))
+    client_event['message'] = message
+    return client_event
+
 def compute_full_event_type(event):
     # type: (Mapping[str, Any]) -> str
     if event["type"] == "update_message_flags":
@@ -230,6 +264,114 @@ def compute_full_event_type(event):
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
+# For some kinds of events, a client only needs the combined effect of
+# all the events that it hasn't fetched yet, e.g. only the latest
+# pointer, or only the latest presence of each user.  Such an event is
+# kept as a "virtual event" until it's sent to the client, and later
+# events with the same coalescing key are merged into it (and it
+# moves to the position of the latest of them in the queue).  This
+# keeps the queues of idle clients, and the responses they get once
+# they come back, small.
+#
+# Maps an event type to a (get_key, merge, accumulates) triple:
+# get_key(event) returns the event's coalescing key, or None if it
+# can't be coalesced; merge(virtual_event, event) merges a new event
+# into the earlier one with the same key; and accumulates says whether
+# the merged event is about as large as the two events together (for
+# the queue size limit), rather than as the larger of them.
+EventCoalescer = Tuple[Callable[[Mapping[str, Any]], Optional[str]],
+                       Callable[[Dict[str, Any], Mapping[str, Any]], None],
+                       bool]
+event_coalescers = {}  # type: Dict[str, EventCoalescer]
+
+def register_event_coalescer(event_type, get_key, merge, accumulates=False):
+    # type: (str, Callable[[Mapping[str, Any]], Optional[str]], Callable[[Dict[str, Any], Mapping[str, Any]], None], bool) -> None
+    event_coalescers[event_type] = (get_key, merge, accumulates)
+
+def get_coalescing_key(event):
+    # type: (Mapping[str, Any]) -> Optional[str]
+    if event["type"] not in event_coalescers:
+        return None
+    get_key = event_coalescers[event["type"]][0]
+    return get_key(event)
+
+def merge_pointer_event(virtual_event, event):
+    # type: (Dict[str, Any], Mapping[str, Any]) -> None
+    virtual_event["pointer"] = event["pointer"]
+
+def merge_restart_event(virtual_event, event):
+    # type: (Dict[str, Any], Mapping[str, Any]) -> None
+    virtual_event["server_generation"] = event["server_generation"]
+
+def get_flags_event_key(event):
+    # type: (Mapping[str, Any]) -> Optional[str]
+    full_event_type = compute_full_event_type(event)
+    if full_event_type.startswith("flags/"):
+        return full_event_type
+    return None
+
+def merge_flags_event(virtual_event, event):
+    # type: (Dict[str, Any], Mapping[str, Any]) -> None
+    virtual_event["messages"] += event["messages"]
+
+def get_presence_event_key(event):
+    # type: (Mapping[str, Any]) -> Optional[str]
+    return "presence/%s" % (event["email"],)
+
+def merge_presence_event(virtual_event, event):
+    # type: (Dict[str, Any], Mapping[str, Any]) -> None
+    # The presence dicts are keyed by client, and clients merge them
+    # into what they know about the user's presence the same way.
+    virtual_event["presence"].update(event["presence"])
+    virtual_event["server_timestamp"] = event["server_timestamp"]
+
+def get_typing_event_key(event):
+    # type: (Mapping[str, Any]) -> Optional[str]
+    recipient_ids = sorted(recipient["user_id"] for recipient in event["recipients"])
+    return "typing/%s/%s" % (event["sender"]["user_id"],
+                             ",".join(str(user_id) for user_id in recipient_ids))
+
+def merge_typing_event(virtual_event, event):
+    # type: (Dict[str, Any], Mapping[str, Any]) -> None
+    # Only whether the user is typing now matters.
+    virtual_event["op"] = event["op"]
+
+def get_update_message_event_key(event):
+    # type: (Mapping[str, Any]) -> Optional[str]
+    # Topic edits can move other messages as well, and clients use
+    # orig_subject to find them, so we only merge content edits.
+    if "subject" in event:
+        return None
+    return "update_message/%s" % (event["message_id"],)
+
+def merge_update_message_event(virtual_event, event):
+    # type: (Dict[str, Any], Mapping[str, Any]) -> None
+    # The merged edit goes from the original content of the first
+    # edit to the content of the last one.
+    for key, value in six.iteritems(event):
+        if not key.startswith("orig_") or key not in virtual_event:
+            virtual_event[key] = value
+
+register_event_coalescer("pointer", lambda event: "pointer", merge_pointer_event)
+register_event_coalescer("restart", lambda event: "restart", merge_restart_event)
+register_event_coalescer("update_message_flags", get_flags_event_key, merge_flags_event,
+                         accumulates=True)
+register_event_coalescer("presence", get_presence_event_key, merge_presence_event)
+register_event_coalescer("typing", get_typing_event_key, merge_typing_event)
+register_event_coalescer("update_message", get_update_message_event_key,
+                         merge_update_message_event)
+
+def estimate_event_size(event):
+    # type: (Mapping[str, Any]) -> int
+    """Roughly how many bytes `event` takes up in an event queue, based
+    on the size of its JSON encoding.  For message events, we only
+    count the message, which is most of the event; callers that add an
+    event to many queues should compute this once and pass it to
+    ClientDescriptor.add_event."""
+    if event['type'] == 'message':
+        return len(ujson.dumps(event['message']))
+    return len(ujson.dumps(event))
+
 class EventQueue(object):
     def __init__(self, id):
         # type: (str) -> None
@@ -237,6 +379,16 @@ class EventQueue(object):
         self.next_event_id = 0  # type: int
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
+        # Estimated sizes of the events in the queue (including virtual
+        # events), by event id, and their total.
+        self.event_sizes = {}  # type: Dict[int, int]
+        self.size_bytes = 0  # type: int
+        # Whether the queue has hit its size limit; see overflow().
+        self.overflowed = False  # type: bool
+        # The missed-message notifications for the message events that
+        # were dropped because the queue overflowed, which
+        # missedmessage_hook sends if the client never comes back.
+        self.missed_notifications = []  # type: List[Dict[str, Any]]
 
     def to_dict(self):
         # type: () -> Dict[str, Any]
@@ -246,7 +398,9 @@ class EventQueue(object):
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
                     queue=list(self.queue),
-                    virtual_events=self.virtual_events)
+                    virtual_events=self.virtual_events,
+                    overflowed=self.overflowed,
+                    missed_notifications=self.missed_notifications)
 
     @classmethod
     def from_dict(cls, d):
@@ -255,51 +409,122 @@ class EventQueue(object):
         ret.next_event_id = d['next_event_id']
         ret.queue = deque(d['queue'])
         ret.virtual_events = d.get("virtual_events", {})
+        ret.overflowed = d.get("overflowed", False)
+        ret.missed_notifications = d.get("missed_notifications", [])
+        for event in list(ret.queue) + list(ret.virtual_events.values()):
+            ret.event_sizes[event['id']] = estimate_event_size(event)
+        ret.size_bytes = sum(ret.event_sizes.values())
         return ret
 
-    def push(self, event):
-        # type: (Dict[str, Any]) -> None
+    def overflow(self):
+        # type: () -> None
+        """Replaces the contents of the queue with a single resync_required
+        event, which tells the client that it has missed events and needs
+        to reload its state and register a new queue.  No more events are
+        added to the queue, and once the client has seen the event, it is
+        treated as a bad queue id (see fetch_events), so that clients that
+        don't know about resync_required events also register a new queue."""
+        for event in self.queue:
+            self.record_missed_notification(event)
+        self.queue.clear()
+        self.virtual_events = {}
+        self.event_sizes = {}
+        self.size_bytes = 0
+        self.overflowed = True
+        self.queue.append(dict(type='resync_required', id=self.next_event_id))
+        self.next_event_id += 1
+
+    def record_missed_notification(self, event):
+        # type: (Mapping[str, Any]) -> bool
+        """Remembers the notification missedmessage_hook would send for
+        `event` if the client never fetched it; returns whether there
+        was one."""
+        notify_info = get_missed_message_notification(event)
+        if notify_info is None:
+            return False
+        self.missed_notifications.append(notify_info)
+        return True
+
+    def push(self, event, size=None):
+        # type: (Dict[str, Any], Optional[int]) -> None
+        if self.overflowed:
+            self.record_missed_notification(event)
+            return
+        if size is None:
+            size = estimate_event_size(event)
         event['id'] = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
-        if (full_event_type in ["pointer", "restart"] or
-                full_event_type.startswith("flags/")):
-            if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
-                return
+        self.size_bytes += size
+        key = get_coalescing_key(event)
+        if key is None:
+            self.queue.append(event)
+            self.event_sizes[event['id']] = size
+        elif key not in self.virtual_events:
+            # The event may be shared with other queues, so copy the
+            # parts that merging modifies in place.
+            virtual_event = dict(event)
+            if "presence" in virtual_event:
+                virtual_event["presence"] = dict(virtual_event["presence"])
+            if "messages" in virtual_event:
+                virtual_event["messages"] = list(virtual_event["messages"])
+            self.virtual_events[key] = virtual_event
+            self.event_sizes[event['id']] = size
+        else:
             # Update the virtual event with the values from the event
-            virtual_event = self.virtual_events[full_event_type]
+            virtual_event = self.virtual_events[key]
+            (_, merge, accumulates) = event_coalescers[event["type"]]
+            virtual_size = self.event_sizes.pop(virtual_event["id"], 0)
+            if not accumulates:
+                self.size_bytes -= min(virtual_size, size)
+                size = max(virtual_size, size)
+            else:
+                size += virtual_size
+            self.event_sizes[event['id']] = size
+            merge(virtual_event, event)
             virtual_event["id"] = event["id"]
             if "timestamp" in event:
                 virtual_event["timestamp"] = event["timestamp"]
-            if full_event_type == "pointer":
-                virtual_event["pointer"] = event["pointer"]
-            elif full_event_type == "restart":
-                virtual_event["server_generation"] = event["server_generation"]
-            elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
-        else:
-            self.queue.append(event)
+        self.check_size()
+
+    def check_size(self):
+        # type: () -> None
+        if (len(self.queue) + len(self.virtual_events) > settings.EVENT_QUEUE_MAX_EVENTS or
+                self.size_bytes > settings.EVENT_QUEUE_MAX_BYTES):
+            logging.warning("Event queue %s overflowed with %d events (%d bytes)" % (
+                self.id, len(self.queue) + len(self.virtual_events), self.size_bytes))
+            statsd.incr('tornado.event_queue_overflows')
+            self.overflow()
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self):
         # type: () -> Dict[str, Any]
-        return self.queue.popleft()
+        event = self.queue.popleft()
+        self.size_bytes -= self.event_sizes.pop(event['id'], 0)
+        return event
 
     def empty(self):
         # type: () -> bool
         return len(self.queue) == 0 and len(self.virtual_events) == 0
 
-    # See the comment on pop; that applies here as well
     def prune(self, through_id):
         # type: (int) -> None
         while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
             self.pop()
-
-    def contents(self):
+        # Virtual events are normally folded into the queue (by
+        # raw_contents) before the client acknowledges them, but that
+        # isn't journaled, so after replaying a journal, acknowledged
+        # events can still be virtual.
+        for key, virtual_event in list(self.virtual_events.items()):
+            if virtual_event['id'] <= through_id:
+                del self.virtual_events[key]
+                self.size_bytes -= self.event_sizes.pop(virtual_event['id'], 0)
+
+    def raw_contents(self):
         # type: () -> List[Dict[str, Any]]
+        """Returns the events in the queue, in their internal format
+        (i.e. with any message_overlay not yet applied)."""
         contents = []  # type: List[Dict[str, Any]]
         virtual_id_map = {}  # type: Dict[str, Dict[str, Any]]
         for event_type in self.virtual_events:
@@ -322,6 +547,11 @@ class EventQueue(object):
         self.queue = deque(contents)
         return contents
 
+    def contents(self):
+        # type: () -> List[Dict[str, Any]]
+        """Returns the events in the queue, in the format we send to clients."""
+        return [apply_message_overlay(event) for event in self.raw_contents()]
+
 # maps queue ids to client descriptors
 clients = {}  # type: Dict[str, ClientDescriptor]
 # maps user id to list of client descriptors
@@ -336,8 +566,26 @@ realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
 # that is about to be deleted
 gc_hooks = []  # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
+# A heap of (time, queue id) pairs, with an entry for each event queue
+# for when it should next be checked for idleness, so that
+# gc_event_queues only looks at queues that might have expired rather
+# than every queue.  An entry's time is the queue's expiry time as of
+# when it was scheduled; reconnecting doesn't touch the heap, so a
+# queue that was used since then is just rescheduled when its entry
+# comes up.  Entries for queues that have already been removed are
+# discarded when they come up.
+gc_heap = []  # type: List[Tuple[float, str]]
+
 next_queue_id = 0
 
+# The journal of changes to the event queues since the last snapshot;
+# None when journaling is disabled (e.g. in the test suite).
+journal = None  # type: Optional[EventQueueJournal]
+
+# Where load_event_queues keeps a copy of the snapshot and journal it
+# loaded from.
+EVENT_QUEUE_BACKUP_DIR = "/var/tmp"
+
 def add_client_gc_hook(hook):
     # type: (Callable[[int, ClientDescriptor, bool], None]) -> None
     gc_hooks.append(hook)
@@ -360,15 +608,25 @@ def add_to_client_dicts(client):
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
 
+def schedule_queue_gc(client, now):
+    # type: (ClientDescriptor, float) -> None
+    expiry_time = client.last_connection_time + client.queue_timeout
+    # A queue with a connected handler isn't idle even if its expiry
+    # time has passed; check it again on the next GC run.
+    heapq.heappush(gc_heap, (max(expiry_time, now), client.event_queue.id))
+
 def allocate_client_descriptor(new_queue_data):
     # type: (MutableMapping[str, Any]) -> ClientDescriptor
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    queue_id = make_queue_id(settings.SERVER_GENERATION, next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    schedule_queue_gc(client, time.time())
+    if journal is not None:
+        journal.record_create(queue_id, client.to_dict())
     return client
 
 def do_gc_event_queues(to_remove, affected_users, affected_realms):
@@ -395,79 +653,178 @@ def do_gc_event_queues(to_remove, affected_users, affected_realms):
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
 
+    if journal is not None and to_remove:
+        journal.record_gc(list(to_remove))
+
 def gc_event_queues():
     # type: () -> None
     start = time.time()
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in six.iteritems(clients):
+    to_reschedule = []  # type: List[ClientDescriptor]
+    num_checked = 0
+    while gc_heap and gc_heap[0][0] <= start:
+        (_, id) = heapq.heappop(gc_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already removed, e.g. by ClientDescriptor.cleanup.
+            continue
+        num_checked += 1
         if client.idle(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            to_reschedule.append(client)
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle and thus
     # not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
+    for client in to_reschedule:
+        schedule_queue_gc(client, start)
 
-    logging.info(('Tornado removed %d idle event queues owned by %d users in %.3fs.' +
+    gc_time = time.time() - start
+    logging.info(('Tornado removed %d idle event queues owned by %d users (checked %d) in %.3fs.' +
                   '  Now %d active queues, %s')
-                 % (len(to_remove), len(affected_users), time.time() - start,
+                 % (len(to_remove), len(affected_users), num_checked, gc_time,
                     len(clients), handler_stats_string()))
+    statsd.timing('tornado.gc_event_queues.time', int(gc_time * 1000))
+    statsd.gauge('tornado.gc_event_queues.checked', num_checked)
+    statsd.gauge('tornado.gc_event_queues.removed', len(to_remove))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
 def dump_event_queues():
     # type: () -> None
+    """Writes a snapshot of all the event queues and starts a new
+    journal for changes made after the snapshot."""
+    global journal
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)],
-                   stored_queues)
+    filename = persistent_queue_filename(get_current_shard())
+    if journal is not None:
+        journal.close()
+        generation = journal.generation + 1
+    else:
+        generation = 0
+    write_snapshot(filename, generation,
+                   [(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)])
+    journal = EventQueueJournal(journal_filename(filename), generation)
 
     logging.info('Tornado dumped %d event queues in %.3fs'
                  % (len(clients), time.time() - start))
+    report_event_queue_sizes()
+
+def report_event_queue_sizes():
+    # type: () -> None
+    queue_lengths = [len(client.event_queue.queue) + len(client.event_queue.virtual_events)
+                     for client in six.itervalues(clients)]
+    queue_sizes = [client.event_queue.size_bytes for client in six.itervalues(clients)]
+    statsd.gauge('tornado.event_queues.total_events', sum(queue_lengths))
+    statsd.gauge('tornado.event_queues.total_bytes', sum(queue_sizes))
+    statsd.gauge('tornado.event_queues.max_events', max(queue_lengths or [0]))
+    statsd.gauge('tornado.event_queues.max_bytes', max(queue_sizes or [0]))
+
+def flush_event_queue_journal():
+    # type: () -> None
+    if journal is not None:
+        journal.flush()
+
+def replay_journal_record(record):
+    # type: (Mapping[str, Any]) -> None
+    op = record["op"]
+    if op == "create":
+        clients[record["queue_id"]] = ClientDescriptor.from_dict(record["client"])
+        return
+    if op == "gc":
+        for queue_id in record["queue_ids"]:
+            clients.pop(queue_id, None)
+        return
+
+    client = clients.get(record["queue_id"])
+    if client is None:
+        return
+    if op == "event":
+        client.event_queue.push(record["event"])
+    elif op == "prune":
+        client.event_queue.prune(record["through_id"])
+    elif op == "connect":
+        client.last_connection_time = record["last_connection_time"]
 
 def load_event_queues():
     # type: () -> None
-    global clients
+    global clients, journal
     start = time.time()
+    filename = persistent_queue_filename(get_current_shard())
+    generation = None  # type: Optional[int]
 
     # ujson chokes on bad input pretty easily.  We separate out the actual
     # file reading from the loading so that we don't silently fail if we get
     # bad input.
     try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
+        with open(filename, "r") as stored_queues:
             json_data = stored_queues.read()
         try:
+            generation, queues = read_snapshot(json_data)
             clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
+                           for (qid, client) in queues)
         except Exception:
             logging.exception("Could not deserialize event queues")
     except (IOError, EOFError):
         pass
 
+    num_records = 0
+    if generation is not None:
+        for record in read_journal(journal_filename(filename), generation):
+            try:
+                replay_journal_record(record)
+            except Exception:
+                logging.exception("Could not replay event queue journal record")
+            num_records += 1
+
     for client in six.itervalues(clients):
         # Put code for migrations due to event queue data format changes here
 
         add_to_client_dicts(client)
+        schedule_queue_gc(client, start)
 
-    logging.info('Tornado loaded %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+    logging.info('Tornado loaded %d event queues (replaying %d journal records) in %.3fs'
+                 % (len(clients), num_records, time.time() - start))
+
+    # Keep a copy of what we loaded (or failed to load) before it's
+    # overwritten, so that queues can be recovered by hand if the
+    # snapshot turns out to be unreadable.
+    for path in [filename, journal_filename(filename)]:
+        try:
+            os.rename(path, os.path.join(EVENT_QUEUE_BACKUP_DIR,
+                                         "%s.last" % (os.path.basename(path),)))
+        except OSError:
+            pass
+
+    # Compact what we loaded into a fresh snapshot, which also starts
+    # the journal for this process.  We continue numbering generations
+    # from the loaded snapshot, so the journal we just replayed can
+    # never match the new snapshot.
+    new_generation = 0 if generation is None else generation + 1
+    write_snapshot(filename, new_generation,
+                   [(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)])
+    journal = EventQueueJournal(journal_filename(filename), new_generation)
 
 def send_restart_events(immediate=False):
     # type: (bool) -> None
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION)  # type: Dict[str, Any]
     if immediate:
         event['immediate'] = True
+    event_size = estimate_event_size(event)
     for client in six.itervalues(clients):
         if client.accepts_event(event):
-            client.add_event(event.copy())
+            client.add_event(event.copy(), event_size)
 
 def setup_event_queue():
     # type: () -> None
+    ioloop = tornado.ioloop.IOLoop.instance()
     if not settings.TEST_SUITE:
         load_event_queues()
         atexit.register(dump_event_queues)
@@ -475,13 +832,14 @@ def setup_event_queue():
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))  # type: ignore # https://github.com/python/mypy/issues/2955
         tornado.autoreload.add_reload_hook(dump_event_queues)  # type: ignore # TODO: Fix missing tornado.autoreload stub
 
-    try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
-    except OSError:
-        pass
+        # Keep the on-disk snapshot and journal up to date, so that we
+        # can recover the event queues if Tornado crashes.
+        tornado.ioloop.PeriodicCallback(flush_event_queue_journal,
+                                        EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS, ioloop).start()
+        tornado.ioloop.PeriodicCallback(dump_event_queues,
+                                        EVENT_QUEUE_SNAPSHOT_FREQ_MSECS, ioloop).start()
 
     # Set up event queue garbage collection
-    ioloop = tornado.ioloop.IOLoop.instance()
     pc = tornado.ioloop.PeriodicCallback(gc_event_queues,
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
@@ -505,6 +863,11 @@ def fetch_events(query):
         extra_log_data = ""
         if queue_id is None:
             if dont_block:
+                if get_user_shard(user_profile_id) != get_current_shard():
+                    # On a sharded server, queues must be created in the
+                    # process that receives the user's events; this is
+                    # what the Django side of /register does.
+                    raise JsonableError(_("This server does not handle event queues for this user"))
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
             else:
@@ -518,10 +881,17 @@ def fetch_events(query):
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
             client.event_queue.prune(last_event_id)
+            if journal is not None:
+                journal.record_prune(queue_id, last_event_id)
             was_connected = client.finish_current_handler()
+            if client.event_queue.overflowed and client.event_queue.empty():
+                # The client has seen the resync_required event.
+                raise BadEventQueueIdError(queue_id)
 
         if not client.event_queue.empty() or dont_block:
-            response = dict(events=client.event_queue.contents(),
+            # The events are in the queue's internal format; they are
+            # converted for the client when encoded by json_events_response.
+            response = dict(events=client.event_queue.raw_contents(),
                             handler_id=handler_id)  # type: Dict[str, Any]
             if orig_queue_id is None:
                 response['queue_id'] = queue_id
@@ -573,7 +943,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
             req['event_types'] = ujson.dumps(event_types)
 
         try:
-            resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+            resp = requests_client.get(get_user_tornado_uri(user_profile.id) + '/api/v1/events',
                                        auth=requests.auth.HTTPBasicAuth(
                                            user_profile.email, user_profile.api_key),
                                        params=req)
@@ -583,7 +953,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                           (settings.ERROR_FILE_LOG_PATH, "tornado.log"))
             raise requests.adapters.ConnectionError(
                 "Django cannot connect to Tornado server (%s); try restarting" %
-                (settings.TORNADO_SERVER))
+                (get_user_tornado_uri(user_profile.id),))
 
         resp.raise_for_status()
 
@@ -594,7 +964,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
 def get_user_events(user_profile, queue_id, last_event_id):
     # type: (UserProfile, str, int) -> List[Dict]
     if settings.TORNADO_SERVER:
-        resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+        resp = requests_client.get(get_user_tornado_uri(user_profile.id) + '/api/v1/events',
                                    auth=requests.auth.HTTPBasicAuth(
                                        user_profile.email, user_profile.api_key),
                                    params={'queue_id': queue_id,
@@ -616,6 +986,21 @@ def build_offline_notification(user_profile_id, message_id):
             "message_id": message_id,
             "timestamp": time.time()}
 
+def get_missed_message_notification(event):
+    # type: (Mapping[str, Any]) -> Optional[Dict[str, Any]]
+    if not event['type'] == 'message' or not event['flags']:
+        return None
+
+    if 'mentioned' not in event['flags'] or 'read' in event['flags']:
+        return None
+    notify_info = dict(message_id=event['message']['id'])  # type: Dict[str, Any]
+
+    if not event.get('push_notified', False):
+        notify_info['send_push'] = True
+    if not event.get('email_notified', False):
+        notify_info['send_email'] = True
+    return notify_info
+
 def missedmessage_hook(user_profile_id, queue, last_for_client):
     # type: (int, ClientDescriptor, bool) -> None
     # Only process missedmessage hook when the last queue for a
@@ -623,18 +1008,12 @@ def missedmessage_hook(user_profile_id, queue, last_for_client):
     if not last_for_client:
         return
 
-    message_ids_to_notify = []  # type: List[Dict[str, Any]]
-    for event in queue.event_queue.contents():
-        if not event['type'] == 'message' or not event['flags']:
-            continue
-
-        if 'mentioned' in event['flags'] and 'read' not in event['flags']:
-            notify_info = dict(message_id=event['message']['id'])
-
-            if not event.get('push_notified', False):
-                notify_info['send_push'] = True
-            if not event.get('email_notified', False):
-                notify_info['send_email'] = True
+    # Message events dropped when the queue overflowed were never
+    # fetched either.
+    message_ids_to_notify = list(queue.event_queue.missed_notifications)
+    for event in queue.event_queue.raw_contents():
+        notify_info = get_missed_message_notification(event)
+        if notify_info is not None:
             message_ids_to_notify.append(notify_info)
 
     for notify_info in message_ids_to_notify:
@@ -645,44 +1024,27 @@ def missedmessage_hook(user_profile_id, queue, last_for_client):
         if notify_info.get('send_email', False):
             queue_json_publish("missedmessage_emails", notice, lambda notice: None)
 
-def receiver_is_idle(user_profile_id, realm_presences):
-    # type: (int, Optional[Dict[int, Dict[Text, Dict[str, Any]]]]) -> bool
+def receiver_is_idle(user_profile_id, last_active_time):
+    # type: (int, Optional[int]) -> bool
     # If a user has no message-receiving event queues, they've got no open zulip
     # session so we notify them
     all_client_descriptors = get_client_descriptors_for_user(user_profile_id)
     message_event_queues = [client for client in all_client_descriptors if client.accepts_messages()]
     off_zulip = len(message_event_queues) == 0
 
-    # It's possible a recipient is not in the realm of a sender. We don't have
-    # presence information in this case (and it's hard to get without an additional
-    # db query) so we simply don't try to guess if this cross-realm recipient
-    # has been idle for too long
-    if realm_presences is None or user_profile_id not in realm_presences:
+    # If we have no record of the user ever being active (e.g. because
+    # presence is disabled in their realm), we simply don't try to
+    # guess if they have been idle for too long.
+    if last_active_time is None:
         return off_zulip
 
-    # We want to find the newest "active" presence entity and compare that to the
-    # activity expiry threshold.
-    user_presence = realm_presences[user_profile_id]
-    latest_active_timestamp = None
-    idle = False
-
-    for client, status in six.iteritems(user_presence):
-        if (latest_active_timestamp is None or status['timestamp'] > latest_active_timestamp) and \
-                status['status'] == 'active':
-            latest_active_timestamp = status['timestamp']
-
-    if latest_active_timestamp is None:
-        idle = True
-    else:
-        active_datetime = timestamp_to_datetime(latest_active_timestamp)
-        # 140 seconds is consistent with presence.js:OFFLINE_THRESHOLD_SECS
-        idle = timezone_now() - active_datetime > datetime.timedelta(seconds=140)
+    # 140 seconds is consistent with presence.js:OFFLINE_THRESHOLD_SECS
+    idle = time.time() - last_active_time > 140
 
     return off_zulip or idle
 
 def process_message_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
-    realm_presences = {int(k): v for k, v in event_template['presences'].items()}  # type: Dict[int, Dict[Text, Dict[str, Any]]]
     sender_queue_id = event_template.get('sender_queue_id', None)  # type: Optional[str]
     message_dict_markdown = event_template['message_dict_markdown']  # type: Dict[str, Any]
     message_dict_no_markdown = event_template['message_dict_no_markdown']  # type: Dict[str, Any]
@@ -697,12 +1059,28 @@ def process_message_event(event_template, users):
     # Extra user-specific data to include
     extra_user_data = {}  # type: Dict[int, Any]
 
+    # The per-client message overlays are immutable, so we share a
+    # single overlay dict between all clients that need the same one.
+    message_overlays = {}  # type: Dict[Tuple[bool, Optional[bool]], Dict[str, Any]]
+
+    # The estimated size of the message events, by apply_markdown.
+    event_sizes = {}  # type: Dict[bool, int]
+
     if 'stream_name' in event_template and not event_template.get("invite_only"):
         for client in get_client_descriptors_for_realm_all_streams(event_template['realm_id']):
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': None}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
                 send_to_clients[client.event_queue.id]['is_sender'] = True
 
+    # Only recipients who were sent a PM or mentioned can get
+    # missed-message notifications, so we only look up when those
+    # users were last active (in one round trip).
+    users = list(users)
+    notifiable_user_ids = [user_data['id'] for user_data in users
+                           if (message_type == "private" and user_data['id'] != sender_id) or
+                           'mentioned' in user_data.get('flags', [])]
+    last_active_times = get_last_active_times(notifiable_user_ids)
+
     for user_data in users:
         user_profile_id = user_data['id']  # type: int
         flags = user_data.get('flags', [])  # type: Iterable[str]
@@ -716,9 +1094,11 @@ def process_message_event(event_template, users):
         # or they were @-notified potentially notify more immediately
         received_pm = message_type == "private" and user_profile_id != sender_id
         mentioned = 'mentioned' in flags
-        idle = receiver_is_idle(user_profile_id, realm_presences)
+        if not (received_pm or mentioned):
+            continue
+        idle = receiver_is_idle(user_profile_id, last_active_times.get(user_profile_id))
         always_push_notify = user_data.get('always_push_notify', False)
-        if (received_pm or mentioned) and (idle or always_push_notify):
+        if idle or always_push_notify:
             notice = build_offline_notification(user_profile_id, message_id)
             queue_json_publish("missedmessage_mobile_notifications", notice, lambda notice: None)
             notified = dict(push_notified=True)  # type: Dict[str, bool]
@@ -749,13 +1129,25 @@ def process_message_event(event_template, users):
             message_dict = message_dict_no_markdown
 
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
+        invite_only_stream = "mirror" in client.client_type_name and \
+            bool(event_template.get("invite_only"))
+        is_mentioned = None  # type: Optional[bool]
         if flags is not None:
-            message_dict['is_mentioned'] = 'mentioned' in flags
+            is_mentioned = 'mentioned' in flags
+
+        # Note that message_dict is shared by every client receiving
+        # this message; see apply_message_overlay.
         user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
+        if invite_only_stream or is_mentioned is not None:
+            overlay_key = (invite_only_stream, is_mentioned)
+            if overlay_key not in message_overlays:
+                overlay = {}  # type: Dict[str, Any]
+                if invite_only_stream:
+                    overlay['invite_only_stream'] = True
+                if is_mentioned is not None:
+                    overlay['is_mentioned'] = is_mentioned
+                message_overlays[overlay_key] = overlay
+            user_event['message_overlay'] = message_overlays[overlay_key]
         if extra_data is not None:
             user_event.update(extra_data)
 
@@ -771,27 +1163,33 @@ def process_message_event(event_template, users):
         if ('mirror' in sending_client and
                 sending_client.lower() == client.client_type_name.lower()):
             continue
-        client.add_event(user_event)
+        if client.apply_markdown not in event_sizes:
+            event_sizes[client.apply_markdown] = estimate_event_size(user_event)
+        client.add_event(user_event, event_sizes[client.apply_markdown])
 
 def process_event(event, users):
     # type: (Mapping[str, Any], Iterable[int]) -> None
+    event_size = estimate_event_size(event)
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
-                client.add_event(dict(event))
+                client.add_event(dict(event), event_size)
 
 def process_userdata_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
     for user_data in users:
-        user_profile_id = user_data['id']
+        user_profile_id = user_data['id']  # type: int
         user_event = dict(event_template)  # shallow copy, but deep enough for our needs
         for key in user_data.keys():
             if key != "id":
                 user_event[key] = user_data[key]
 
+        event_size = None  # type: Optional[int]
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(user_event):
-                client.add_event(user_event)
+                if event_size is None:
+                    event_size = estimate_event_size(user_event)
+                client.add_event(user_event, event_size)
 
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
@@ -804,29 +1202,80 @@ def process_notification(notice):
     else:
         process_event(event, cast(Iterable[int], users))
 
+def process_notification_batch(data):
+    # type: (Mapping[str, Any]) -> None
+    """Entry point for payloads arriving on the notify_tornado queue or
+    endpoint, which are either a single notice or a batch of notices
+    (as sent by send_event_batch)."""
+    if 'notices' in data:
+        for notice in data['notices']:
+            process_notification(notice)
+    else:
+        process_notification(data)
+
 # Runs in the Django process to send a notification to Tornado.
 #
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data):
-    # type: (Mapping[str, Any]) -> None
+def send_notification_http(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests_client.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+        requests_client.post(get_tornado_uri(shard) + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
     else:
-        process_notification(data)
+        process_notification_batch(data)
+
+def send_notification_to_shard(data, shard):
+    # type: (Mapping[str, Any], int) -> None
+    queue_json_publish(notify_tornado_queue_name(shard), data,
+                       lambda data: send_notification_http(data, shard))
 
 def send_notification(data):
     # type: (Mapping[str, Any]) -> None
-    queue_json_publish("notify_tornado", data, send_notification_http)
+    send_notification_to_shard(data, 0)
+
+def split_users_by_shard(event, users):
+    # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> Dict[int, List[Any]]
+    """Partitions `users` by the Tornado shard that holds their event
+    queues.  Messages to public streams also go to every other shard,
+    since any shard may have all_public_streams/narrowed clients in the
+    realm that need to see the message."""
+    users_by_shard = {}  # type: Dict[int, List[Any]]
+    if event['type'] == 'message' and 'stream_name' in event and not event.get('invite_only'):
+        for shard in range(get_tornado_shard_count()):
+            users_by_shard[shard] = []
+    for user in users:
+        if isinstance(user, int):
+            user_profile_id = user
+        else:
+            user_profile_id = user['id']
+        users_by_shard.setdefault(get_user_shard(user_profile_id), []).append(user)
+    return users_by_shard
 
 def send_event(event, users):
     # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    if get_tornado_shard_count() == 1:
+        send_notification_to_shard(dict(event=event, users=users), 0)
+        return
+    for shard, shard_users in six.iteritems(split_users_by_shard(event, users)):
+        send_notification_to_shard(dict(event=event, users=shard_users), shard)
+
+def send_event_batch(events_and_users):
+    # type: (Sequence[Tuple[Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]]]) -> None
+    """Like send_event, but for a sequence of (event, users) pairs, which
+    are delivered to each Tornado shard in a single notify_tornado publish."""
+    notices_by_shard = {}  # type: Dict[int, List[Dict[str, Any]]]
+    for (event, users) in events_and_users:
+        if get_tornado_shard_count() == 1:
+            notices_by_shard.setdefault(0, []).append(dict(event=event, users=users))
+            continue
+        for shard, shard_users in six.iteritems(split_users_by_shard(event, users)):
+            notices_by_shard.setdefault(shard, []).append(dict(event=event, users=shard_users))
+
+    for shard, notices in six.iteritems(notices_by_shard):
+        send_notification_to_shard(dict(notices=notices), shard)
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+
+# Most of the requests Tornado serves are long-polling GET requests
+# for events from an existing event queue.  Sending those through the
+# full Django stack (all of settings.MIDDLEWARE, URL resolution and
+# rest_dispatch) is a lot of overhead for what is usually just looking
+# up a queue, so the handler first tries this fast path for them.
+#
+# The fast path authenticates the request the same way rest_dispatch
+# would (a session cookie for /json/events, HTTP basic auth with an
+# API key otherwise), using the same decorators and cached lookups,
+# and then calls get_events_backend directly.  It only runs the
+# middleware needed for logging, rate limiting and error handling;
+# the session, CSRF, locale and common middleware don't do anything
+# useful for these requests.  Anything it isn't sure about (e.g. a
+# request without credentials, which needs the usual 401 or redirect)
+# falls back to the full Django stack.
+
+from importlib import import_module
+from typing import Any, List, Optional, Union
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.http import HttpRequest, HttpResponse
+
+from zerver.decorator import RespondAsynchronously, _RespondAsynchronously, \
+    authenticate_log_and_execute_json, authenticated_rest_api_view
+from zerver.middleware import FlushDisplayRecipientCache, JsonErrorHandler, LogRequests, \
+    RateLimitMiddleware, SetRemoteAddrFromForwardedFor, TagRequests, async_request_stop
+
+EVENTS_PATHS = ['/json/events', '/api/v1/events']
+
+# The subset of settings.MIDDLEWARE that the fast path runs, in the
+# same order.
+FAST_PATH_MIDDLEWARE = [
+    TagRequests(),
+    SetRemoteAddrFromForwardedFor(),
+    LogRequests(),
+    JsonErrorHandler(),
+    RateLimitMiddleware(),
+    FlushDisplayRecipientCache(),
+]  # type: List[Any]
+
+def is_fast_path_request(request):
+    # type: (HttpRequest) -> bool
+    # Requests without a queue_id create a queue; those come from
+    # Django's /register and aren't worth optimizing.
+    return (settings.TORNADO_EVENTS_FAST_PATH and
+            request.method == 'GET' and
+            request.path in EVENTS_PATHS and
+            'queue_id' in request.GET)
+
+def authenticate_and_get_events(request):
+    # type: (HttpRequest) -> Optional[Union[HttpResponse, _RespondAsynchronously]]
+    # Imported here to avoid an import cycle, since the views import
+    # the event queue code, which imports the handlers.
+    from zerver.tornado.views import get_events_backend
+
+    # Set for update_user_activity, like rest_dispatch does.
+    request._query = get_events_backend.__name__
+    if request.path.startswith('/json/'):
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if session_key is not None:
+            session_store = import_module(settings.SESSION_ENGINE).SessionStore
+            request.session = session_store(session_key)
+            # The auth backends look the user up via the cache.
+            request.user = get_user(request)
+            if request.user.is_authenticated:
+                # GET requests don't need a CSRF check.
+                return authenticate_log_and_execute_json(request, get_events_backend)
+    if 'HTTP_AUTHORIZATION' in request.META:
+        return authenticated_rest_api_view()(get_events_backend)(request)
+    return None
+
+def get_events_fast_path(request):
+    # type: (HttpRequest) -> Optional[Union[HttpResponse, _RespondAsynchronously]]
+    """Serves a request for which is_fast_path_request is true.  Returns
+    None if the request needs to go through the full Django stack
+    instead, or RespondAsynchronously if the request is waiting for
+    events and will be finished later via AsyncDjangoHandler.zulip_finish."""
+    for middleware in FAST_PATH_MIDDLEWARE:
+        if hasattr(middleware, 'process_request'):
+            middleware.process_request(request)
+
+    try:
+        response = authenticate_and_get_events(request)
+    except Exception as e:
+        response = None
+        for middleware in reversed(FAST_PATH_MIDDLEWARE):
+            if hasattr(middleware, 'process_exception'):
+                response = middleware.process_exception(request, e)
+                if response is not None:
+                    break
+        if response is None:
+            raise
+    else:
+        if response is None:
+            return None
+
+    request._events_fast_path = True
+    if response is RespondAsynchronously:
+        async_request_stop(request)
+        return response
+    return finish_fast_path_response(request, response)
+
+def finish_fast_path_response(request, response):
+    # type: (HttpRequest, HttpResponse) -> HttpResponse
+    for middleware in reversed(FAST_PATH_MIDDLEWARE):
+        if hasattr(middleware, 'process_response'):
+            response = middleware.process_response(request, response)
+    return response
@@ -20,12 +20,15 @@ from threading import Lock
 from tornado.wsgi import WSGIContainer
 from six.moves import urllib
 
-from zerver.decorator import RespondAsynchronously
+from zerver.decorator import RespondAsynchronously, _RespondAsynchronously
 from zerver.lib.response import json_response
 from zerver.middleware import async_request_stop, async_request_restart
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
+from zerver.tornado.event_encoding import json_events_response
+from zerver.tornado.fast_path import finish_fast_path_response, get_events_fast_path, \
+    is_fast_path_request
 
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Union
 
 current_handler_id = 0
 handlers = {}  # type: Dict[int, AsyncDjangoHandler]
@@ -66,9 +69,9 @@ def finish_handler(handler_id, event_queue_id, contents, apply_markdown):
             request._log_data['extra'] = "[%s/1/%s]" % (event_queue_id, contents[0]["type"])
 
         handler.zulip_finish(dict(result='success', msg='',
-                                  events=contents,
                                   queue_id=event_queue_id),
-                             request, apply_markdown=apply_markdown)
+                             request, apply_markdown=apply_markdown,
+                             events=contents)
     except IOError as e:
         if str(e) != 'Stream is closed':
             logging.exception(err_msg)
@@ -87,14 +90,9 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # type: (*Any, **Any) -> None
         super(AsyncDjangoHandler, self).__init__(*args, **kwargs)
 
-        # Set up middleware if needed. We couldn't do this earlier, because
-        # settings weren't available.
+        # The middleware is loaded when the request needs it (i.e.
+        # unless it's served by the fast path); see get().
         self._request_middleware = None  # type: Optional[List[Callable]]
-        self.initLock.acquire()
-        # Check that middleware is still uninitialised.
-        if self._request_middleware is None:
-            self.load_middleware()
-        self.initLock.release()
         self._auto_finish = False
         # Handler IDs are allocated here, and the handler ID map must
         # be cleared when the handler finishes its response
@@ -162,9 +160,25 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         set_script_prefix(get_script_name(environ))
         signals.request_started.send(sender=self.__class__)
         try:
-            response = self.get_response(request)
-
-            if not response:
+            response = None  # type: Optional[Union[HttpResponse, _RespondAsynchronously]]
+            if is_fast_path_request(request):
+                try:
+                    response = get_events_fast_path(request)
+                except Exception:
+                    clear_handler_by_id(self.handler_id)
+                    raise
+                if response is not None and response is not RespondAsynchronously:
+                    clear_handler_by_id(self.handler_id)
+
+            # If the fast path didn't serve the request, fall back to
+            # the full Django stack.
+            if response is None:
+                with self.initLock:
+                    if self._request_middleware is None:
+                        self.load_middleware()
+                response = self.get_response(request)
+
+            if not response or response is RespondAsynchronously:
                 return
         finally:
             signals.request_finished.send(sender=self.__class__)
@@ -338,8 +352,8 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
 
         return response
 
-    def zulip_finish(self, response, request, apply_markdown):
-        # type: (Dict[str, Any], HttpRequest, bool) -> None
+    def zulip_finish(self, response, request, apply_markdown, events=None):
+        # type: (Dict[str, Any], HttpRequest, bool, Optional[List[Dict[str, Any]]]) -> None
         # Make sure that Markdown rendering really happened, if requested.
         # This is a security issue because it's where we escape HTML.
         # c.f. ticket #64
@@ -358,10 +372,19 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # the headers from that since sending those to Tornado seems
         # tricky; instead just send the (already json-rendered)
         # content on to Tornado
-        django_response = json_response(res_type=response['result'],
-                                        data=response, status=self.get_status())
-        django_response = self.apply_response_middleware(request, django_response,
-                                                         request._resolver)
+        if events is not None:
+            # Event queue contents are encoded using pre-encoded
+            # message fragments; see zerver/tornado/event_encoding.py.
+            django_response = json_events_response(dict(response, events=events),
+                                                   status=self.get_status())
+        else:
+            django_response = json_response(res_type=response['result'],
+                                            data=response, status=self.get_status())
+        if getattr(request, '_events_fast_path', False):
+            django_response = finish_fast_path_response(request, django_response)
+        else:
+            django_response = self.apply_response_middleware(request, django_response,
+                                                             request._resolver)
         # Pass through the content-type from Django, as json content should be
         # served as application/json
         self.set_header("Content-Type", django_response['Content-Type'])
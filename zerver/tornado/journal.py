@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+
+import logging
+import os
+import ujson
+
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Text, Tuple
+
+# The event queue journal records every change to the Tornado event
+# queues since the last snapshot (see dump_event_queues), so that a
+# crashed Tornado process can be restored from the snapshot plus the
+# journal instead of losing every queue.
+#
+# The journal is a file of JSON lines.  The first line is a header
+# recording the journal generation, which must match the generation
+# stored in the snapshot for the journal to be replayed; this protects
+# against replaying a stale journal on top of a newer snapshot.
+#
+# Records are buffered in memory and written out by flush(), which
+# Tornado calls every EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS, so a
+# crash loses at most that much data.
+#
+# Message events are usually delivered to many queues with the same
+# message dict, so each distinct message dict is written once per
+# flush, and the per-queue event records refer to it by number.
+
+class EventQueueJournal(object):
+    def __init__(self, filename, generation):
+        # type: (str, int) -> None
+        self.filename = filename
+        self.generation = generation
+        self.buffer = []  # type: List[str]
+        # Maps id() of a message dict to (message_ref, message dict);
+        # we keep a reference to the dict so its id() can't be reused
+        # before the next flush.
+        self.message_refs = {}  # type: Dict[int, Tuple[int, Dict[str, Any]]]
+        self.next_message_ref = 0
+        self.file = open(filename, "w")
+        self.file.write(ujson.dumps(dict(op="header", generation=generation)) + "\n")
+        self.file.flush()
+
+    def _record(self, record):
+        # type: (Mapping[str, Any]) -> None
+        self.buffer.append(ujson.dumps(record))
+
+    def record_create(self, queue_id, client_dict):
+        # type: (str, Mapping[str, Any]) -> None
+        self._record(dict(op="create", queue_id=queue_id, client=client_dict))
+
+    def record_event(self, queue_id, event):
+        # type: (str, Mapping[str, Any]) -> None
+        if event["type"] != "message":
+            self._record(dict(op="event", queue_id=queue_id, event=event))
+            return
+
+        message_dict = event["message"]
+        if id(message_dict) in self.message_refs:
+            message_ref = self.message_refs[id(message_dict)][0]
+        else:
+            message_ref = self.next_message_ref
+            self.next_message_ref += 1
+            self.message_refs[id(message_dict)] = (message_ref, message_dict)
+            self._record(dict(op="message", message_ref=message_ref, message=message_dict))
+        event_without_message = dict(event)
+        del event_without_message["message"]
+        self._record(dict(op="event", queue_id=queue_id, event=event_without_message,
+                          message_ref=message_ref))
+
+    def record_prune(self, queue_id, through_id):
+        # type: (str, int) -> None
+        self._record(dict(op="prune", queue_id=queue_id, through_id=through_id))
+
+    def record_connect(self, queue_id, last_connection_time):
+        # type: (str, float) -> None
+        self._record(dict(op="connect", queue_id=queue_id,
+                          last_connection_time=last_connection_time))
+
+    def record_gc(self, queue_ids):
+        # type: (List[str]) -> None
+        self._record(dict(op="gc", queue_ids=queue_ids))
+
+    def flush(self):
+        # type: () -> None
+        if self.buffer:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.file.flush()
+            self.buffer = []
+        self.message_refs = {}
+
+    def close(self):
+        # type: () -> None
+        self.flush()
+        self.file.close()
+
+def read_journal(filename, generation):
+    # type: (str, int) -> Iterator[Dict[str, Any]]
+    """Yields the records of the journal at `filename`, with message
+    references resolved, if it belongs to journal generation
+    `generation`.  A truncated final line (from a crash in the middle
+    of a flush) is ignored."""
+    try:
+        journal_file = open(filename, "r")
+    except (IOError, OSError):
+        return
+
+    with journal_file:
+        header_line = journal_file.readline()
+        try:
+            header = ujson.loads(header_line)
+        except ValueError:
+            logging.warning("Ignoring event queue journal %s with a bad header" % (filename,))
+            return
+        if header.get("generation") != generation:
+            logging.info("Ignoring stale event queue journal %s (generation %s, expected %s)"
+                         % (filename, header.get("generation"), generation))
+            return
+
+        messages = {}  # type: Dict[int, Dict[str, Any]]
+        for line in journal_file:
+            try:
+                record = ujson.loads(line)
+            except ValueError:
+                logging.warning("Stopping at truncated record in event queue journal %s" % (filename,))
+                return
+            if record["op"] == "message":
+                messages[record["message_ref"]] = record["message"]
+                continue
+            if record["op"] == "event" and "message_ref" in record:
+                record["event"]["message"] = messages[record["message_ref"]]
+            yield record
+
+def journal_filename(snapshot_filename):
+    # type: (str) -> str
+    return snapshot_filename + ".journal"
+
+def write_snapshot(filename, generation, queues):
+    # type: (str, int, List[Tuple[str, Dict[str, Any]]]) -> None
+    """Atomically replaces the snapshot at `filename`."""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as stored_queues:
+        ujson.dump(dict(journal_generation=generation, queues=queues), stored_queues)
+    os.rename(tmp_filename, filename)
+
+def read_snapshot(json_data):
+    # type: (Text) -> Tuple[Optional[int], List[Tuple[str, Dict[str, Any]]]]
+    """Returns the journal generation and the queues stored in a
+    snapshot.  Snapshots from before the journal was added are just a
+    list of queues, and have no journal generation."""
+    data = ujson.loads(json_data)
+    if isinstance(data, list):
+        return None, data
+    return data["journal_generation"], data["queues"]
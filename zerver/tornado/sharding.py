@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+
+from django.conf import settings
+from six.moves.urllib.parse import urlsplit, urlunsplit
+from typing import Optional
+
+# The event queue system can be sharded across several Tornado
+# processes (settings.TORNADO_PROCESSES).  Users are assigned to
+# shards by user ID, so every event queue for a given user lives in
+# the same Tornado process.  Shard N listens on the port of
+# settings.TORNADO_SERVER plus N.
+#
+# Queue IDs allocated on a sharded server are prefixed with the shard
+# number, so that the frontend proxy can route /json/events requests
+# to the right process.  The proxy only sees the query string, so
+# requests for a queue must pass queue_id there, not in the body.
+
+def get_tornado_shard_count():
+    # type: () -> int
+    return max(1, settings.TORNADO_PROCESSES)
+
+def is_sharded():
+    # type: () -> bool
+    return get_tornado_shard_count() > 1
+
+def get_user_shard(user_profile_id):
+    # type: (int) -> int
+    return user_profile_id % get_tornado_shard_count()
+
+def get_current_shard():
+    # type: () -> int
+    return settings.TORNADO_SHARD
+
+def get_tornado_base_port():
+    # type: () -> int
+    port = urlsplit(settings.TORNADO_SERVER).port
+    assert port is not None
+    return port
+
+def get_shard_for_port(port):
+    # type: (int) -> int
+    shard = port - get_tornado_base_port()
+    if not 0 <= shard < get_tornado_shard_count():
+        raise ValueError("Port %d does not belong to any Tornado shard" % (port,))
+    return shard
+
+def get_tornado_uri(shard):
+    # type: (int) -> str
+    if shard == 0:
+        return settings.TORNADO_SERVER
+    parts = urlsplit(settings.TORNADO_SERVER)
+    netloc = "%s:%d" % (parts.hostname, get_tornado_base_port() + shard)
+    return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+
+def get_user_tornado_uri(user_profile_id):
+    # type: (int) -> str
+    return get_tornado_uri(get_user_shard(user_profile_id))
+
+def notify_tornado_queue_name(shard):
+    # type: (int) -> str
+    if not is_sharded():
+        return "notify_tornado"
+    return "notify_tornado_shard%d" % (shard,)
+
+def tornado_return_queue_name(shard):
+    # type: (int) -> str
+    if not is_sharded():
+        return "tornado_return"
+    return "tornado_return_shard%d" % (shard,)
+
+def get_queue_id_shard(queue_id):
+    # type: (str) -> Optional[int]
+    """Returns the shard that allocated queue_id, or None if it
+    wasn't allocated by a sharded server."""
+    parts = queue_id.split(':')
+    if len(parts) != 3 or not parts[0].isdigit():
+        return None
+    return int(parts[0])
+
+def make_queue_id(server_generation, queue_number):
+    # type: (int, int) -> str
+    queue_id = str(server_generation) + ':' + str(queue_number)
+    if is_sharded():
+        queue_id = str(get_current_shard()) + ':' + queue_id
+    return queue_id
+
+def persistent_queue_filename(shard):
+    # type: (int) -> str
+    if not is_sharded():
+        return settings.JSON_PERSISTENT_QUEUE_FILENAME
+    return "%s.shard%d" % (settings.JSON_PERSISTENT_QUEUE_FILENAME, shard)
@@ -12,8 +12,10 @@ from zerver.decorator import asynchronous, \
 from zerver.lib.response import json_success, json_error
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.tornado.event_queue import get_client_descriptor, \
-    process_notification, fetch_events
+    process_notification_batch, fetch_events
+from zerver.tornado.event_encoding import json_events_response
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.sharding import get_current_shard, get_queue_id_shard, is_sharded
 from django.core.handlers.base import BaseHandler
 
 from typing import Union, Optional, Iterable, Sequence, List, Text
@@ -23,7 +25,7 @@ import ujson
 @internal_notify_view(True)
 def notify(request):
     # type: (HttpRequest) -> HttpResponse
-    process_notification(ujson.loads(request.POST['data']))
+    process_notification_batch(ujson.loads(request.POST['data']))
     return json_success()
 
 @has_request_variables
@@ -31,6 +33,11 @@ def cleanup_event_queue(request, user_profile, queue_id=REQ()):
     # type: (HttpRequest, UserProfile, Text) -> HttpResponse
     client = get_client_descriptor(str(queue_id))
     if client is None:
+        shard = get_queue_id_shard(str(queue_id))
+        if is_sharded() and shard is not None and shard != get_current_shard():
+            # The proxy routes by the query string, so a queue_id
+            # passed in the request body ends up on the default shard.
+            return json_error(_("queue_id must be passed in the query string"))
         raise BadEventQueueIdError(queue_id)
     if user_profile.id != client.user_profile_id:
         return json_error(_("You are not authorized to access this queue"))
@@ -89,4 +96,4 @@ def get_events_backend(request, user_profile, handler,
         return RespondAsynchronously
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    return json_events_response(result["response"])
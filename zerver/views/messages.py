@@ -3,12 +3,12 @@ from __future__ import absolute_import
 from django.utils.translation import ugettext as _
 from django.utils.timezone import now as timezone_now
 from django.conf import settings
-from django.core import validators
+from django.core import signing, validators
 from django.core.exceptions import ValidationError
 from django.db import connection
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from typing import Dict, List, Set, Text, Any, AnyStr, Callable, Iterable, \
-    Optional, Tuple, Union
+    Iterator, Optional, Tuple, Union
 from zerver.lib.str_utils import force_text
 from zerver.lib.exceptions import JsonableError, ErrorCode
 from zerver.lib.html_diff import highlight_html_differences
@@ -579,19 +579,13 @@ def exclude_muting_conditions(user_profile, narrow):
 
     return conditions
 
-@has_request_variables
-def get_messages_backend(request, user_profile,
-                         anchor = REQ(converter=int),
-                         num_before = REQ(converter=to_non_negative_int),
-                         num_after = REQ(converter=to_non_negative_int),
-                         narrow = REQ('narrow', converter=narrow_parameter, default=None),
-                         use_first_unread_anchor = REQ(default=False, converter=ujson.loads),
-                         apply_markdown=REQ(default=True,
-                                            converter=ujson.loads)):
-    # type: (HttpRequest, UserProfile, int, int, int, Optional[List[Dict[str, Any]]], bool, bool) -> HttpResponse
-    include_history = ok_to_include_history(narrow, user_profile.realm)
-
-    if include_history and not use_first_unread_anchor:
+def get_base_query(user_profile, narrow, include_history, need_flags):
+    # type: (UserProfile, Optional[List[Dict[str, Any]]], bool, bool) -> Tuple[Select, ColumnElement]
+    """Returns the query for all messages this user might see, before
+    the narrow is applied, along with the message ID column to filter
+    and order it by.  need_flags ensures the query reads from
+    `zerver_usermessage`, for callers that filter on flags."""
+    if include_history and not need_flags:
         # The initial query in this case doesn't use `zerver_usermessage`,
         # and isn't yet limited to messages the user is entitled to see!
         #
@@ -600,7 +594,7 @@ def get_messages_backend(request, user_profile,
         # See `ok_to_include_history` for details.
         query = select([column("id").label("message_id")], None, table("zerver_message"))
         inner_msg_id_col = literal_column("zerver_message.id")
-    elif narrow is None and not use_first_unread_anchor:
+    elif narrow is None and not need_flags:
         # This is limited to messages the user received, as recorded in `zerver_usermessage`.
         query = select([column("message_id"), column("flags")],
                        column("user_profile_id") == literal(user_profile.id),
@@ -615,113 +609,84 @@ def get_messages_backend(request, user_profile,
                             literal_column("zerver_usermessage.message_id") ==
                             literal_column("zerver_message.id")))
         inner_msg_id_col = column("message_id")
+    return query, inner_msg_id_col
 
-    num_extra_messages = 1
+def add_narrow_conditions(user_profile, inner_msg_id_col, query, narrow):
+    # type: (UserProfile, ColumnElement, Select, Optional[List[Dict[str, Any]]]) -> Tuple[Select, bool]
+    """Limits query to the messages matching narrow.  Also returns
+    whether this is a search, in which case the query has the extra
+    columns get_search_fields needs."""
     is_search = False
-
-    if narrow is not None:
-        # Add some metadata to our logging data for narrows
-        verbose_operators = []
-        for term in narrow:
-            if term['operator'] == "is":
-                verbose_operators.append("is:" + term['operand'])
-            else:
-                verbose_operators.append(term['operator'])
-        request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
-
-        # Build the query for the narrow
-        num_extra_messages = 0
-        builder = NarrowBuilder(user_profile, inner_msg_id_col)
-        search_term = None  # type: Optional[Dict[str, Any]]
-        for term in narrow:
-            if term['operator'] == 'search':
-                if not is_search:
-                    search_term = term
-                    query = query.column(column("subject")).column(column("rendered_content"))
-                    is_search = True
-                else:
-                    # Join the search operators if there are multiple of them
-                    search_term['operand'] += ' ' + term['operand']
+    if narrow is None:
+        return query, is_search
+
+    builder = NarrowBuilder(user_profile, inner_msg_id_col)
+    search_term = None  # type: Optional[Dict[str, Any]]
+    for term in narrow:
+        if term['operator'] == 'search':
+            if not is_search:
+                # Copied, since we modify it below and the caller
+                # might reuse the narrow.
+                search_term = dict(term)
+                query = query.column(column("subject")).column(column("rendered_content"))
+                is_search = True
             else:
-                query = builder.add_term(query, term)
-        if is_search:
-            query = builder.add_term(query, search_term)
-
-    # We add 1 to the number of messages requested if no narrow was
-    # specified to ensure that the resulting list always contains the
-    # anchor message.  If a narrow was specified, the anchor message
-    # might not match the narrow anyway.
-    if num_after != 0:
-        num_after += num_extra_messages
-    else:
-        num_before += num_extra_messages
-
-    sa_conn = get_sqlalchemy_connection()
-    if use_first_unread_anchor:
-        condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
-
-        # We exclude messages on muted topics when finding the first unread
-        # message in this narrow
-        muting_conditions = exclude_muting_conditions(user_profile, narrow)
-        if muting_conditions:
-            condition = and_(condition, *muting_conditions)
-
-        # The mobile app uses narrow=[] and use_first_unread_anchor=True to
-        # determine what messages to show when you first load the app.
-        # Unfortunately, this means that if you have a years-old unread
-        # message, the mobile app could get stuck in the past.
-        #
-        # To fix this, we enforce that the "first unread anchor" must be on or
-        # after the user's current pointer location. Since the pointer
-        # location refers to the latest the user has read in the home view,
-        # we'll only apply this logic in the home view (ie, when narrow is
-        # empty).
-        if not narrow:
-            pointer_condition = inner_msg_id_col >= user_profile.pointer
-            condition = and_(condition, pointer_condition)
-
-        first_unread_query = query.where(condition)
-        first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
-        first_unread_result = list(sa_conn.execute(first_unread_query).fetchall())
-        if len(first_unread_result) > 0:
-            anchor = first_unread_result[0][0]
+                # Join the search operators if there are multiple of them
+                search_term['operand'] += ' ' + term['operand']
         else:
-            anchor = LARGER_THAN_MAX_MESSAGE_ID
-
-    before_query = None
-    after_query = None
-    if num_before != 0:
-        before_anchor = anchor
-        if num_after != 0:
-            # Don't include the anchor in both the before query and the after query
-            before_anchor = anchor - 1
-        before_query = query.where(inner_msg_id_col <= before_anchor) \
-                            .order_by(inner_msg_id_col.desc()).limit(num_before)
-    if num_after != 0:
-        after_query = query.where(inner_msg_id_col >= anchor) \
-                           .order_by(inner_msg_id_col.asc()).limit(num_after)
-
-    if anchor == LARGER_THAN_MAX_MESSAGE_ID:
-        # There's no need for an after_query if we're targeting just the target message.
-        after_query = None
-
-    if before_query is not None:
-        if after_query is not None:
-            query = union_all(before_query.self_group(), after_query.self_group())
+            query = builder.add_term(query, term)
+    if is_search:
+        query = builder.add_term(query, search_term)
+    return query, is_search
+
+def log_narrow(request, narrow):
+    # type: (HttpRequest, Optional[List[Dict[str, Any]]]) -> None
+    if narrow is None:
+        return
+    # Add some metadata to our logging data for narrows
+    verbose_operators = []
+    for term in narrow:
+        if term['operator'] == "is":
+            verbose_operators.append("is:" + term['operand'])
         else:
-            query = before_query
-    elif after_query is not None:
-        query = after_query
-    else:
-        # This can happen when a narrow is specified.
-        query = query.where(inner_msg_id_col == anchor)
-
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_messages */")
-    query_result = list(sa_conn.execute(query).fetchall())
-
+            verbose_operators.append(term['operator'])
+    request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
+
+def find_first_unread_anchor(sa_conn, user_profile, narrow, query, inner_msg_id_col):
+    # type: (Any, UserProfile, Optional[List[Dict[str, Any]]], Select, ColumnElement) -> int
+    condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
+
+    # We exclude messages on muted topics when finding the first unread
+    # message in this narrow
+    muting_conditions = exclude_muting_conditions(user_profile, narrow)
+    if muting_conditions:
+        condition = and_(condition, *muting_conditions)
+
+    # The mobile app uses narrow=[] and use_first_unread_anchor=True to
+    # determine what messages to show when you first load the app.
+    # Unfortunately, this means that if you have a years-old unread
+    # message, the mobile app could get stuck in the past.
+    #
+    # To fix this, we enforce that the "first unread anchor" must be on or
+    # after the user's current pointer location. Since the pointer
+    # location refers to the latest the user has read in the home view,
+    # we'll only apply this logic in the home view (ie, when narrow is
+    # empty).
+    if not narrow:
+        pointer_condition = inner_msg_id_col >= user_profile.pointer
+        condition = and_(condition, pointer_condition)
+
+    first_unread_query = query.where(condition)
+    first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
+    first_unread_result = list(sa_conn.execute(first_unread_query).fetchall())
+    if len(first_unread_result) > 0:
+        return first_unread_result[0][0]
+    return LARGER_THAN_MAX_MESSAGE_ID
+
+def messages_for_rows(user_profile, query_result, include_history, is_search, apply_markdown):
+    # type: (UserProfile, List[Any], bool, bool, bool) -> List[Dict[str, Any]]
+    """Turns the rows returned by a query built with get_base_query and
+    add_narrow_conditions into message dicts to send to the client."""
     # The following is a little messy, but ensures that the code paths
     # are similar regardless of the value of include_history.  The
     # 'user_messages' dictionary maps each message to the user's
@@ -781,6 +746,77 @@ def get_messages_backend(request, user_profile,
         if "edit_history" in msg_dict and not user_profile.realm.allow_edit_history:
             del msg_dict["edit_history"]
         message_list.append(msg_dict)
+    return message_list
+
+@has_request_variables
+def get_messages_backend(request, user_profile,
+                         anchor = REQ(converter=int),
+                         num_before = REQ(converter=to_non_negative_int),
+                         num_after = REQ(converter=to_non_negative_int),
+                         narrow = REQ('narrow', converter=narrow_parameter, default=None),
+                         use_first_unread_anchor = REQ(default=False, converter=ujson.loads),
+                         apply_markdown=REQ(default=True,
+                                            converter=ujson.loads)):
+    # type: (HttpRequest, UserProfile, int, int, int, Optional[List[Dict[str, Any]]], bool, bool) -> HttpResponse
+    include_history = ok_to_include_history(narrow, user_profile.realm)
+    query, inner_msg_id_col = get_base_query(user_profile, narrow, include_history,
+                                             need_flags=use_first_unread_anchor)
+
+    num_extra_messages = 1
+    if narrow is not None:
+        log_narrow(request, narrow)
+        num_extra_messages = 0
+    query, is_search = add_narrow_conditions(user_profile, inner_msg_id_col, query, narrow)
+
+    # We add 1 to the number of messages requested if no narrow was
+    # specified to ensure that the resulting list always contains the
+    # anchor message.  If a narrow was specified, the anchor message
+    # might not match the narrow anyway.
+    if num_after != 0:
+        num_after += num_extra_messages
+    else:
+        num_before += num_extra_messages
+
+    sa_conn = get_sqlalchemy_connection()
+    if use_first_unread_anchor:
+        anchor = find_first_unread_anchor(sa_conn, user_profile, narrow, query, inner_msg_id_col)
+
+    before_query = None
+    after_query = None
+    if num_before != 0:
+        before_anchor = anchor
+        if num_after != 0:
+            # Don't include the anchor in both the before query and the after query
+            before_anchor = anchor - 1
+        before_query = query.where(inner_msg_id_col <= before_anchor) \
+                            .order_by(inner_msg_id_col.desc()).limit(num_before)
+    if num_after != 0:
+        after_query = query.where(inner_msg_id_col >= anchor) \
+                           .order_by(inner_msg_id_col.asc()).limit(num_after)
+
+    if anchor == LARGER_THAN_MAX_MESSAGE_ID:
+        # There's no need for an after_query if we're targeting just the target message.
+        after_query = None
+
+    if before_query is not None:
+        if after_query is not None:
+            query = union_all(before_query.self_group(), after_query.self_group())
+        else:
+            query = before_query
+    elif after_query is not None:
+        query = after_query
+    else:
+        # This can happen when a narrow is specified.
+        query = query.where(inner_msg_id_col == anchor)
+
+    main_query = alias(query)
+    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+    # This is a hack to tag the query we use for testing
+    query = query.prefix_with("/* get_messages */")
+    query_result = list(sa_conn.execute(query).fetchall())
+
+    message_list = messages_for_rows(user_profile, query_result, include_history,
+                                     is_search, apply_markdown)
 
     statsd.incr('loaded_old_messages', len(message_list))
     ret = {'messages': message_list,
@@ -788,6 +824,147 @@ def get_messages_backend(request, user_profile,
            "msg": ""}
     return json_success(ret)
 
+# Limits on num_messages for get_messages_page_backend; streamed
+# responses are read from the database STREAM_CHUNK_SIZE messages at
+# a time, so they can be much longer.
+MAX_MESSAGES_PER_PAGE = 1000
+MAX_MESSAGES_PER_STREAMED_PAGE = 100000
+STREAM_CHUNK_SIZE = 1000
+
+MESSAGES_CURSOR_SALT = 'zerver.views.messages.cursor'
+
+def make_messages_cursor(user_profile, narrow, direction, last_id, apply_markdown):
+    # type: (UserProfile, Optional[List[Dict[str, Any]]], Text, int, bool) -> str
+    return signing.dumps(dict(user_profile_id=user_profile.id,
+                              narrow=narrow,
+                              direction=direction,
+                              last_id=last_id,
+                              apply_markdown=apply_markdown),
+                         salt=MESSAGES_CURSOR_SALT, compress=True)
+
+def parse_messages_cursor(user_profile, cursor):
+    # type: (UserProfile, Text) -> Dict[str, Any]
+    try:
+        data = signing.loads(cursor, salt=MESSAGES_CURSOR_SALT)
+    except signing.BadSignature:
+        raise JsonableError(_("Invalid cursor"))
+    # Cursors are signed, but not encrypted, and the narrow they
+    # contain is only checked against the user's permissions when it
+    # is applied; so only accept a user's own cursors.
+    if data['user_profile_id'] != user_profile.id:
+        raise JsonableError(_("Invalid cursor"))
+    return data
+
+def get_page_query(query, inner_msg_id_col, direction, last_id, limit):
+    # type: (Select, ColumnElement, Text, int, int) -> Select
+    if direction == 'newer':
+        query = query.where(inner_msg_id_col > last_id).order_by(inner_msg_id_col.asc())
+    else:
+        query = query.where(inner_msg_id_col < last_id).order_by(inner_msg_id_col.desc())
+    # This is a hack to tag the query we use for testing
+    return query.limit(limit).prefix_with("/* get_messages */")
+
+@has_request_variables
+def get_messages_page_backend(request, user_profile,
+                              cursor=REQ(default=None),
+                              anchor=REQ(converter=int, default=None),
+                              direction=REQ(default='newer'),
+                              num_messages=REQ(converter=to_non_negative_int, default=100),
+                              narrow=REQ('narrow', converter=narrow_parameter, default=None),
+                              use_first_unread_anchor=REQ(validator=check_bool, default=False),
+                              apply_markdown=REQ(validator=check_bool, default=True),
+                              stream=REQ(validator=check_bool, default=False)):
+    # type: (HttpRequest, UserProfile, Optional[Text], Optional[int], Text, int, Optional[List[Dict[str, Any]]], bool, bool, bool) -> HttpResponse
+    """A keyset-paginated variant of get_messages_backend.  The first
+    request gives the narrow, a direction ('newer' or 'older') and
+    optionally an anchor, which is included in the results; the
+    response contains the matching messages in that direction, in the
+    order they were found, along with a `cursor` to pass instead to
+    get the next page.  Since the cursor records the narrow, direction
+    and the last message ID returned, every later page is a single
+    range scan on the message ID.  `cursor` is None once there are no
+    more messages.
+
+    With stream=True, the response is streamed as it is read from the
+    database, which lets bulk readers fetch much larger pages."""
+    if cursor is not None:
+        data = parse_messages_cursor(user_profile, cursor)
+        narrow = data['narrow']
+        direction = data['direction']
+        last_id = data['last_id']
+        apply_markdown = data['apply_markdown']
+    elif direction not in ('newer', 'older'):
+        return json_error(_("Invalid direction"))
+
+    max_messages = MAX_MESSAGES_PER_STREAMED_PAGE if stream else MAX_MESSAGES_PER_PAGE
+    if num_messages < 1:
+        return json_error(_("num_messages must be at least 1"))
+    if num_messages > max_messages:
+        return json_error(_("Too many messages requested (maximum %s).") % (max_messages,))
+
+    log_narrow(request, narrow)
+    include_history = ok_to_include_history(narrow, user_profile.realm)
+    sa_conn = get_sqlalchemy_connection()
+
+    if cursor is None:
+        if use_first_unread_anchor:
+            unread_query, unread_msg_id_col = get_base_query(user_profile, narrow,
+                                                             include_history, need_flags=True)
+            unread_query = add_narrow_conditions(user_profile, unread_msg_id_col,
+                                                 unread_query, narrow)[0]
+            anchor = find_first_unread_anchor(sa_conn, user_profile, narrow,
+                                              unread_query, unread_msg_id_col)
+        elif anchor is None:
+            anchor = 0 if direction == 'newer' else LARGER_THAN_MAX_MESSAGE_ID
+        # The anchor itself is included in the first page.
+        last_id = anchor - 1 if direction == 'newer' else anchor + 1
+
+    query, inner_msg_id_col = get_base_query(user_profile, narrow, include_history,
+                                             need_flags=False)
+    query, is_search = add_narrow_conditions(user_profile, inner_msg_id_col, query, narrow)
+
+    def fetch(last_id, limit):
+        # type: (int, int) -> List[Dict[str, Any]]
+        page_query = get_page_query(query, inner_msg_id_col, direction, last_id, limit)
+        query_result = list(sa_conn.execute(page_query).fetchall())
+        return messages_for_rows(user_profile, query_result, include_history,
+                                 is_search, apply_markdown)
+
+    def next_cursor(message_list, limit):
+        # type: (List[Dict[str, Any]], int) -> Optional[str]
+        if len(message_list) < limit:
+            return None
+        return make_messages_cursor(user_profile, narrow, direction,
+                                    message_list[-1]['id'], apply_markdown)
+
+    if not stream:
+        message_list = fetch(last_id, num_messages)
+        statsd.incr('loaded_old_messages', len(message_list))
+        return json_success({'messages': message_list,
+                             'cursor': next_cursor(message_list, num_messages)})
+
+    def stream_messages(last_id):
+        # type: (int) -> Iterator[str]
+        yield '{"result":"success","msg":"","messages":['
+        remaining = num_messages
+        new_cursor = None  # type: Optional[str]
+        separator = ''
+        while remaining > 0:
+            limit = min(remaining, STREAM_CHUNK_SIZE)
+            message_list = fetch(last_id, limit)
+            statsd.incr('loaded_old_messages', len(message_list))
+            for msg_dict in message_list:
+                yield separator + ujson.dumps(msg_dict)
+                separator = ','
+            new_cursor = next_cursor(message_list, limit)
+            if new_cursor is None:
+                break
+            last_id = message_list[-1]['id']
+            remaining -= limit
+        yield '],"cursor":%s}' % (ujson.dumps(new_cursor),)
+
+    return StreamingHttpResponse(stream_messages(last_id), content_type='application/json')
+
 @has_request_variables
 def update_message_flags(request, user_profile,
                          messages=REQ(validator=check_list(check_int)),
@@ -12,8 +12,9 @@ from django.db import connection
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.handlers.base import BaseHandler
 from zerver.models import \
-    get_client, get_prereg_user_by_email, get_system_bot, ScheduledEmail, \
-    get_user_profile_by_id, Message, Realm, Service, UserMessage, UserProfile
+    flush_per_request_caches, get_client, get_prereg_user_by_email, get_system_bot, ScheduledEmail, \
+    get_user_profile_by_id, bulk_get_user_profiles_by_id, Message, Realm, Service, \
+    UserMessage, UserProfile
 from zerver.lib.context_managers import lockfile
 from zerver.lib.error_notify import do_report_error
 from zerver.lib.feedback import handle_feedback
@@ -23,7 +24,7 @@ from zerver.lib.notifications import handle_missedmessage_emails, enqueue_welcom
     clear_scheduled_emails
 from zerver.lib.push_notifications import handle_push_notification
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    bulk_update_user_activity, bulk_update_user_activity_interval, bulk_update_user_presence, \
     internal_send_message, check_send_message, extract_recipients, \
     render_incoming_message, do_update_embedded_data
 from zerver.lib.url_preview import preview as url_preview
@@ -119,19 +120,26 @@ class QueueProcessingWorker(object):
         try:
             self.consume(data)
         except Exception:
-            self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = u'%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
-            check_and_send_restart_signal()
+            self._handle_consume_exception([data])
         finally:
             reset_queries()
+            # Each event is the worker's equivalent of a request.
+            flush_per_request_caches()
+
+    def _handle_consume_exception(self, events):
+        # type: (List[Mapping[str, Any]]) -> None
+        self._log_problem()
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lines = u''.join(u'%s\t%s\n' % (time.asctime(), ujson.dumps(event))
+                         for event in events)
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                f.write(lines.encode('utf-8'))
+        check_and_send_restart_signal()
 
     def _log_problem(self):
         # type: () -> None
@@ -150,6 +158,35 @@ class QueueProcessingWorker(object):
         # type: () -> None
         self.q.stop_consuming()
 
+class LoopQueueProcessingWorker(QueueProcessingWorker):
+    """A worker that periodically drains its queue and processes all the
+    events in it at once, for queues where handling events in batches
+    is much cheaper than handling them one at a time."""
+    sleep_delay = 1  # type: int
+
+    def start(self):
+        # type: () -> None
+        while True:
+            self.process_one_batch()
+            time.sleep(self.sleep_delay)
+
+    def process_one_batch(self):
+        # type: () -> None
+        events = self.q.drain_queue(self.queue_name, json=True)
+        if len(events) == 0:
+            return
+        try:
+            self.consume_batch(events)
+        except Exception:
+            self._handle_consume_exception(events)
+        finally:
+            reset_queries()
+            flush_per_request_caches()
+
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        raise WorkerDeclarationException("No batch consumer defined!")
+
 @assign_queue('signups')
 class SignupWorker(QueueProcessingWorker):
     def consume(self, data):
@@ -196,34 +233,46 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
             context=context,
             delay=datetime.timedelta(days=2))
 
-@assign_queue('user_activity')
-class UserActivityWorker(QueueProcessingWorker):
-    def consume(self, event):
-        # type: (Mapping[str, Any]) -> None
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
-
-@assign_queue('user_activity_interval')
-class UserActivityIntervalWorker(QueueProcessingWorker):
-    def consume(self, event):
-        # type: (Mapping[str, Any]) -> None
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
-
-@assign_queue('user_presence')
-class UserPresenceWorker(QueueProcessingWorker):
-    def consume(self, event):
-        # type: (Mapping[str, Any]) -> None
-        logging.info("Received event: %s" % (event),)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+def get_user_profiles_for_events(events):
+    # type: (List[Dict[str, Any]]) -> Dict[int, UserProfile]
+    user_profiles = bulk_get_user_profiles_by_id(event["user_profile_id"] for event in events)
+    for event in events:
+        if event["user_profile_id"] not in user_profiles:
+            logging.warning("Dropping event for missing user: %s" % (event,))
+    return user_profiles
+
+# Every open client sends a presence update every minute (and makes
+# other requests all the time), so these queues see a lot of traffic;
+# we process them in batches, coalescing the updates for each user.
+@assign_queue('user_activity', queue_type="loop")
+class UserActivityWorker(LoopQueueProcessingWorker):
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        user_profiles = get_user_profiles_for_events(events)
+        bulk_update_user_activity([
+            (user_profiles[event["user_profile_id"]], get_client(event["client"]),
+             event["query"], timestamp_to_datetime(event["time"]))
+            for event in events if event["user_profile_id"] in user_profiles])
+
+@assign_queue('user_activity_interval', queue_type="loop")
+class UserActivityIntervalWorker(LoopQueueProcessingWorker):
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        user_profiles = get_user_profiles_for_events(events)
+        bulk_update_user_activity_interval([
+            (user_profiles[event["user_profile_id"]], timestamp_to_datetime(event["time"]))
+            for event in events if event["user_profile_id"] in user_profiles])
+
+@assign_queue('user_presence', queue_type="loop")
+class UserPresenceWorker(LoopQueueProcessingWorker):
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        logging.info("Received %d events" % (len(events),))
+        user_profiles = get_user_profiles_for_events(events)
+        bulk_update_user_presence([
+            (user_profiles[event["user_profile_id"]], get_client(event["client"]),
+             timestamp_to_datetime(event["time"]), event["status"])
+            for event in events if event["user_profile_id"] in user_profiles])
 
 @assign_queue('missedmessage_emails', queue_type="loop")
 class MissedMessageWorker(QueueProcessingWorker):
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import base64
+import time
+from typing import Any, Dict, Generator, Text
+
+from django.conf import settings
+from django.core.management.base import CommandParser
+from django.test.utils import override_settings
+from six.moves import urllib_parse
+from tornado import gen, httpserver, ioloop, netutil
+from tornado.httpclient import AsyncHTTPClient
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.tornado.application import create_tornado_application
+from zerver.tornado.event_queue import allocate_client_descriptor
+
+class Command(ZulipBaseCommand):
+    help = """Measure how many GET /api/v1/events requests per second Tornado serves.
+
+Starts Tornado in this process on a free local port, creates an event
+queue for the given user, and polls it with dont_block requests, with
+the events fast path (see zerver/tornado/fast_path.py) enabled and
+then disabled.
+
+Usage: ./manage.py benchmark_get_events <email> [--requests=2000] [--concurrency=10]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('email', metavar='<email>', type=str,
+                            help='Email address of the user polling for events')
+        parser.add_argument('--requests', dest='requests', type=int, default=2000,
+                            help='Number of requests to make in each configuration')
+        parser.add_argument('--concurrency', dest='concurrency', type=int, default=10,
+                            help='Number of requests to have in flight at once')
+        self.add_realm_args(parser)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        user_profile = self.get_user(options['email'], realm)
+        num_requests = options['requests']
+        concurrency = options['concurrency']
+
+        # Like runtornado; this also lets API requests from localhost
+        # through the subdomain check.
+        settings.RUNNING_INSIDE_TORNADO = True
+        sockets = netutil.bind_sockets(0, '127.0.0.1')
+        port = sockets[0].getsockname()[1]
+        server = httpserver.HTTPServer(create_tornado_application(), xheaders=True)
+        server.add_sockets(sockets)
+
+        client = allocate_client_descriptor(dict(
+            user_profile_id=user_profile.id,
+            user_profile_email=user_profile.email,
+            realm_id=user_profile.realm_id,
+            event_types=None,
+            client_type_name='benchmark',
+            apply_markdown=True,
+            all_public_streams=False,
+            queue_timeout=0,
+            last_connection_time=time.time(),
+            narrow=[]))
+        url = 'http://127.0.0.1:%d/api/v1/events?%s' % (port, urllib_parse.urlencode({
+            'queue_id': client.event_queue.id,
+            'last_event_id': -1,
+            'dont_block': 'true',
+        }))
+        credentials = u"%s:%s" % (user_profile.email, user_profile.api_key)
+        headers = {
+            'Authorization': u'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('utf-8'),
+        }  # type: Dict[str, Text]
+        http_client = AsyncHTTPClient(max_clients=concurrency)
+
+        @gen.coroutine
+        def worker(count):
+            # type: (int) -> Generator[Any, Any, None]
+            for i in range(count):
+                yield http_client.fetch(url, headers=headers)
+
+        @gen.coroutine
+        def benchmark(name):
+            # type: (str) -> Generator[Any, Any, None]
+            # Warm up caches and connections.
+            yield http_client.fetch(url, headers=headers)
+            start = time.time()
+            yield [worker(num_requests // concurrency) for i in range(concurrency)]
+            elapsed = time.time() - start
+            total = (num_requests // concurrency) * concurrency
+            print("%-12s %6d requests in %7.3fs (%8.1f requests/sec)" % (
+                name, total, elapsed, total / elapsed))
+
+        @gen.coroutine
+        def run():
+            # type: () -> Generator[Any, Any, None]
+            with override_settings(TORNADO_EVENTS_FAST_PATH=True):
+                yield benchmark('fast path')
+            with override_settings(TORNADO_EVENTS_FAST_PATH=False):
+                yield benchmark('django')
+
+        ioloop.IOLoop.current().run_sync(run)
+        server.stop()
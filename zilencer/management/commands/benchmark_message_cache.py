@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+import ujson
+import zlib
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import CommandParser
+from six import binary_type
+from six.moves import range
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import MessageDict, extract_message_dict, stringify_message_dict
+from zerver.lib.str_utils import dict_with_str_keys
+from zerver.models import Message
+
+# The format the to_dict cache used before the binary one.
+def json_stringify_message_dict(message_dict):
+    # type: (Dict[str, Any]) -> binary_type
+    return zlib.compress(ujson.dumps(message_dict).encode('utf-8'))
+
+def json_extract_message_dict(message_bytes):
+    # type: (binary_type) -> Dict[str, Any]
+    return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes).decode("utf-8")))
+
+FORMATS = [
+    ('zlib+json', json_stringify_message_dict, json_extract_message_dict),
+    ('msgpack', stringify_message_dict, extract_message_dict),
+]
+
+class Command(ZulipBaseCommand):
+    help = """Measure the cost of encoding and decoding message dicts in the
+format stored in the to_dict cache, and the number of bytes stored per
+message, for the current binary format and the zlib-compressed JSON
+format used previously.
+
+Uses the most recent messages in the realm; doesn't modify anything.
+
+Usage: ./manage.py benchmark_message_cache -r <realm> [--messages=1000] [--rounds=10]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--messages', dest='messages', type=int, default=1000,
+                            help='Number of recent messages to use')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=10,
+                            help='Number of times to encode and decode each message')
+        self.add_realm_args(parser, True)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        rounds = options['rounds']
+        message_ids = list(Message.objects.filter(sender__realm=realm).order_by('-id')
+                           .values_list('id', flat=True)[:options['messages']])
+        message_dicts = [MessageDict.build_dict_from_raw_db_row(row, apply_markdown)
+                         for row in Message.get_raw_db_rows(message_ids)
+                         for apply_markdown in (True, False)]
+        if not message_dicts:
+            print("No messages in this realm.")
+            return
+
+        def timed(function, items):
+            # type: (Callable[[Any], Any], List[Any]) -> float
+            start = time.time()
+            for i in range(rounds):
+                for item in items:
+                    function(item)
+            return (time.time() - start) / (rounds * len(items))
+
+        print("%d message dicts, %d rounds" % (len(message_dicts), rounds))
+        for name, stringify, extract in FORMATS:
+            encoded = [stringify(message_dict) for message_dict in message_dicts]
+            assert [extract(message_bytes) for message_bytes in encoded] == message_dicts
+            encode_time = timed(stringify, message_dicts)
+            decode_time = timed(extract, encoded)
+            average_size = float(sum(len(message_bytes) for message_bytes in encoded)) / len(encoded)
+            print("%-10s encode %7.1fus  decode %7.1fus  %7.1f bytes/message" % (
+                name, encode_time * 1e6, decode_time * 1e6, average_size))
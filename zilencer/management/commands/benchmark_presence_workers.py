@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import datetime
+import time
+from typing import Any, Callable, List, Sequence
+
+from django.core.management.base import CommandParser
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.actions import bulk_update_user_activity, \
+    bulk_update_user_activity_interval, bulk_update_user_presence
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import UserPresence, UserProfile, get_client
+
+class Command(ZulipBaseCommand):
+    help = """Measure how many user_presence, user_activity and
+user_activity_interval events per second the queue workers can record,
+for several batch sizes.  A batch size of 1 is equivalent to processing
+events one at a time.
+
+The events are presence heartbeats and requests from every active human
+user in the realm, from a few clients, so this writes UserPresence,
+UserActivity and UserActivityInterval rows; only run it against a
+development or throwaway database.
+
+Usage: ./manage.py benchmark_presence_workers -r <realm> [--batch-sizes=1,10,100,1000]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--batch-sizes', dest='batch_sizes', type=str,
+                            default='1,10,100,1000',
+                            help='Comma-separated list of batch sizes to measure')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=3,
+                            help='Number of heartbeats per user and client for each batch size')
+        self.add_realm_args(parser, True)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        user_profiles = list(UserProfile.objects.select_related().filter(
+            realm=realm, is_active=True, is_bot=False))
+        clients = [get_client(name) for name in ['website', 'ZulipAndroid', 'ZulipiOS']]
+        batch_sizes = [int(size) for size in options['batch_sizes'].split(',')]
+        rounds = options['rounds']
+
+        # Each round is a minute's worth of heartbeats, ending now.
+        log_time = timezone_now() - datetime.timedelta(minutes=(len(batch_sizes) * rounds + 1))
+
+        def make_round(log_time):
+            # type: (datetime.datetime) -> List[Any]
+            return [(user_profile, client, log_time) for user_profile in user_profiles
+                    for client in clients]
+
+        def run(name, process, events, batch_size):
+            # type: (str, Callable[[Sequence[Any]], None], List[Any], int) -> None
+            start = time.time()
+            for i in range(0, len(events), batch_size):
+                process(events[i:i + batch_size])
+            elapsed = time.time() - start
+            print("%-24s batch size %5d: %6d events in %7.3fs (%8.1f events/sec)" % (
+                name, batch_size, len(events), elapsed, len(events) / elapsed))
+
+        # Create the UserPresence and UserActivity rows first, since
+        # nearly all real heartbeats update existing rows.
+        heartbeats = make_round(log_time)
+        bulk_update_user_presence([(user_profile, client, t, UserPresence.ACTIVE)
+                                   for (user_profile, client, t) in heartbeats])
+        bulk_update_user_activity([(user_profile, client, 'get_events_backend', t)
+                                   for (user_profile, client, t) in heartbeats])
+
+        for batch_size in batch_sizes:
+            heartbeats = []
+            for i in range(rounds):
+                log_time += datetime.timedelta(minutes=1)
+                heartbeats.extend(make_round(log_time))
+            run('user_presence', bulk_update_user_presence,
+                [(user_profile, client, t, UserPresence.ACTIVE)
+                 for (user_profile, client, t) in heartbeats], batch_size)
+            run('user_activity', bulk_update_user_activity,
+                [(user_profile, client, 'get_events_backend', t)
+                 for (user_profile, client, t) in heartbeats], batch_size)
+            run('user_activity_interval', bulk_update_user_activity_interval,
+                [(user_profile, t) for (user_profile, client, t) in heartbeats], batch_size)
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+from typing import Any, List
+
+from django.core.management.base import CommandParser
+
+from zerver.lib.actions import do_send_messages, internal_prep_stream_message
+from zerver.lib.management import ZulipBaseCommand
+
+class Command(ZulipBaseCommand):
+    help = """Measure do_send_messages throughput for several batch sizes.
+
+This sends real messages to the given stream, so only run it against a
+development or throwaway database.
+
+Usage: ./manage.py benchmark_send_messages <email> <stream> [--batch-sizes=1,10,100,1000]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('email', metavar='<email>', type=str,
+                            help='Email address of the sender')
+        parser.add_argument('stream', metavar='<stream>', type=str,
+                            help='Name of the stream to send the messages to')
+        parser.add_argument('--batch-sizes', dest='batch_sizes', type=str,
+                            default='1,10,100,1000',
+                            help='Comma-separated list of batch sizes to measure')
+        parser.add_argument('--total', dest='total', type=int, default=1000,
+                            help='Number of messages to send for each batch size')
+        self.add_realm_args(parser)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = self.get_realm(options)
+        sender = self.get_user(options['email'], realm)
+        batch_sizes = [int(size) for size in options['batch_sizes'].split(',')]
+        total = options['total']
+
+        for batch_size in batch_sizes:
+            num_batches = max(1, total // batch_size)
+            elapsed = 0.0
+            for batch in range(num_batches):
+                messages = [
+                    internal_prep_stream_message(sender.realm, sender, options['stream'],
+                                                 'benchmark %d' % (batch_size,),
+                                                 'Benchmark message %d of batch %d' % (i, batch))
+                    for i in range(batch_size)
+                ]  # type: List[Any]
+                start = time.time()
+                do_send_messages(messages)
+                elapsed += time.time() - start
+            sent = num_batches * batch_size
+            print("batch size %5d: sent %d messages in %.3fs (%.1f messages/sec)" % (
+                batch_size, sent, elapsed, sent / elapsed))
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+from typing import Any, Callable, List, Optional, Text, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.tex import render_tex_in_subprocess, render_tex_many, \
+    render_tex_with_server
+
+FORMULAS = [
+    u'x^2 + y^2 = z^2',
+    u'\\frac{-b \\pm \\sqrt{b^2 - 4ac}}{2a}',
+    u'\\int_0^\\infty e^{-x^2} dx = \\frac{\\sqrt{\\pi}}{2}',
+    u'\\sum_{n=1}^{\\infty} \\frac{1}{n^2} = \\frac{\\pi^2}{6}',
+    u'e^{i\\pi} + 1 = 0',
+    u'\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}',
+    u'\\lim_{h \\to 0} \\frac{f(x + h) - f(x)}{h}',
+    u'\\nabla \\times \\mathbf{E} = -\\frac{\\partial \\mathbf{B}}{\\partial t}',
+]
+
+class Command(BaseCommand):
+    help = """Compare the throughput of the ways we can render TeX formulas.
+
+Measures starting a KaTeX process per formula (cli.js), the persistent
+KaTeX server with batches of one formula and of --batch-size formulas,
+and render_tex_many once its caches are warm.
+
+Usage: ./manage.py benchmark_tex [--count=200] [--batch-size=20]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--count', dest='count', type=int, default=200,
+                            help='Number of formulas to render with each method')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=20,
+                            help='Number of formulas per batch for the batched methods')
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        count = options['count']
+        batch_size = options['batch_size']
+        # Make each formula distinct, so the server does real work.
+        formulas = [(FORMULAS[i % len(FORMULAS)] + u' + %d' % (i,), i % 2 == 0)
+                    for i in range(count)]
+
+        def benchmark(name, render_batch, batch_size, formulas):
+            # type: (str, Callable[[List[Tuple[Text, bool]]], Any], int, List[Tuple[Text, bool]]) -> None
+            start = time.time()
+            for i in range(0, len(formulas), batch_size):
+                render_batch(formulas[i:i + batch_size])
+            elapsed = time.time() - start
+            print("%-28s %6d formulas in %7.3fs (%8.1f formulas/sec)" % (
+                name, len(formulas), elapsed, len(formulas) / elapsed))
+
+        def render_in_subprocesses(batch):
+            # type: (List[Tuple[Text, bool]]) -> List[Optional[Text]]
+            return [render_tex_in_subprocess(tex, is_inline) for (tex, is_inline) in batch]
+
+        # Start the server before timing anything.
+        render_tex_with_server([(u'x', True)])
+
+        # Starting a process per formula is slow, so use fewer formulas.
+        benchmark('subprocess per formula', render_in_subprocesses, 1,
+                  formulas[:max(1, count // 10)])
+        benchmark('server, batches of 1', render_tex_with_server, 1, formulas)
+        benchmark('server, batches of %d' % (batch_size,), render_tex_with_server,
+                  batch_size, formulas)
+        render_tex_many(formulas)
+        benchmark('render_tex_many, cached', render_tex_many, batch_size, formulas)
@@ -405,3 +405,46 @@ CAMO_URI = '/external_content/'
 
 # Controls whether Zulip will rate-limit user requests.
 # RATE_LIMITING = True
+
+# Checking a request against the rate limits takes a round trip to
+# redis.  If this is set to N > 1, a request from a user who is far
+# below their limits reserves N requests at once, and the server
+# process then allows the next N - 1 requests from that user without
+# checking with redis.  This can let a user briefly exceed a limit by
+# up to N - 1 requests per server process, and delays manual blocks
+# (`manage.py rate_limit`) by up to the shortest rule's range.
+# RATE_LIMITING_LOCAL_LEASE = 0
+
+# Number of Tornado processes to shard the event queue system across.
+# Shard N listens on port 9993 + N; users are assigned to shards by
+# user ID.  Defaults to `tornado_processes` in the [application_server]
+# section of /etc/zulip/zulip.conf, which also configures nginx and
+# supervisor to match; see the "Sharding" section of
+# docs/events-system.md.
+# TORNADO_PROCESSES = 1
+
+# Limits on how many events, and roughly how many bytes of events, an
+# event queue can hold.  A queue that exceeds either limit (usually
+# because its client went away without its queue being garbage
+# collected yet) is replaced by a single event telling the client to
+# reload its state.
+# EVENT_QUEUE_MAX_EVENTS = 10000
+# EVENT_QUEUE_MAX_BYTES = 16 * 1024 * 1024
+
+# Serve requests for events from existing event queues without going
+# through the full Django middleware stack (see
+# zerver/tornado/fast_path.py).
+# TORNADO_EVENTS_FAST_PATH = True
+
+# Render markdown in a pool of this many worker processes (per
+# Django process), instead of in the process handling the request.
+# This enforces the markdown rendering timeout by killing the worker,
+# and renders batches of messages in parallel.  0 disables the pool.
+# BUGDOWN_RENDER_PROCESSES = 0
+
+# Keep up to this many users, streams and display recipients in an
+# in-process cache in front of memcached, for up to LOCAL_CACHE_TIMEOUT
+# seconds each.  Changes are propagated between processes via redis
+# at the start of each request.  0 disables the in-process cache.
+# LOCAL_CACHE_SIZE = 0
+# LOCAL_CACHE_TIMEOUT = 60
@@ -136,7 +136,10 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'RABBITMQ_HOST': 'localhost',
                     'RABBITMQ_USERNAME': 'zulip',
                     'MEMCACHED_LOCATION': '127.0.0.1:11211',
+                    'LOCAL_CACHE_SIZE': 0,
+                    'LOCAL_CACHE_TIMEOUT': 60,
                     'RATE_LIMITING': True,
+                    'RATE_LIMITING_LOCAL_LEASE': 0,
                     'REDIS_HOST': '127.0.0.1',
                     'REDIS_PORT': 6379,
                     # The following bots only exist in non-VOYAGER installs
@@ -217,6 +220,14 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'PASSWORD_MIN_ZXCVBN_QUALITY': 0.5,
                     'OFFLINE_THRESHOLD_SECS': 5 * 60,
                     'PUSH_NOTIFICATION_BOUNCER_URL': None,
+                    'TORNADO_PROCESSES': (config_file.getint('application_server', 'tornado_processes')
+                                          if config_file.has_option('application_server',
+                                                                    'tornado_processes')
+                                          else 1),
+                    'EVENT_QUEUE_MAX_EVENTS': 10000,
+                    'EVENT_QUEUE_MAX_BYTES': 16 * 1024 * 1024,
+                    'TORNADO_EVENTS_FAST_PATH': True,
+                    'BUGDOWN_RENDER_PROCESSES': 0,
                     }
 
 for setting_name, setting_val in six.iteritems(DEFAULT_SETTINGS):
@@ -395,6 +406,9 @@ ZILENCER_ENABLED = 'zilencer' in INSTALLED_APPS
 # We override the port number when running frontend tests.
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
+# When TORNADO_PROCESSES > 1, this is the index of the event queue
+# shard served by the current Tornado process; see zerver/tornado/sharding.py.
+TORNADO_SHARD = 0
 AUTORELOAD = DEBUG
 
 ########################################################################
@@ -253,6 +253,8 @@ v1_api_and_json_patterns = [
         {'GET': 'zerver.views.messages.json_fetch_raw_message',
          'PATCH': 'zerver.views.messages.update_message_backend',
          'DELETE': 'zerver.views.messages.delete_message_backend'}),
+    url(r'^messages/page$', rest_dispatch,
+        {'GET': 'zerver.views.messages.get_messages_page_backend'}),
     url(r'^messages/render$', rest_dispatch,
         {'POST': 'zerver.views.messages.render_message_backend'}),
     url(r'^messages/flags$', rest_dispatch,